@@ -0,0 +1,277 @@
+import asyncio
+import math
+import time
+from contextlib import asynccontextmanager
+from typing import Callable, Dict, Optional
+
+import metrics
+from scheduling import BATCH, DEFAULT_TENANT, INTERACTIVE, PRIORITIES, FairQueue, Flow
+
+# Flow of requests that were not classified
+DEFAULT_FLOW: Flow = (INTERACTIVE, DEFAULT_TENANT, "")
+
+GRADIENT = "gradient"
+AIMD = "aimd"
+
+
+class AdmissionRejected(Exception):
+    """
+    Raised when a request cannot be admitted upstream, either because the
+    wait queue is full or because its deadline passed while queued.
+
+    Attributes:
+        reason (str): "queue_full" or "deadline"
+        retry_after_s (int): Suggested client back-off in seconds
+    """
+
+    def __init__(self, reason: str, retry_after_s: int):
+        super().__init__(f"Request not admitted: {reason}")
+        self.reason = reason
+        self.retry_after_s = retry_after_s
+
+
+class AdaptiveAdmissionController:
+    """
+    Limits the number of concurrent upstream generations with a concurrency
+    limit that adapts to observed latency, so vLLM runs near its throughput
+    knee instead of thrashing its KV cache.
+
+    Requests over the limit wait in a bounded weighted fair queue, each until
+    its own deadline (at most `queue_timeout_s`), and are dispatched by the
+    share of their flow (priority, tenant, language): a flow's weight is its
+    priority weight times its tenant weight. A fraction of the limit is
+    reserved for the interactive priority, which batch requests can never
+    occupy. When the queue is full the request is rejected at once so the
+    endpoint can answer 429 with Retry-After.
+
+    The "gradient" algorithm compares the unloaded (baseline) latency with
+    the recent latency once per round trip: while recent latency stays within
+    `tolerance` of the baseline the limit grows by roughly its square root,
+    and when it rises above (requests are queueing inside vLLM) the limit
+    shrinks in proportion. The "aimd" algorithm adds one slot per limit's
+    worth of fast successes and multiplies the limit by `aimd_backoff` at most
+    once per round trip with a slow or failed request. With either algorithm
+    the limit stops growing while more than `engine_max_waiting` requests are
+    queued inside vLLM (`engine_waiting_fn`), which already has more work than
+    it can schedule.
+
+    Attributes:
+        limit (float): Current concurrency limit
+        inflight (int): Admitted requests that have not finished yet
+        min_limit (int): Lower bound of the limit
+        max_limit (int): Upper bound of the limit
+        max_queue_size (int): Requests allowed to wait for a slot
+        queue_timeout_s (float): Longest time a request may wait for a slot
+        algorithm (str): "gradient" or "aimd"
+        priority_weights (Dict[str, float]): Fair-share weight per priority
+        tenant_weights (Dict[str, float]): Fair-share weight per tenant (default 1)
+        interactive_reserved_fraction (float): Share of the limit batch requests cannot use
+        engine_waiting_fn (Optional[Callable]): Returns the requests queued inside vLLM
+        engine_max_waiting (int): Engine queue length above which the limit does not grow
+    """
+
+    def __init__(
+        self,
+        initial_limit: int = 64,
+        min_limit: int = 8,
+        max_limit: int = 512,
+        max_queue_size: int = 256,
+        queue_timeout_s: float = 2.0,
+        algorithm: str = GRADIENT,
+        smoothing: float = 0.5,
+        tolerance: float = 1.5,
+        baseline_window_s: float = 30.0,
+        recent_alpha: float = 0.2,
+        aimd_latency_threshold_s: float = 5.0,
+        aimd_backoff: float = 0.9,
+        priority_weights: Optional[Dict[str, float]] = None,
+        tenant_weights: Optional[Dict[str, float]] = None,
+        interactive_reserved_fraction: float = 0.25,
+        engine_waiting_fn: Optional[Callable[[], int]] = None,
+        engine_max_waiting: int = 8,
+    ):
+        if algorithm not in (GRADIENT, AIMD):
+            raise ValueError(f"Unknown admission algorithm: {algorithm}")
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.max_queue_size = max_queue_size
+        self.queue_timeout_s = queue_timeout_s
+        self.algorithm = algorithm
+        self.smoothing = smoothing
+        self.tolerance = tolerance
+        self.baseline_window_s = baseline_window_s
+        self.recent_alpha = recent_alpha
+        self.aimd_latency_threshold_s = aimd_latency_threshold_s
+        self.aimd_backoff = aimd_backoff
+        self.priority_weights = priority_weights or {INTERACTIVE: 4.0, BATCH: 1.0}
+        self.tenant_weights = tenant_weights or {}
+        self.interactive_reserved_fraction = interactive_reserved_fraction
+        self.engine_waiting_fn = engine_waiting_fn
+        self.engine_max_waiting = engine_max_waiting
+        self.inflight = 0
+        self.inflight_by_priority = {priority: 0 for priority in PRIORITIES}
+        self.baseline_latency_s: Optional[float] = None
+        self.recent_latency_s: Optional[float] = None
+        self._waiters = FairQueue()
+        self._last_sample_at = time.monotonic()
+        self._last_update_at = 0.0
+
+        metrics.admission_limit.set(self.limit)
+
+    def queue_length(self) -> int:
+        return len(self._waiters)
+
+    def retry_after_s(self) -> int:
+        """
+        Rough time for the current queue to drain, in whole seconds (at least 1).
+        """
+        latency_s = self.recent_latency_s or self.queue_timeout_s
+        return max(1, math.ceil(latency_s * (len(self._waiters) + 1) / max(self.limit, 1)))
+
+    def _can_admit(self, priority: str) -> bool:
+        if self.inflight >= self.limit:
+            return False
+        if priority == INTERACTIVE:
+            return True
+        # The reserved interactive lane is never lent out to other priorities
+        shared_limit = self.limit * (1 - self.interactive_reserved_fraction)
+        return self.inflight - self.inflight_by_priority[INTERACTIVE] < shared_limit
+
+    def _admit(self, priority: str):
+        self.inflight += 1
+        self.inflight_by_priority[priority] += 1
+        metrics.admission_inflight.labels(priority=priority).set(self.inflight_by_priority[priority])
+
+    def weight(self, flow: Flow) -> float:
+        priority, tenant, _ = flow
+        return self.priority_weights.get(priority, 1.0) * self.tenant_weights.get(tenant, 1.0)
+
+    async def acquire(self, deadline: Optional[float] = None, flow: Flow = DEFAULT_FLOW):
+        """
+        Wait for a slot until `deadline` (time.monotonic() seconds), but no
+        longer than `queue_timeout_s`. `flow` is the (priority, tenant,
+        language) class of the request.
+
+        Raises:
+            AdmissionRejected: If the queue is full or the deadline passed
+        """
+        priority, _, language = flow
+        if not self._waiters and self._can_admit(priority):
+            self._admit(priority)
+            metrics.admission_queue_wait_seconds.labels(priority=priority, language=language).observe(0)
+            return
+        if len(self._waiters) >= self.max_queue_size:
+            metrics.admission_rejected_total.labels(reason="queue_full", priority=priority).inc()
+            raise AdmissionRejected("queue_full", self.retry_after_s())
+
+        queue_deadline = time.monotonic() + self.queue_timeout_s
+        deadline = queue_deadline if deadline is None else min(deadline, queue_deadline)
+        future = asyncio.get_running_loop().create_future()
+        entry = self._waiters.push(flow, self.weight(flow), future)
+        # The new request may be runnable at once if only other priorities are blocked
+        self._grant_waiters()
+        start_time = time.perf_counter()
+        try:
+            # A granted slot is already counted in `inflight` by `_grant_waiters`
+            await asyncio.wait_for(asyncio.shield(future), max(0.0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            if future.done() and not future.cancelled():
+                # Granted at the very moment the deadline passed
+                return
+            metrics.admission_rejected_total.labels(reason="deadline", priority=priority).inc()
+            raise AdmissionRejected("deadline", self.retry_after_s()) from None
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was granted just as the caller went away: hand it on
+                self.release(priority=priority)
+            raise
+        finally:
+            if not future.done():
+                future.cancel()
+                self._waiters.remove(entry)
+            metrics.admission_queue_length.set(len(self._waiters))
+            metrics.admission_queue_wait_seconds.labels(priority=priority, language=language).observe(
+                time.perf_counter() - start_time
+            )
+
+    def _grant_waiters(self):
+        while self._waiters:
+            popped = self._waiters.pop(self._can_admit)
+            if popped is None:
+                break
+            (priority, _, _), future = popped
+            self._admit(priority)
+            future.set_result(None)
+        metrics.admission_queue_length.set(len(self._waiters))
+
+    def release(self, latency_s: Optional[float] = None, failed: bool = False, priority: str = INTERACTIVE):
+        """
+        Free a slot of `priority` and feed the request's latency (None when
+        unknown) into the limit.
+        """
+        self.inflight -= 1
+        self.inflight_by_priority[priority] -= 1
+        metrics.admission_inflight.labels(priority=priority).set(self.inflight_by_priority[priority])
+        if latency_s is not None or failed:
+            self._update_limit(latency_s, failed)
+        self._grant_waiters()
+
+    def _update_limit(self, latency_s: Optional[float], failed: bool):
+        now = time.monotonic()
+        if latency_s is not None:
+            if self.baseline_latency_s is None:
+                self.baseline_latency_s = self.recent_latency_s = latency_s
+            else:
+                self.recent_latency_s += self.recent_alpha * (latency_s - self.recent_latency_s)
+                # The baseline follows the lowest latency seen and only drifts up over `baseline_window_s`
+                drift = min(1.0, (now - self._last_sample_at) / self.baseline_window_s)
+                self.baseline_latency_s = min(
+                    latency_s, self.baseline_latency_s + drift * (self.recent_latency_s - self.baseline_latency_s)
+                )
+            self._last_sample_at = now
+        # Idle periods say nothing about capacity
+        saturated = self.inflight + 1 >= self.limit / 2
+        # Samples finishing in the same round trip all reflect the same limit: act on them once
+        round_trip_over = now - self._last_update_at >= (self.recent_latency_s or 0.0)
+
+        if self.algorithm == AIMD:
+            if failed or latency_s > self.aimd_latency_threshold_s:
+                if not round_trip_over:
+                    return
+                new_limit = self.limit * self.aimd_backoff
+            elif saturated:
+                new_limit = self.limit + 1 / self.limit
+            else:
+                return
+        else:
+            if latency_s is None or not saturated or not round_trip_over:
+                return
+            gradient = max(0.5, min(1.0, self.tolerance * self.baseline_latency_s / self.recent_latency_s))
+            new_limit = self.limit * gradient + math.sqrt(self.limit)
+            new_limit = self.limit * (1 - self.smoothing) + new_limit * self.smoothing
+        if new_limit > self.limit and self.engine_waiting_fn is not None and self.engine_waiting_fn() > self.engine_max_waiting:
+            # More concurrency would only wait in vLLM's own queue
+            new_limit = self.limit
+        self._last_update_at = now
+        self.limit = min(self.max_limit, max(self.min_limit, new_limit))
+        metrics.admission_limit.set(self.limit)
+
+    @asynccontextmanager
+    async def slot(self, deadline: Optional[float] = None, flow: Flow = DEFAULT_FLOW):
+        """
+        Hold one admission slot for the duration of the block; its latency
+        feeds the limit, an exception counts as a failed request.
+        """
+        priority = flow[0]
+        await self.acquire(deadline, flow)
+        start_time = time.perf_counter()
+        try:
+            yield
+        except asyncio.CancelledError:
+            self.release(priority=priority)
+            raise
+        except Exception:
+            self.release(failed=True, priority=priority)
+            raise
+        self.release(time.perf_counter() - start_time, priority=priority)
@@ -0,0 +1,232 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, NamedTuple, Optional
+
+from openai.types import CompletionUsage
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# submit_batch(key, payloads) -> one result per payload, in order
+SubmitBatch = Callable[[Hashable, List[Any]], Awaitable[List[Any]]]
+
+
+class GenerationResult(NamedTuple):
+    """
+    One generation, whether it came from its own chat completion or from a batch.
+    """
+    text: str
+    finish_reason: Optional[str]
+    stop_reason: Any
+    model: str
+    usage: Optional[CompletionUsage]
+
+
+def from_chat_completion(response) -> GenerationResult:
+    choice = response.choices[0]
+    return GenerationResult(
+        choice.message.content, choice.finish_reason, getattr(choice, "stop_reason", None),
+        response.model, response.usage,
+    )
+
+
+def render_chat_prompt(messages: List[dict]) -> str:
+    """
+    Render chat messages with the Gemma 3 chat template, as vLLM does for a
+    chat completion. The system prompt is folded into the first user turn.
+    `<bos>` is left out: the completions endpoint adds it when tokenizing.
+    """
+    prefix = ""
+    turns = []
+    for message in messages:
+        if message["role"] == "system":
+            prefix = message["content"] + "\n\n"
+            continue
+        role = "model" if message["role"] == "assistant" else message["role"]
+        turns.append(f"<start_of_turn>{role}\n{prefix}{message['content'].strip()}<end_of_turn>\n")
+        prefix = ""
+    turns.append("<start_of_turn>model\n")
+    return "".join(turns)
+
+
+def merge_generation_params(params: List[dict]) -> dict:
+    """
+    Generation parameters of one batched call: the largest `max_tokens` of
+    the batch and the stop sequences every item asked for.
+    """
+    merged = {"max_tokens": max(p["max_tokens"] for p in params)}
+    stops = [s for s in params[0].get("stop", []) if all(s in p.get("stop", []) for p in params[1:])]
+    if stops:
+        merged["stop"] = stops
+    return merged
+
+
+def split_completion_batch(response, prompts: List[str]) -> List[GenerationResult]:
+    """
+    Fan a multi-prompt completion back out into one result per prompt.
+
+    vLLM reports token usage for the whole call only, so each item gets a
+    share of the prompt tokens proportional to its prompt length and of the
+    completion tokens proportional to its output length.
+    """
+    choices = sorted(response.choices, key=lambda c: c.index)
+    usage = response.usage
+    prompt_chars = sum(len(p) for p in prompts) or 1
+    output_chars = sum(len(c.text) for c in choices)
+    results = []
+    for prompt, choice in zip(prompts, choices):
+        item_usage = None
+        if usage is not None:
+            prompt_tokens = round(usage.prompt_tokens * len(prompt) / prompt_chars)
+            if output_chars:
+                completion_tokens = round(usage.completion_tokens * len(choice.text) / output_chars)
+            else:
+                completion_tokens = usage.completion_tokens // len(choices)
+            item_usage = CompletionUsage(
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                total_tokens=prompt_tokens + completion_tokens,
+            )
+        results.append(GenerationResult(
+            choice.text, choice.finish_reason, getattr(choice, "stop_reason", None), response.model, item_usage,
+        ))
+    return results
+
+
+class MicroBatchDispatcher:
+    """
+    Collects concurrent upstream requests per key (the adapter and language,
+    so that a batch goes to one replica) for up to `max_wait_ms` or until
+    `max_batch_size` requests are queued, sends each group with one
+    `submit_batch` call and fans the results back out to the waiting callers.
+
+    A caller that goes away leaves its batch running for the others; the
+    upstream call is only cancelled when every caller of the batch is gone.
+
+    Attributes:
+        max_wait_ms (float): How long the first request of a batch may wait for company
+        max_batch_size (int): Maximum number of requests submitted together
+    """
+
+    def __init__(self, submit_batch: SubmitBatch, max_wait_ms: float = 5.0, max_batch_size: int = 32):
+        self.submit_batch = submit_batch
+        self.max_wait_ms = max_wait_ms
+        self.max_batch_size = max_batch_size
+        self._queues: Dict[Hashable, asyncio.Queue] = {}
+        self._workers: Dict[Hashable, asyncio.Task] = {}
+        self._inflight_batches: set = set()
+
+        metrics.batch_max_wait_ms.set(max_wait_ms)
+        metrics.batch_max_size.set(max_batch_size)
+
+    def queue_depth(self) -> int:
+        """
+        Requests waiting for their batch to be sent, over all keys.
+        """
+        return sum(queue.qsize() for queue in self._queues.values())
+
+    def _get_queue(self, key: Hashable) -> asyncio.Queue:
+        queue = self._queues.get(key)
+        if queue is None:
+            # Unbounded: every queued request already holds an admission slot
+            queue = asyncio.Queue()
+            self._queues[key] = queue
+            self._workers[key] = asyncio.create_task(self._worker(key, queue))
+        return queue
+
+    async def submit(self, key: Hashable, payload: Any) -> Any:
+        """
+        Enqueue one request under `key` (whose first element is the adapter)
+        and wait for its result.
+        """
+        queue = self._get_queue(key)
+        future = asyncio.get_running_loop().create_future()
+        queue.put_nowait((payload, future, time.perf_counter()))
+        metrics.batch_queue_depth.labels(adapter=key[0]).inc()
+        return await future
+
+    async def _worker(self, key: Hashable, queue: asyncio.Queue):
+        adapter = key[0]
+        max_wait_s = self.max_wait_ms / 1000
+        while True:
+            batch = [await queue.get()]
+            deadline = time.perf_counter() + max_wait_s
+            while len(batch) < self.max_batch_size:
+                if not queue.empty():
+                    batch.append(queue.get_nowait())
+                    continue
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            metrics.batch_queue_depth.labels(adapter=adapter).dec(len(batch))
+
+            # Callers that gave up while queued are dropped before submission
+            batch = [item for item in batch if not item[1].done()]
+            if not batch:
+                continue
+            task = asyncio.create_task(self._run_batch(key, batch))
+            self._inflight_batches.add(task)
+            task.add_done_callback(self._inflight_batches.discard)
+
+    async def _run_batch(self, key: Hashable, batch: List[tuple]):
+        adapter = key[0]
+        now = time.perf_counter()
+        metrics.batch_size.labels(adapter=adapter).observe(len(batch))
+        for _, _, enqueued_at in batch:
+            metrics.batch_wait_seconds.labels(adapter=adapter).observe(now - enqueued_at)
+
+        futures = [future for _, future, _ in batch]
+        call = asyncio.create_task(self.submit_batch(key, [payload for payload, _, _ in batch]))
+
+        def on_caller_done(_):
+            if not call.done() and all(future.done() for future in futures):
+                call.cancel()
+
+        for future in futures:
+            future.add_done_callback(on_caller_done)
+        try:
+            await asyncio.wait([call])
+        except asyncio.CancelledError:
+            call.cancel()
+            for future in futures:
+                if not future.done():
+                    future.set_exception(RuntimeError("Dispatcher is shutting down."))
+            raise
+        if call.cancelled():
+            # Every caller of the batch is gone
+            return
+
+        error = call.exception()
+        if error is not None:
+            logger.error(f"Micro-batch of {len(batch)} for {key} failed: {error}")
+        results = [error] * len(batch) if error is not None else call.result()
+        for future, result in zip(futures, results):
+            if future.done():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def close(self):
+        """
+        Stop the workers and fail every request that is still queued or in flight.
+        """
+        for worker in self._workers.values():
+            worker.cancel()
+        for task in self._inflight_batches:
+            task.cancel()
+        await asyncio.gather(*self._workers.values(), *self._inflight_batches, return_exceptions=True)
+        for queue in self._queues.values():
+            while not queue.empty():
+                _, future, _ = queue.get_nowait()
+                if not future.done():
+                    future.set_exception(RuntimeError("Dispatcher is shutting down."))
+        self._queues.clear()
+        self._workers.clear()
@@ -0,0 +1,664 @@
+#!/usr/bin/env python3
+"""
+Microbenchmarks for hot paths of the detoxification service.
+They run in-process and need neither vLLM nor Google Cloud.
+
+Usage:
+    python benchmark.py guard [--requests N]
+    python benchmark.py patterns [--texts N]
+    python benchmark.py json [--records N]
+    python benchmark.py admission [--clients N] [--seconds S]
+    python benchmark.py scheduling [--backfill N]
+    python benchmark.py parser [--repeat N]
+    python benchmark.py tracing [--requests N]
+    python benchmark.py engine-metrics [--repeat N]
+    python benchmark.py lexicon [--terms N] [--texts N]
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+from starlette.middleware.base import BaseHTTPMiddleware
+
+BENCH_BODY = {"text": "This is a stupid example of toxic content", "language_id": "en"}
+
+
+class _NullLogger:
+    def warning(self, *args, **kwargs):
+        pass
+
+    def info(self, *args, **kwargs):
+        pass
+
+
+async def _requests_per_second(app, path: str, body: dict, n_requests: int, concurrency: int = 32) -> float:
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for _ in range(50):
+            await client.post(path, json=body)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one():
+            async with semaphore:
+                response = await client.post(path, json=body)
+                assert response.status_code == 200, response.text
+
+        start_time = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(n_requests)))
+        return n_requests / (time.perf_counter() - start_time)
+
+
+def _legacy_guard_app() -> FastAPI:
+    """
+    The guard as it was before: a BaseHTTPMiddleware that parses the body,
+    followed by FastAPI parsing it again into a Pydantic model.
+    """
+    class LegacySanitizationMiddleware(BaseHTTPMiddleware):
+        async def dispatch(self, request: Request, call_next):
+            if request.method == "POST" and request.url.path == "/detoxify":
+                try:
+                    body = await request.json()
+                except json.JSONDecodeError:
+                    return JSONResponse(status_code=400, content={"detail": "Invalid JSON format in request body."})
+                if not isinstance(body.get("text"), str) or not isinstance(body.get("language_id"), str):
+                    return JSONResponse(status_code=400, content={"detail": "Invalid request format."})
+                if any(k in body.get("text", "").lower() for k in ["prompt", "secret", "token", "password"]):
+                    return JSONResponse(status_code=400, content={"detail": "Query contains forbidden content."})
+                if len(body.get("text", "")) > 500:
+                    return JSONResponse(status_code=400, content={"detail": "Query is too long."})
+            return await call_next(request)
+
+    class Item(BaseModel):
+        text: str
+        language_id: str
+
+    app = FastAPI()
+    app.add_middleware(LegacySanitizationMiddleware)
+
+    @app.post("/detoxify")
+    async def detoxify(request: Item):
+        return {"status": "success", "data": {"input_text": request.text}}
+
+    return app
+
+
+def _asgi_guard_app() -> FastAPI:
+    from guard import TextSanitizationMiddleware, PARSED_BODY_STATE_KEY
+
+    app = FastAPI()
+    app.add_middleware(TextSanitizationMiddleware, logger=_NullLogger(), guarded_paths={"/detoxify"})
+
+    @app.post("/detoxify")
+    async def detoxify(http_request: Request):
+        body = getattr(http_request.state, PARSED_BODY_STATE_KEY)
+        return {"status": "success", "data": {"input_text": body["text"]}}
+
+    return app
+
+
+def bench_guard(args):
+    before = asyncio.run(_requests_per_second(_legacy_guard_app(), "/detoxify", BENCH_BODY, args.requests))
+    after = asyncio.run(_requests_per_second(_asgi_guard_app(), "/detoxify", BENCH_BODY, args.requests))
+    print(f"BaseHTTPMiddleware guard + Pydantic body: {before:10.1f} req/s")
+    print(f"Pure ASGI guard, body parsed once:       {after:10.1f} req/s")
+    print(f"Speed-up: {after / before:.2f}x")
+
+
+def bench_patterns(args):
+    import random
+    from forbidden_patterns import AhoCorasickMatcher, KeywordScanMatcher, compile_matcher
+
+    random.seed(0)
+    alphabet = "abcdefghijklmnopqrstuvwxyzабвгдежзийклмнопрстуфхцчшщыэюя"
+    texts = [
+        " ".join("".join(random.choices(alphabet, k=random.randint(2, 9))) for _ in range(60))[:500]
+        for _ in range(args.texts)
+    ]
+    print(f"{'patterns':>9} {'per-keyword scan':>18} {'automaton':>12}  compile_matcher")
+    for n_patterns in (4, 64, 128, 256, 1024):
+        patterns = ["".join(random.choices(alphabet, k=random.randint(6, 14))) for _ in range(n_patterns)]
+        timings = []
+        for matcher in (KeywordScanMatcher(patterns), AhoCorasickMatcher(patterns)):
+            start_time = time.perf_counter()
+            for text in texts:
+                matcher.search(text)
+            timings.append((time.perf_counter() - start_time) / len(texts) * 1e6)
+        chosen = type(compile_matcher(patterns)).__name__
+        print(f"{n_patterns:>9} {timings[0]:>15.1f} us {timings[1]:>9.1f} us  {chosen}")
+
+
+def bench_json(args):
+    import logging
+    from logging_handle import JsonFormatter
+    from serialization import BACKEND, dumps, merge_objects
+
+    texts = [
+        "Это просто глупый пример токсичного текста, который нужно переписать вежливо.",
+        "这是一个需要改写的愚蠢的有毒文本示例，请保持原意。",
+        "هذا مثال غبي على نص سام يجب إعادة كتابته بأدب.",
+        "This is a stupid example of toxic content that should be rewritten politely.",
+    ]
+    results = [
+        {
+            "input_text": text,
+            "language_id": "en",
+            "model_used": "en",
+            "actual_model_id": "en",
+            "detoxified_text": text,
+            "toxicity_terms_detected": ["stupid", "глупый"],
+            "latency_ms": 123.456,
+            "prompt_tokens": 180,
+            "completion_tokens": 40,
+            "total_tokens": 220,
+            "cache_hit": False,
+            "coalesced": False,
+            "prefilter_bypass": False,
+            "degraded": False,
+            "degraded_reason": None,
+        }
+        for text in texts
+    ]
+    results = [results[i % len(results)] for i in range(args.records)]
+    record = logging.LogRecord("inference", logging.INFO, __file__, 1, "Detoxification Inference Completed", None, None)
+
+    def legacy(result):
+        # Response rendered by JSONResponse, log record by json.dumps of the full entry
+        body = json.dumps({"status": "success", "data": result}, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        legacy_record.json_payload = {"request_id": "0123456789abcdef", **result, "log_reason": "sampled"}
+        return body, json.dumps(formatter.build_entry(legacy_record))
+
+    formatter = JsonFormatter()
+    legacy_record = logging.LogRecord("inference", logging.INFO, __file__, 1, "Detoxification Inference Completed", None, None)
+
+    def serialize_once(result):
+        result_json = dumps(result)
+        body = b'{"status":"success","data":' + result_json + b'}'
+        record.json_payload_raw = merge_objects(dumps({"request_id": "0123456789abcdef", "log_reason": "sampled"}), result_json)
+        return body, formatter.format(record)
+
+    for name, fn in (("stdlib json, serialized twice", legacy), (f"{BACKEND}, serialized once", serialize_once)):
+        start_time = time.perf_counter()
+        for result in results:
+            fn(result)
+        per_record_us = (time.perf_counter() - start_time) / len(results) * 1e6
+        print(f"{name:<32} {per_record_us:8.2f} us/request")
+
+
+async def _simulate_overload(clients: int, seconds: float, admission=None, knee: int = 64, slo_s: float = 2.0) -> dict:
+    """
+    Closed-loop clients against a simulated vLLM whose per-request latency
+    grows once more than `knee` sequences run at once (KV-cache thrashing).
+    """
+    from admission import AdmissionRejected
+
+    inflight = 0
+    stats = {"ok": 0, "slo_ok": 0, "rejected": 0}
+
+    async def backend():
+        nonlocal inflight
+        inflight += 1
+        try:
+            await asyncio.sleep(0.2 * (1 + (max(0, inflight - knee) / knee) ** 2))
+        finally:
+            inflight -= 1
+
+    async def client(stop_at: float):
+        while time.monotonic() < stop_at:
+            start_time = time.monotonic()
+            try:
+                if admission is not None:
+                    async with admission.slot():
+                        await backend()
+                else:
+                    await backend()
+            except AdmissionRejected:
+                stats["rejected"] += 1
+                await asyncio.sleep(0.05)
+                continue
+            stats["ok"] += 1
+            stats["slo_ok"] += time.monotonic() - start_time <= slo_s
+
+    stop_at = time.monotonic() + seconds
+    await asyncio.gather(*(client(stop_at) for _ in range(clients)))
+    return {key: value / seconds for key, value in stats.items()}
+
+
+def bench_admission(args):
+    from admission import AdaptiveAdmissionController
+
+    print(f"{'clients':>8} {'mode':>10} {'done/s':>8} {'in SLO/s':>9} {'429/s':>8}")
+    for clients in args.clients:
+        for mode in ("none", "gradient", "aimd"):
+            admission = None if mode == "none" else AdaptiveAdmissionController(
+                initial_limit=16, max_queue_size=clients // 4, queue_timeout_s=1.0, algorithm=mode,
+                aimd_latency_threshold_s=0.4,
+            )
+            result = asyncio.run(_simulate_overload(clients, args.seconds, admission))
+            print(f"{clients:>8} {mode:>10} {result['ok']:>8.0f} {result['slo_ok']:>9.0f} {result['rejected']:>8.0f}")
+
+
+async def _simulate_backfill(backfill: int, fair: bool) -> dict:
+    """
+    A bulk backfill in one language floods the admission queue while
+    interactive requests in other languages keep arriving.
+    """
+    from admission import AdaptiveAdmissionController
+
+    admission = AdaptiveAdmissionController(
+        initial_limit=32, min_limit=32, max_limit=32, max_queue_size=backfill + 1000, queue_timeout_s=600,
+        interactive_reserved_fraction=0.25 if fair else 0.0,
+    )
+    waits = {"interactive": [], "batch": []}
+
+    async def request(flow):
+        start_time = time.perf_counter()
+        async with admission.slot(flow=flow if fair else ("interactive", "default", "")):
+            waits[flow[0]].append(time.perf_counter() - start_time)
+            await asyncio.sleep(0.05)
+
+    backfill_tasks = [asyncio.create_task(request(("batch", "backfill", "es"))) for _ in range(backfill)]
+    interactive_tasks = []
+    for i in range(200):
+        await asyncio.sleep(0.01)
+        language = ("en", "de", "ru", "zh")[i % 4]
+        interactive_tasks.append(asyncio.create_task(request(("interactive", "app", language))))
+    await asyncio.gather(*interactive_tasks)
+    for task in backfill_tasks:
+        task.cancel()
+    await asyncio.gather(*backfill_tasks, return_exceptions=True)
+    return waits
+
+
+def bench_scheduling(args):
+    def percentile(values, p):
+        ordered = sorted(values)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] * 1000
+
+    print(f"{'queue':>6} {'interactive wait p50':>21} {'p99':>9} {'backfill done':>14}")
+    for fair in (False, True):
+        waits = asyncio.run(_simulate_backfill(args.backfill, fair))
+        interactive = waits["interactive"]
+        print(
+            f"{'WFQ' if fair else 'FIFO':>6} {percentile(interactive, 50):>18.0f} ms {percentile(interactive, 99):>6.0f} ms"
+            f" {len(waits['batch']):>14}"
+        )
+
+
+def _legacy_parse_detoxified_output(output_text, lang):
+    """
+    The output parser as it was before (two str.find scans, slicing and
+    quote stripping), without its print on failure.
+    """
+    from utils import neutral_text_key_dict, toxic_words_key_dict
+
+    def parse_toxic_words(toxic_words_text):
+        toxic_words_text = toxic_words_text.strip()
+        if toxic_words_text.startswith("[") and toxic_words_text.endswith("]"):
+            toxic_words_text = toxic_words_text[1:-1]
+            if toxic_words_text:
+                return [word.strip().strip('"\'') for word in toxic_words_text.split(",")]
+            return []
+        if toxic_words_text:
+            return [toxic_words_text.strip().strip('"\'')]
+        return []
+
+    try:
+        toxic_words_key = toxic_words_key_dict[lang]
+        neutral_text_key = neutral_text_key_dict[lang]
+        toxic_words_match = output_text.find(toxic_words_key)
+        neutral_text_match = output_text.find(neutral_text_key)
+        if toxic_words_match == -1 or neutral_text_match == -1:
+            raise ValueError("Output format is incorrect.")
+        toxic_words_text = output_text[toxic_words_match + len(toxic_words_key) + 1:neutral_text_match].strip()
+        neutral_text = output_text[neutral_text_match + len(neutral_text_key) + 1:].strip()
+        return {
+            "toxic_words": parse_toxic_words(toxic_words_text),
+            "neutral_text": neutral_text if "\n" not in neutral_text else neutral_text.split("\n")[0],
+        }
+    except Exception:
+        return {"toxic_words": [], "neutral_text": "error"}
+
+
+# Toxic words and neutral text of each prompt's few-shot answer, written out by hand
+_PARSER_SEEDS = {
+    'en': (['fuckin', 'dummy'], 'can you please get your steps, right?'),
+    'es': (['maldito', 'tonto'], 'vamos, querido amigo, pon tu paso correcto.'),
+    'fr': (['con'], 'allez, espèce de débile, mets ton pas droit.'),
+    'de': (['verdammter Dummkopf'], 'komm schon, du Dummkopf, mach deinen Schritt richtig.'),
+    'it': (['stupido bastardo'], 'Dai, amico, fai il tuo passo giusto.'),
+    'tt': (['чиркәү'], 'Әйдә, синең белән, дус, дөрес адымны яса.'),
+    'zh': (['混蛋'], '过来，走好你的每一步。'),
+    'ja': (['クソ野郎'], '来いよ、正しい一歩を踏み出せ。'),
+    'ru': (['иди сюда', 'чертов ублюдок'], 'Подойди, сделай правильный шаг.'),
+    'uk': (['бл*дь'], 'Іди сюди, зроби правильний крок.'),
+    'hi': (['बेवकूफ'], 'आओ यार समझदारी से अपने सही कदम पर कदम रखो।'),
+    'am': (['እቅፍ'], 'እቅፍ ይላል የተወደድኩት ነገር አይደለም።'),
+    'he': (['בן זונה'], 'בוא לפה תעשה צעד נכון.'),
+    'hin': (['bechara chutiya'], 'Aye, dost, apna kadam sahi rakho.'),
+    'ar': (['غبي', 'اللعين'], 'تعال يا غبي اجعل خطوتك صحيحة.'),
+}
+
+
+def _parser_corpus():
+    """
+    (lang, output, expected toxic words, expected neutral text) in every
+    language, built from the literal seeds above with the list and quoting
+    styles the model produces. Truncated outputs expect a failure.
+    """
+    from utils import output_format
+
+    corpus = []
+    for lang, (words, neutral) in _PARSER_SEEDS.items():
+        lists = [
+            json.dumps(words, ensure_ascii=False),
+            str(words),
+            "[" + ", ".join(words) + "]",
+            "[]",
+        ]
+        for toxic_words in lists:
+            expected_words = [] if toxic_words == "[]" else words
+            for neutral_sentence in (neutral, f'"{neutral}"'):
+                output = output_format[lang].format(toxic_words=toxic_words, neutral_sentence=neutral_sentence)
+                corpus.append((lang, output, expected_words, neutral))
+        # A term containing a comma, and a second paragraph after the answer
+        with_comma = words + [f"{words[0]}, {words[-1]}"]
+        output = output_format[lang].format(toxic_words=json.dumps(with_comma, ensure_ascii=False), neutral_sentence=neutral)
+        corpus.append((lang, output + "\n\n" + neutral, with_comma, neutral))
+        # Cut off inside the toxic words list
+        corpus.append((lang, output[: len(output) // 4], None, None))
+    return corpus
+
+
+def bench_parser(args):
+    from output_parser import USABLE_STATUSES, IncrementalOutputParser, parse_detoxified_output
+
+    corpus = _parser_corpus()
+
+    def correct(parsed, expected_words, expected_neutral):
+        if expected_words is None:
+            return parsed["neutral_text"] == "error"
+        return parsed["toxic_words"] == expected_words and parsed["neutral_text"] == expected_neutral
+
+    def streamed(output, lang):
+        parser = IncrementalOutputParser(lang)
+        for position in range(0, len(output), 4):
+            parser.feed(output[position:position + 4])
+        return parser.result()
+
+    parsers = (
+        ("legacy str.find", _legacy_parse_detoxified_output),
+        ("compiled", parse_detoxified_output),
+        ("compiled, fed in 4-char chunks", lambda output, lang: streamed(output, lang)),
+    )
+    print(f"{len(corpus)} outputs in {len({lang for lang, *_ in corpus})} languages, best of {args.repeat} passes")
+    print(f"{'parser':<32} {'per output':>12} {'correct':>9}")
+    per_language = {}
+    for name, parse in parsers:
+        # Best pass over the corpus, which is less noisy than the mean
+        best_s = float("inf")
+        for _ in range(args.repeat):
+            start_time = time.perf_counter()
+            for lang, output, _, _ in corpus:
+                parse(output, lang)
+            best_s = min(best_s, time.perf_counter() - start_time)
+        per_output_us = best_s / len(corpus) * 1e6
+        n_correct = 0
+        for lang, output, expected_words, expected_neutral in corpus:
+            ok = correct(parse(output, lang), expected_words, expected_neutral)
+            n_correct += ok
+            per_language.setdefault(lang, {}).setdefault(name, [0, 0])
+            per_language[lang][name][0] += ok
+            per_language[lang][name][1] += 1
+        print(f"{name:<32} {per_output_us:>9.2f} us {n_correct:>5}/{len(corpus)}")
+
+    print(f"\n{'lang':<5} " + " ".join(f"{name.split(',')[0]:>16}" for name, _ in parsers[:2]))
+    for lang, counts in per_language.items():
+        print(f"{lang:<5} " + " ".join(f"{counts[name][0]:>13}/{counts[name][1]:<2}" for name, _ in parsers[:2]))
+
+    statuses = {}
+    for lang, output, _, _ in corpus:
+        status = parse_detoxified_output(output, lang)["status"]
+        statuses[status] = statuses.get(status, 0) + 1
+    usable = sum(count for status, count in statuses.items() if status in USABLE_STATUSES)
+    print(f"\nstatus codes: {statuses} ({usable} usable)")
+
+
+def bench_tracing(args):
+    from instrumentation import LOG_ENQUEUE, PARSE, PROMPT_BUILD, UPSTREAM, observe_stage
+    from tracing import TracingMiddleware
+
+    stages = (PROMPT_BUILD, UPSTREAM, PARSE, LOG_ENQUEUE)
+    body = {"type": "http.response.body", "body": b"{}"}
+
+    async def endpoint(scope, receive, send):
+        # The stage hooks of one /detoxify request, without the work they time
+        for stage in stages:
+            observe_stage(stage, "en", "seen-language", 0.001)
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send(body)
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    def scope(traceparent=None):
+        headers = [(b"content-type", b"application/json")]
+        if traceparent is not None:
+            headers.append((b"traceparent", traceparent.encode()))
+        return {"type": "http", "method": "POST", "path": "/detoxify", "headers": headers}
+
+    async def per_request_us(app, request_scope) -> float:
+        # Best of 5 runs, which is less noisy than the mean
+        best_s = float("inf")
+        for _ in range(5):
+            start_time = time.perf_counter()
+            for _ in range(args.requests):
+                await app(request_scope, receive, send)
+            best_s = min(best_s, time.perf_counter() - start_time)
+        return best_s / args.requests * 1e6
+
+    traceparent = "00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01"
+    variants = (
+        ("no tracing middleware", endpoint, scope()),
+        ("sampling off, new trace", TracingMiddleware(endpoint, {"/detoxify"}, 0.0), scope()),
+        ("sampling off, traceparent in", TracingMiddleware(endpoint, {"/detoxify"}, 0.0), scope(traceparent[:-1] + "0")),
+        ("sampled, Server-Timing", TracingMiddleware(endpoint, {"/detoxify"}, 1.0), scope()),
+        ("sampled, trace record logged", TracingMiddleware(endpoint, {"/detoxify"}, 1.0, _NullLogger()), scope(traceparent)),
+    )
+    print(f"{len(stages)} stages per request, best of 5 x {args.requests} requests")
+    print(f"{'variant':<30} {'per request':>12} {'overhead':>10}")
+    baseline_us = None
+    for name, app, request_scope in variants:
+        us = asyncio.run(per_request_us(app, request_scope))
+        baseline_us = us if baseline_us is None else baseline_us
+        print(f"{name:<30} {us:>9.2f} us {us - baseline_us:>7.2f} us")
+
+
+def bench_engine_metrics(args):
+    import os
+    from prometheus_client.parser import text_string_to_metric_families
+    from engine_metrics import parse_vllm_metrics
+
+    # A scrape of a vLLM (V1 engine) server with one LoRA-enabled model
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "vllm_metrics_sample.txt")) as f:
+        exposition = f.read()
+
+    def best_us(parse) -> float:
+        # Best pass, which is less noisy than the mean
+        best_s = float("inf")
+        for _ in range(args.repeat):
+            start_time = time.perf_counter()
+            parse(exposition)
+            best_s = min(best_s, time.perf_counter() - start_time)
+        return best_s * 1e6
+
+    full_us = best_us(lambda text: list(text_string_to_metric_families(text)))
+    targeted_us = best_us(parse_vllm_metrics)
+    print(f"\n{len(exposition.splitlines())} lines, {len(exposition)} bytes, best of {args.repeat} parses")
+    print(f"prometheus_client text parser: {full_us:10.1f} us")
+    print(f"targeted series scan:          {targeted_us:10.1f} us")
+
+
+_LEXICON_STARTUP = """
+import json, re, sys, time
+start_time = time.perf_counter()
+from delete_baseline import DetoxificationBaseline
+if sys.argv[1] == "hf":
+    # The dataset loader, pointed at a local copy of the dataset instead of the Hub
+    DetoxificationBaseline._load_toxic_lexicon.__defaults__ = (None, sys.argv[2])
+    baseline = DetoxificationBaseline()
+else:
+    baseline = DetoxificationBaseline(compiled_lexicon_path=sys.argv[2])
+ready_s = time.perf_counter() - start_time
+
+def rss_mib():
+    with open("/proc/self/status") as f:
+        return int(re.search(r"VmRSS:\\s+(\\d+)", f.read()).group(1)) / 1024
+
+ready_rss = rss_mib()
+baseline.find_toxic_terms(sys.argv[3], "en")
+print(json.dumps({"ready_s": ready_s, "ready_rss": ready_rss, "first_lookup_s": time.perf_counter() - start_time, "lookup_rss": rss_mib()}))
+"""
+
+
+def bench_lexicon(args):
+    import os
+    import random
+    import subprocess
+    import sys
+    import tempfile
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    from delete_baseline import DetoxificationBaseline
+    from lexicon import compile_lexicon
+    from utils import langs
+
+    random.seed(0)
+    alphabet = "abcdefghijklmnopqrstuvwxyzабвгдежзийклмнопрстуфхцчшщыэюяäöüéèñ"
+    per_language = args.terms // len(langs)
+    lexicon = {
+        lang: ["".join(random.choices(alphabet, k=random.randint(3, 14))) for _ in range(per_language)]
+        for lang in langs
+    }
+    text = " ".join(random.choice(lexicon["en"]) if i % 10 == 0 else "harmless" for i in range(60))
+
+    with tempfile.TemporaryDirectory() as directory:
+        # A local copy laid out like the dataset on the Hub, one split per language
+        os.makedirs(os.path.join(directory, "dataset", "data"))
+        splits = []
+        for lang, terms in lexicon.items():
+            pq.write_table(pa.table({"text": terms}), os.path.join(directory, "dataset", "data", f"{lang}-00000-of-00001.parquet"))
+            splits.append(f"  - split: {lang}\n    path: data/{lang}-*")
+        with open(os.path.join(directory, "dataset", "README.md"), "w") as f:
+            f.write("---\nconfigs:\n- config_name: default\n  data_files:\n" + "\n".join(splits) + "\n---\n")
+        compiled_path = os.path.join(directory, "toxic_lexicon.bin")
+        compile_start = time.perf_counter()
+        compile_lexicon(lexicon, compiled_path)
+        compile_s = time.perf_counter() - compile_start
+
+        env = {**os.environ, "HF_HOME": os.path.join(directory, "hf"), "HF_DATASETS_OFFLINE": "1", "HF_HUB_OFFLINE": "1"}
+
+        def startup(source: str, path: str) -> dict:
+            output = subprocess.run(
+                [sys.executable, "-c", _LEXICON_STARTUP, source, path, text],
+                env=env, capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+            ).stdout
+            return json.loads(output.strip().splitlines()[-1])
+
+        # The first load converts the dataset into the datasets cache, like a cold start would download it
+        cold = startup("hf", os.path.join(directory, "dataset"))
+        warm = startup("hf", os.path.join(directory, "dataset"))
+        compiled = startup("compiled", compiled_path)
+
+        n_terms = sum(len(set(terms)) for terms in lexicon.values())
+        print(f"{n_terms} synthetic terms in {len(lexicon)} languages; compiled in {compile_s:.2f}s "
+              f"to {os.path.getsize(compiled_path) / 1024:.0f} KiB")
+        print(f"{'lexicon source':<32} {'ready':>8} {'RSS':>9} {'1st lookup':>11} {'RSS':>9}")
+        for name, result in (("HF dataset, cold cache", cold), ("HF dataset, warm cache", warm), ("compiled, mapped lazily", compiled)):
+            print(f"{name:<32} {result['ready_s']:>7.2f}s {result['ready_rss']:>5.0f} MiB "
+                  f"{result['first_lookup_s']:>10.2f}s {result['lookup_rss']:>5.0f} MiB")
+
+        json_path = os.path.join(directory, "toxic_lexicon.json")
+        with open(json_path, "w") as f:
+            json.dump(sorted(set().union(*lexicon.values())), f)
+        merged = DetoxificationBaseline(toxic_lexicon_path=json_path)
+        uncached = DetoxificationBaseline(compiled_lexicon_path=compiled_path)
+        uncached.stopwords.cache_size = 0
+        in_memory = DetoxificationBaseline(compiled_lexicon_path=compiled_path)
+        assert merged.find_toxic_terms(text) == in_memory.find_toxic_terms(text)
+        assert all(term in in_memory.stopwords for term in merged.stopwords)
+
+        # Request texts of 60 tokens from a skewed (Zipf) vocabulary, one token in ten a lexicon term
+        vocabulary = ["".join(random.choices(alphabet[:26], k=random.randint(2, 9))) for _ in range(20000)]
+        tokens = iter(random.choices(vocabulary, [1 / rank for rank in range(1, len(vocabulary) + 1)], k=60 * args.texts))
+        texts = [
+            " ".join(random.choice(lexicon["en"]) if i % 10 == 0 else next(tokens) for i in range(60))
+            for _ in range(args.texts)
+        ]
+        print(f"\nfind_toxic_terms over {args.texts} texts of 60 tokens, lookup cache starting empty")
+        for name, baseline in (
+            ("merged set", merged),
+            ("compiled, no cache", uncached),
+            (f"compiled, {in_memory.stopwords.cache_size}-term cache", in_memory),
+        ):
+            start_time = time.perf_counter()
+            for request_text in texts:
+                baseline.find_toxic_terms(request_text)
+            print(f"{name:<32} {(time.perf_counter() - start_time) / len(texts) * 1e6:>7.1f} us per text")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    guard_parser = subparsers.add_parser("guard", help="Request guard middleware throughput")
+    guard_parser.add_argument("--requests", type=int, default=5000)
+    guard_parser.set_defaults(func=bench_guard)
+
+    patterns_parser = subparsers.add_parser("patterns", help="Forbidden-pattern matching cost per request")
+    patterns_parser.add_argument("--texts", type=int, default=2000)
+    patterns_parser.set_defaults(func=bench_patterns)
+
+    json_parser = subparsers.add_parser("json", help="Response and log record serialization cost")
+    json_parser.add_argument("--records", type=int, default=50000)
+    json_parser.set_defaults(func=bench_json)
+
+    admission_parser = subparsers.add_parser("admission", help="Goodput under overload with and without admission control")
+    admission_parser.add_argument("--clients", type=int, nargs="+", default=[32, 128, 512])
+    admission_parser.add_argument("--seconds", type=float, default=10.0)
+    admission_parser.set_defaults(func=bench_admission)
+
+    scheduling_parser = subparsers.add_parser("scheduling", help="Interactive queue wait behind a bulk backfill")
+    scheduling_parser.add_argument("--backfill", type=int, default=2000)
+    scheduling_parser.set_defaults(func=bench_scheduling)
+
+    parser_parser = subparsers.add_parser("parser", help="Model output parsing cost and correctness in every language")
+    parser_parser.add_argument("--repeat", type=int, default=200)
+    parser_parser.set_defaults(func=bench_parser)
+
+    tracing_parser = subparsers.add_parser("tracing", help="Per-request cost of tracing with sampling off and on")
+    tracing_parser.add_argument("--requests", type=int, default=20000)
+    tracing_parser.set_defaults(func=bench_tracing)
+
+    engine_parser = subparsers.add_parser("engine-metrics", help="vLLM /metrics parsing against a captured scrape")
+    engine_parser.add_argument("--repeat", type=int, default=200)
+    engine_parser.set_defaults(func=bench_engine_metrics)
+
+    lexicon_parser = subparsers.add_parser("lexicon", help="Startup time, RSS and lookup cost with the HF dataset and the compiled lexicon")
+    lexicon_parser.add_argument("--terms", type=int, default=150000)
+    lexicon_parser.add_argument("--texts", type=int, default=5000)
+    lexicon_parser.set_defaults(func=bench_lexicon)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,366 @@
+import asyncio
+import hashlib
+import logging
+import re
+import sqlite3
+import struct
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Optional
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+_spaces_re = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normalize input text for cache lookups: NFC form, trimmed, with runs of
+    whitespace collapsed to a single space. Case is kept because the model
+    output preserves it.
+    """
+    return _spaces_re.sub(" ", unicodedata.normalize("NFC", text)).strip()
+
+
+def make_cache_key(text: str, language_id: str, adapter: str, prompt_version: str) -> str:
+    """
+    Build the cache key for one detoxification request.
+    """
+    raw = "\x1f".join((normalize_text(text), language_id, adapter, prompt_version))
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class DetoxResultCache:
+    """
+    In-process exact-match cache of detoxification results with LRU eviction
+    and a per-entry TTL.
+
+    Attributes:
+        max_entries (int): Maximum number of cached results
+        ttl_s (float): Seconds a result stays valid after it was stored
+    """
+
+    def __init__(self, max_entries: int = 10000, ttl_s: float = 3600.0):
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self._entries: "OrderedDict[str, tuple[float, dict]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[dict]:
+        """
+        Return the cached result for `key`, or None on a miss or expired entry.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            metrics.cache_requests_total.labels(result="miss").inc()
+            return None
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            metrics.cache_evictions_total.labels(reason="ttl").inc()
+            metrics.cache_entries.set(len(self._entries))
+            metrics.cache_requests_total.labels(result="miss").inc()
+            return None
+        self._entries.move_to_end(key)
+        metrics.cache_requests_total.labels(result="hit").inc()
+        return value
+
+    def set(self, key: str, value: dict):
+        """
+        Store a result, evicting the least recently used entries when full.
+        """
+        self._entries[key] = (time.monotonic() + self.ttl_s, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            metrics.cache_evictions_total.labels(reason="lru").inc()
+        metrics.cache_entries.set(len(self._entries))
+
+    def clear(self):
+        self._entries.clear()
+        metrics.cache_entries.set(0)
+
+
+# --- Second-tier (shared) cache ---
+
+# Version 1 used 16-bit counts and lengths; its entries now decode as corrupt (a miss)
+_VALUE_FORMAT_VERSION = 2
+_header = struct.Struct("!BI")
+_str_len = struct.Struct("!I")
+
+
+def encode_value(value: dict) -> bytes:
+    """
+    Encode a cached result as compact binary: a version byte, the number of
+    toxic terms, then length-prefixed UTF-8 strings for the model id, the
+    neutral text and each toxic term. Counts and lengths are 32-bit.
+
+    Raises:
+        struct.error: If a count or length does not fit in 32 bits
+    """
+    toxic_words = value["toxicity_terms_detected"]
+    strings = [value.get("actual_model_id") or "", value["detoxified_text"], *toxic_words]
+    parts = [_header.pack(_VALUE_FORMAT_VERSION, len(toxic_words))]
+    for string in strings:
+        data = string.encode("utf-8")
+        parts.append(_str_len.pack(len(data)))
+        parts.append(data)
+    return b"".join(parts)
+
+
+def decode_value(data: bytes) -> dict:
+    """
+    Decode a value produced by `encode_value`.
+
+    Raises:
+        ValueError: If the payload uses an unknown format version or is corrupt
+    """
+    try:
+        version, toxic_word_count = _header.unpack_from(data, 0)
+        if version != _VALUE_FORMAT_VERSION:
+            raise ValueError(f"Unsupported cache value version: {version}")
+        offset = _header.size
+        strings = []
+        for _ in range(toxic_word_count + 2):
+            (length,) = _str_len.unpack_from(data, offset)
+            offset += _str_len.size
+            if offset + length > len(data):
+                raise ValueError("Truncated cache value")
+            strings.append(data[offset:offset + length].decode("utf-8"))
+            offset += length
+    except (struct.error, TypeError) as e:
+        raise ValueError(f"Corrupt cache value: {e}") from e
+    return {
+        "actual_model_id": strings[0] or None,
+        "detoxified_text": strings[1],
+        "toxicity_terms_detected": strings[2:],
+    }
+
+
+class SQLiteCacheBackend:
+    """
+    On-disk cache backend shared by all workers on a host. Uses a single
+    SQLite file in WAL mode so readers in several processes do not block the
+    writer.
+
+    Attributes:
+        path (str): Path of the SQLite database file
+        max_rows (int): Rows kept after each purge (oldest expiry dropped first)
+    """
+
+    def __init__(self, path: str, max_rows: int = 1_000_000):
+        self.path = path
+        self.max_rows = max_rows
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=5.0, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS detox_cache ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL NOT NULL"
+            ") WITHOUT ROWID"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS detox_cache_expires ON detox_cache (expires_at)")
+
+    def _get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM detox_cache WHERE key = ? AND expires_at > ?", (key, time.time())
+            ).fetchone()
+        return row[0] if row else None
+
+    def _set_many(self, items: list, ttl_s: float):
+        expires_at = time.time() + ttl_s
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO detox_cache (key, value, expires_at) VALUES (?, ?, ?)",
+                [(key, value, expires_at) for key, value in items],
+            )
+            self._conn.execute("COMMIT")
+
+    def _delete(self, key: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM detox_cache WHERE key = ?", (key,))
+
+    def _purge(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM detox_cache WHERE expires_at <= ?", (time.time(),))
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM detox_cache").fetchone()
+            if count > self.max_rows:
+                self._conn.execute(
+                    "DELETE FROM detox_cache WHERE key IN "
+                    "(SELECT key FROM detox_cache ORDER BY expires_at LIMIT ?)",
+                    (count - self.max_rows,),
+                )
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await asyncio.to_thread(self._get, key)
+
+    async def set_many(self, items: list, ttl_s: float):
+        await asyncio.to_thread(self._set_many, items, ttl_s)
+
+    async def delete(self, key: str):
+        await asyncio.to_thread(self._delete, key)
+
+    async def purge(self):
+        await asyncio.to_thread(self._purge)
+
+    async def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class RedisCacheBackend:
+    """
+    Network key-value cache backend shared by all inference nodes.
+    Requires the `redis` package.
+
+    Attributes:
+        url (str): Redis connection url, e.g. redis://cache:6379/0
+        prefix (str): Prefix added to every key
+    """
+
+    def __init__(self, url: str, prefix: str = "detox:"):
+        try:
+            import redis.asyncio as redis_asyncio
+        except ImportError as e:
+            raise RuntimeError("RESULT_CACHE_BACKEND=redis requires the 'redis' package.") from e
+        self.url = url
+        self.prefix = prefix
+        self._client = redis_asyncio.from_url(url)
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self._client.get(self.prefix + key)
+
+    async def set_many(self, items: list, ttl_s: float):
+        async with self._client.pipeline(transaction=False) as pipe:
+            for key, value in items:
+                pipe.set(self.prefix + key, value, px=int(ttl_s * 1000))
+            await pipe.execute()
+
+    async def delete(self, key: str):
+        await self._client.delete(self.prefix + key)
+
+    async def purge(self):
+        # Redis expires keys on its own
+        return None
+
+    async def close(self):
+        await self._client.aclose()
+
+
+class TieredDetoxCache:
+    """
+    Two-tier result cache: the in-process DetoxResultCache in front of an
+    optional shared backend. Reads go through to the backend on a local miss
+    and fill the local tier; writes land locally at once and are shipped to
+    the backend in batches by a background writer.
+
+    Attributes:
+        local (DetoxResultCache): First, in-process tier
+        backend: Optional shared tier (SQLiteCacheBackend or RedisCacheBackend)
+    """
+
+    def __init__(
+        self,
+        local: DetoxResultCache,
+        backend=None,
+        write_queue_size: int = 10000,
+        write_batch_size: int = 256,
+        purge_interval_s: float = 300.0,
+    ):
+        self.local = local
+        self.backend = backend
+        self.write_batch_size = write_batch_size
+        self.purge_interval_s = purge_interval_s
+        self._write_queue: asyncio.Queue = asyncio.Queue(maxsize=write_queue_size)
+        self._writer: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self.backend is not None and self._writer is None:
+            self._writer = asyncio.create_task(self._write_behind())
+
+    async def get(self, key: str) -> Optional[dict]:
+        value = self.local.get(key)
+        if value is not None or self.backend is None:
+            return value
+        try:
+            data = await self.backend.get(key)
+            if data is None:
+                metrics.cache_backend_requests_total.labels(result="miss").inc()
+                return None
+            value = decode_value(data)
+        except ValueError as e:
+            # A corrupt or old-format value is a miss; it is evicted so the next generation replaces it
+            logger.warning(f"Evicting undecodable shared cache entry: {e}")
+            metrics.cache_backend_requests_total.labels(result="miss").inc()
+            await self._evict(key)
+            return None
+        except Exception as e:
+            logger.warning(f"Shared cache read failed: {e}")
+            metrics.cache_backend_requests_total.labels(result="error").inc()
+            return None
+        metrics.cache_backend_requests_total.labels(result="hit").inc()
+        self.local.set(key, value)
+        return value
+
+    async def _evict(self, key: str):
+        try:
+            await self.backend.delete(key)
+        except Exception as e:
+            logger.warning(f"Shared cache delete failed: {e}")
+
+    def set(self, key: str, value: dict):
+        self.local.set(key, value)
+        if self.backend is None:
+            return
+        try:
+            self._write_queue.put_nowait((key, encode_value(value)))
+        except (asyncio.QueueFull, struct.error):
+            # A skipped shared write only costs a later miss; it must not fail the request
+            metrics.cache_backend_writes_dropped_total.inc()
+
+    async def _write_behind(self):
+        last_purge = time.monotonic()
+        while True:
+            items = [await self._write_queue.get()]
+            while len(items) < self.write_batch_size and not self._write_queue.empty():
+                items.append(self._write_queue.get_nowait())
+            await self._flush(items)
+            if time.monotonic() - last_purge > self.purge_interval_s:
+                last_purge = time.monotonic()
+                try:
+                    await self.backend.purge()
+                except Exception as e:
+                    logger.warning(f"Shared cache purge failed: {e}")
+
+    async def _flush(self, items: list):
+        try:
+            await self.backend.set_many(items, self.local.ttl_s)
+        except Exception as e:
+            logger.warning(f"Shared cache write of {len(items)} entries failed: {e}")
+            metrics.cache_backend_writes_dropped_total.inc(len(items))
+
+    async def close(self):
+        """
+        Stop the writer, flush pending writes and close the backend.
+        """
+        if self._writer is not None:
+            self._writer.cancel()
+            await asyncio.gather(self._writer, return_exceptions=True)
+            self._writer = None
+        if self.backend is None:
+            return
+        pending = []
+        while not self._write_queue.empty():
+            pending.append(self._write_queue.get_nowait())
+        if pending:
+            await self._flush(pending)
+        await self.backend.close()
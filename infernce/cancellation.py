@@ -0,0 +1,86 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+from starlette.responses import StreamingResponse
+
+import metrics
+
+# Why a request's work was abandoned
+CLIENT_DISCONNECT = "client_disconnect"
+DEADLINE = "deadline"
+
+
+class RequestCancelled(Exception):
+    """
+    Raised when a request's work was cancelled before it finished, because
+    the client went away or its deadline passed.
+
+    Attributes:
+        reason (str): "client_disconnect" or "deadline"
+    """
+
+    def __init__(self, reason: str):
+        super().__init__(f"Request cancelled: {reason}")
+        self.reason = reason
+
+
+async def wait_for_disconnect(receive):
+    """
+    Return once the ASGI server reports that the client closed the
+    connection. Request body messages still arriving are skipped.
+    """
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def run_cancellable(work: Awaitable[Any], receive, deadline: Optional[float], endpoint: str) -> Any:
+    """
+    Await `work` while watching for a client disconnect and `deadline`
+    (time.monotonic() seconds, None for no deadline). When either fires
+    first the work is cancelled, which aborts its upstream request.
+
+    Raises:
+        RequestCancelled: If the client disconnected or the deadline passed
+    """
+    task = asyncio.ensure_future(work)
+    watcher = asyncio.ensure_future(wait_for_disconnect(receive))
+    timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+    try:
+        done, _ = await asyncio.wait({task, watcher}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+    finally:
+        watcher.cancel()
+
+    if task in done:
+        return task.result()
+    task.cancel()
+    reason = CLIENT_DISCONNECT if watcher in done else DEADLINE
+    metrics.requests_cancelled_total.labels(endpoint=endpoint, reason=reason).inc()
+    # Let the work unwind (release its slots, close its upstream request) before answering
+    await asyncio.gather(task, return_exceptions=True)
+    raise RequestCancelled(reason)
+
+
+class ReleasingStreamingResponse(StreamingResponse):
+    """
+    StreamingResponse that awaits `release()` once it is over: the body was
+    sent, the client went away before or while it was streamed, or sending
+    failed. A body generator that never started never runs its `finally`, so
+    what the body holds (an admission slot, a replica, an upstream stream)
+    cannot be released only there. `release` must be idempotent.
+    """
+
+    def __init__(self, content, release: Callable[[], Awaitable[None]], **kwargs):
+        super().__init__(content, **kwargs)
+        self.release = release
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.release()
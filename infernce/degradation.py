@@ -0,0 +1,95 @@
+import time
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+import metrics
+
+
+class DegradationController:
+    """
+    Switches the service into a degraded mode, where requests are answered by
+    the lexicon baseline instead of the LLM, when upstream load is too high.
+
+    The mode is entered when the number of in-flight upstream generations or
+    the upstream queue depth reaches its `enter` threshold, and left only once
+    both are back at or below their `exit` thresholds (hysteresis). A request
+    carrying a latency budget lower than the expected LLM latency is degraded
+    on its own, whatever the mode.
+
+    Attributes:
+        enter_inflight (int): In-flight generations that switch degraded mode on
+        exit_inflight (int): In-flight generations below which it switches off
+        enter_queue_depth (int): Upstream queue depth that switches degraded mode on
+        exit_queue_depth (int): Upstream queue depth below which it switches off
+        queue_depth_fn (Callable): Returns the current upstream queue depth
+        latency_alpha (float): Smoothing factor of the LLM latency EWMA
+    """
+
+    def __init__(
+        self,
+        enter_inflight: int = 256,
+        exit_inflight: int = 192,
+        enter_queue_depth: int = 512,
+        exit_queue_depth: int = 256,
+        queue_depth_fn: Optional[Callable[[], int]] = None,
+        latency_alpha: float = 0.1,
+    ):
+        self.enter_inflight = enter_inflight
+        self.exit_inflight = exit_inflight
+        self.enter_queue_depth = enter_queue_depth
+        self.exit_queue_depth = exit_queue_depth
+        self.queue_depth_fn = queue_depth_fn or (lambda: 0)
+        self.latency_alpha = latency_alpha
+        self.inflight = 0
+        self.degraded = False
+        self.expected_latency_ms: Optional[float] = None
+
+    def _update_mode(self):
+        queue_depth = self.queue_depth_fn()
+        if not self.degraded:
+            if self.inflight >= self.enter_inflight or queue_depth >= self.enter_queue_depth:
+                self.degraded = True
+        elif self.inflight <= self.exit_inflight and queue_depth <= self.exit_queue_depth:
+            self.degraded = False
+        metrics.degraded_mode.set(1 if self.degraded else 0)
+
+    def should_degrade(self, latency_budget_ms: Optional[float] = None) -> Optional[str]:
+        """
+        Decide whether the next request should use the baseline.
+
+        Returns:
+            The reason ("overload" or "latency_budget"), or None to use the LLM.
+        """
+        self._update_mode()
+        if self.degraded:
+            reason = "overload"
+        elif (
+            latency_budget_ms is not None
+            and self.expected_latency_ms is not None
+            and latency_budget_ms < self.expected_latency_ms
+        ):
+            reason = "latency_budget"
+        else:
+            return None
+        metrics.degraded_responses_total.labels(reason=reason).inc()
+        return reason
+
+    @contextmanager
+    def track(self):
+        """
+        Count one upstream generation as in flight and feed its latency into
+        the expected-latency estimate when it succeeds.
+        """
+        self.inflight += 1
+        metrics.upstream_inflight.set(self.inflight)
+        start_time = time.perf_counter()
+        try:
+            yield
+            latency_ms = (time.perf_counter() - start_time) * 1000
+            if self.expected_latency_ms is None:
+                self.expected_latency_ms = latency_ms
+            else:
+                self.expected_latency_ms += self.latency_alpha * (latency_ms - self.expected_latency_ms)
+        finally:
+            self.inflight -= 1
+            metrics.upstream_inflight.set(self.inflight)
@@ -1,9 +1,10 @@
 import json
 import re
-from typing import Optional, Set
+from typing import Container, Optional, Set
 
 import jieba
-from datasets import load_dataset
+
+from lexicon import HF_LEXICON_DATASET, CompiledLexicon, load_hf_lexicon
 
 
 class DetoxificationBaseline:
@@ -12,25 +13,31 @@ class DetoxificationBaseline:
     The baseline removes toxic terms identified in a multilingual lexicon.
 
     Attributes:
-        stopwords (Set[str]): A set of toxic terms to remove
+        stopwords (Container[str]): Toxic terms to remove, a set or a CompiledLexicon
         spaces_re (re.Pattern): Compiled regex for whitespace matching
     """
 
-    def __init__(self, toxic_lexicon_path: Optional[str] = None):
+    def __init__(self, toxic_lexicon_path: Optional[str] = None, compiled_lexicon_path: Optional[str] = None):
         """
         Initialize the detoxification baseline.
 
         Args:
             toxic_lexicon_path: Optional path to load custom toxic lexicon.
                               If None, uses default multilingual lexicon.
+            compiled_lexicon_path: Optional lexicon compiled by lexicon.py. It is
+                              memory-mapped on first use and takes precedence.
         """
         self.spaces_re = re.compile(r"\s+")
-        self.stopwords = self._load_toxic_lexicon(toxic_lexicon_path)
+        self.stopwords: Container[str]
+        if compiled_lexicon_path:
+            self.stopwords = CompiledLexicon(compiled_lexicon_path)
+        else:
+            self.stopwords = self._load_toxic_lexicon(toxic_lexicon_path)
 
     def _load_toxic_lexicon(
         self,
         path: Optional[str] = None,
-        hf_dataset_name: str = "textdetox/multilingual_toxic_lexicon",
+        hf_dataset_name: str = HF_LEXICON_DATASET,
     ) -> Set[str]:
         """
         Load toxic lexicon from HuggingFace datasets or local path.
@@ -45,13 +52,10 @@ class DetoxificationBaseline:
             with open(path) as f:
                 return set(json.load(f))
 
-        stopwords_dataset = load_dataset(hf_dataset_name)
-        words = []
-
-        for language in stopwords_dataset.keys():
-            words.extend(stopwords_dataset[language]["text"])
-
-        return set(words)
+        words = set()
+        for terms in load_hf_lexicon(hf_dataset_name).values():
+            words.update(terms)
+        return words
 
     def detoxify(
         self,
@@ -0,0 +1,203 @@
+import asyncio
+import logging
+import math
+import time
+from typing import Dict, List, Optional
+
+import httpx
+
+import metrics
+from routing import Replica
+
+logger = logging.getLogger(__name__)
+
+# Field -> sample names in vLLM's /metrics, newest spelling first
+VLLM_SERIES = {
+    "running": ("vllm:num_requests_running",),
+    "waiting": ("vllm:num_requests_waiting",),
+    "kv_cache_usage": ("vllm:kv_cache_usage_perc", "vllm:gpu_cache_usage_perc"),
+    "prefix_cache_queries": ("vllm:prefix_cache_queries_total", "vllm:gpu_prefix_cache_queries_total"),
+    "prefix_cache_hits": ("vllm:prefix_cache_hits_total", "vllm:gpu_prefix_cache_hits_total"),
+    # Older engines export the hit rate itself instead of the two counters
+    "prefix_cache_hit_rate": ("vllm:gpu_prefix_cache_hit_rate",),
+}
+# Fractions are combined over engines (data parallel ranks) with max, counts are summed
+_FRACTIONS = ("kv_cache_usage", "prefix_cache_hit_rate")
+
+
+def _sample_values(text: str, name: str) -> List[float]:
+    # Values of every sample of `name`, whatever its labels. `text` starts with a newline.
+    values = []
+    needle = "\n" + name
+    line_start = text.find(needle)
+    while line_start != -1:
+        line_end = text.find("\n", line_start + 1)
+        if line_end == -1:
+            line_end = len(text)
+        rest = text[line_start + len(needle):line_end]
+        if rest[:1] == "{":
+            # Label values may hold anything but the sample value follows the last brace
+            rest = rest[rest.rfind("}") + 1:]
+        elif rest[:1] not in (" ", "\t"):
+            # A longer name sharing the prefix, e.g. name_created
+            rest = ""
+        parts = rest.split()
+        if parts:
+            try:
+                value = float(parts[0])
+            except ValueError:
+                value = math.nan
+            if not math.isnan(value):
+                values.append(value)
+        line_start = text.find(needle, line_end)
+    return values
+
+
+def parse_vllm_metrics(text: str) -> Dict[str, float]:
+    """
+    Read the series the service uses from a vLLM Prometheus exposition.
+    Only the lines of these series are looked at, so the many histograms
+    of a scrape cost next to nothing.
+
+    Returns:
+        {field: value} for the fields of VLLM_SERIES found in `text`.
+
+    Example:
+        >>> parse_vllm_metrics('vllm:num_requests_running{model_name="m"} 7.0\\nvllm:num_requests_waiting{model_name="m"} 3.0\\n')
+        {'running': 7.0, 'waiting': 3.0}
+    """
+    text = "\n" + text
+    values = {}
+    for field, names in VLLM_SERIES.items():
+        for name in names:
+            samples = _sample_values(text, name)
+            if samples:
+                values[field] = max(samples) if field in _FRACTIONS else sum(samples)
+                break
+    return values
+
+
+class EngineStats:
+    """
+    Load of one vLLM replica at its last scrape.
+
+    Attributes:
+        running (int): Requests in the engine's running batch
+        waiting (int): Requests queued inside the engine, from every service worker
+        kv_cache_usage (Optional[float]): Fraction of the KV cache in use
+        prefix_cache_hit_rate (Optional[float]): Prefix-cache hit rate since the previous scrape
+        scraped_at (float): time.monotonic() of the scrape
+    """
+
+    __slots__ = ("running", "waiting", "kv_cache_usage", "prefix_cache_hit_rate", "scraped_at")
+
+    def __init__(self, running: int, waiting: int, kv_cache_usage: Optional[float], prefix_cache_hit_rate: Optional[float]):
+        self.running = running
+        self.waiting = waiting
+        self.kv_cache_usage = kv_cache_usage
+        self.prefix_cache_hit_rate = prefix_cache_hit_rate
+        self.scraped_at = time.monotonic()
+
+
+class EngineMetricsPoller:
+    """
+    Background poller of every replica's vLLM `/metrics`.
+
+    Each round scrapes all replicas concurrently and stores the result in
+    `Replica.engine`, where routing, admission and degradation read it. It
+    is also re-exported as `detox_engine_*` gauges. A replica whose scrape
+    fails has no stats (`Replica.engine` is None) until the next success,
+    so decisions never rest on stale numbers.
+
+    Attributes:
+        replicas (List[Replica]): Replicas to scrape
+        interval_s (float): Seconds between scrape rounds
+        timeout_s (float): Timeout of one scrape
+        path (str): Metrics path on every replica
+    """
+
+    def __init__(self, replicas: List[Replica], interval_s: float = 2.0, timeout_s: float = 1.0, path: str = "/metrics"):
+        self.replicas = replicas
+        self.interval_s = interval_s
+        self.timeout_s = timeout_s
+        self.path = path
+        # Last (hits, queries) counters per replica, for the hit rate between scrapes
+        self._prefix_counters: Dict[str, tuple] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def total_waiting(self) -> int:
+        """
+        Requests queued inside all vLLM engines at their last scrape.
+        """
+        return sum(replica.engine.waiting for replica in self.replicas if replica.engine is not None)
+
+    def _prefix_cache_hit_rate(self, name: str, values: Dict[str, float], previous: Optional[EngineStats]) -> Optional[float]:
+        if "prefix_cache_hits" not in values or "prefix_cache_queries" not in values:
+            return values.get("prefix_cache_hit_rate")
+        hits, queries = values["prefix_cache_hits"], values["prefix_cache_queries"]
+        last = self._prefix_counters.get(name)
+        self._prefix_counters[name] = (hits, queries)
+        if last is not None and queries >= last[1] and hits >= last[0]:
+            if queries == last[1]:
+                # No prefill since the previous scrape
+                return previous.prefix_cache_hit_rate if previous is not None else None
+            return (hits - last[0]) / (queries - last[1])
+        # First scrape, or the engine restarted: the lifetime rate
+        return hits / queries if queries else None
+
+    async def scrape(self, http_client: httpx.AsyncClient, replica: Replica):
+        """
+        Scrape one replica and update its `engine` stats and gauges.
+        """
+        try:
+            response = await http_client.get(f"{replica.base_url}{self.path}", timeout=self.timeout_s)
+            response.raise_for_status()
+            values = parse_vllm_metrics(response.text)
+            if "running" not in values or "waiting" not in values:
+                raise ValueError("no vLLM request gauges in the exposition")
+        except (httpx.HTTPError, ValueError) as e:
+            if replica.engine is not None:
+                logger.warning(f"Scraping vLLM metrics of replica {replica.name} failed: {e}")
+            replica.engine = None
+            metrics.engine_scrape_failures_total.labels(replica=replica.name).inc()
+            for gauge in (metrics.engine_running, metrics.engine_waiting, metrics.engine_kv_cache_usage, metrics.engine_prefix_cache_hit_rate):
+                gauge.labels(replica=replica.name).set(math.nan)
+            return
+
+        stats = EngineStats(
+            running=int(values["running"]),
+            waiting=int(values["waiting"]),
+            kv_cache_usage=values.get("kv_cache_usage"),
+            prefix_cache_hit_rate=self._prefix_cache_hit_rate(replica.name, values, replica.engine),
+        )
+        replica.engine = stats
+        metrics.engine_running.labels(replica=replica.name).set(stats.running)
+        metrics.engine_waiting.labels(replica=replica.name).set(stats.waiting)
+        metrics.engine_kv_cache_usage.labels(replica=replica.name).set(
+            math.nan if stats.kv_cache_usage is None else stats.kv_cache_usage
+        )
+        metrics.engine_prefix_cache_hit_rate.labels(replica=replica.name).set(
+            math.nan if stats.prefix_cache_hit_rate is None else stats.prefix_cache_hit_rate
+        )
+
+    async def poll(self, http_client: httpx.AsyncClient):
+        """
+        Scrape every replica once.
+        """
+        await asyncio.gather(*(self.scrape(http_client, replica) for replica in self.replicas))
+
+    async def _poll_forever(self):
+        async with httpx.AsyncClient() as http_client:
+            while True:
+                await self.poll(http_client)
+                await asyncio.sleep(self.interval_s)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._poll_forever())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
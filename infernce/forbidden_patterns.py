@@ -0,0 +1,247 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import deque
+from typing import Dict, Iterable, List, Optional, Union
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Language key whose patterns apply to every language
+ALL_LANGUAGES = "*"
+# Below this many patterns a plain substring scan beats the pure-Python automaton
+# (500-character text: about 8 us vs 70 us at 4 patterns; even at about 190)
+AHO_CORASICK_MIN_PATTERNS = 192
+
+
+class KeywordScanMatcher:
+    """
+    Matcher that looks for each pattern in turn with a substring search.
+    Fastest for short pattern lists; cost grows with the number of patterns.
+    Patterns and text are compared after Unicode case folding.
+    """
+
+    def __init__(self, patterns: Iterable[str]):
+        folded = {}
+        for pattern in patterns:
+            if pattern.casefold():
+                folded[pattern.casefold()] = pattern
+        self._patterns = list(folded.items())
+        self.size = len(self._patterns)
+
+    def search(self, text: str) -> Optional[str]:
+        """
+        Return the first pattern found in `text`, or None.
+        """
+        text = text.casefold()
+        for folded, pattern in self._patterns:
+            if folded in text:
+                return pattern
+        return None
+
+
+class AhoCorasickMatcher:
+    """
+    Multi-pattern matcher that finds any of a set of keywords or phrases in a
+    single pass over the text, independent of the number of patterns.
+    Patterns and text are compared after Unicode case folding.
+    """
+
+    def __init__(self, patterns: Iterable[str]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[Optional[str]] = [None]
+        self.size = 0
+        for pattern in patterns:
+            self._add(pattern)
+        self._build_failure_links()
+
+    def _add(self, pattern: str):
+        folded = pattern.casefold()
+        if not folded:
+            return
+        state = 0
+        for char in folded:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(None)
+                self._goto[state][char] = next_state
+            state = next_state
+        if self._output[state] is None:
+            self.size += 1
+        self._output[state] = pattern
+
+    def _build_failure_links(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                # Inherit a match ending at the failure state (a pattern that is a suffix of this one)
+                if self._output[next_state] is None:
+                    self._output[next_state] = self._output[self._fail[next_state]]
+
+    def search(self, text: str) -> Optional[str]:
+        """
+        Return the first pattern found in `text`, or None.
+        """
+        goto = self._goto
+        fail = self._fail
+        output = self._output
+        state = 0
+        for char in text.casefold():
+            next_state = goto[state].get(char)
+            while next_state is None and state:
+                state = fail[state]
+                next_state = goto[state].get(char)
+            if next_state is None:
+                state = 0
+                continue
+            state = next_state
+            if output[state] is not None:
+                return output[state]
+        return None
+
+
+Matcher = Union[KeywordScanMatcher, AhoCorasickMatcher]
+
+
+def compile_matcher(patterns: List[str]) -> Matcher:
+    """
+    Compile `patterns` into the faster matcher for their number: a
+    KeywordScanMatcher below AHO_CORASICK_MIN_PATTERNS, an AhoCorasickMatcher above.
+    """
+    if len(patterns) < AHO_CORASICK_MIN_PATTERNS:
+        return KeywordScanMatcher(patterns)
+    return AhoCorasickMatcher(patterns)
+
+
+def _validate_patterns(patterns) -> Dict[str, List[str]]:
+    if not isinstance(patterns, dict):
+        raise ValueError(f"expected an object of language -> patterns, got {type(patterns).__name__}")
+    for language, language_patterns in patterns.items():
+        if not isinstance(language_patterns, list) or not all(isinstance(p, str) for p in language_patterns):
+            raise ValueError(f"patterns of language {language!r} must be a list of strings")
+    return patterns
+
+
+class ForbiddenPatternEngine:
+    """
+    Per-language forbidden-content matcher for the request guard.
+
+    Patterns come from a JSON file mapping a language id (or "*" for every
+    language) to a list of keywords or phrases, e.g.
+    {"*": ["prompt", "password"], "ru": ["пароль"]}. One matcher is compiled
+    per language from its own and the shared patterns (see `compile_matcher`). After `start()`
+    a background task checks the file for changes every `reload_interval_s`
+    and recompiles it in a worker thread without a restart; `search()` never
+    touches the filesystem. `patterns` is used when there is no file or it
+    cannot be loaded.
+
+    Attributes:
+        path (Optional[str]): Pattern file, None for a fixed pattern set
+        reload_interval_s (float): Seconds between file change checks
+    """
+
+    def __init__(
+        self,
+        patterns: Optional[Dict[str, List[str]]] = None,
+        path: Optional[str] = None,
+        reload_interval_s: float = 5.0,
+    ):
+        self.path = path
+        self.reload_interval_s = reload_interval_s
+        self._mtime = None
+        self._task: Optional[asyncio.Task] = None
+        self._fallback = patterns or {}
+        self._matchers: Dict[str, Matcher] = {}
+        if path is not None:
+            self.reload()
+        else:
+            self._compile(self._fallback)
+
+    @classmethod
+    def from_keywords(cls, keywords: List[str]) -> "ForbiddenPatternEngine":
+        return cls({ALL_LANGUAGES: keywords})
+
+    def _compile(self, patterns: Dict[str, List[str]]):
+        shared = patterns.get(ALL_LANGUAGES, [])
+        matchers = {ALL_LANGUAGES: compile_matcher(shared)}
+        for language, language_patterns in patterns.items():
+            if language != ALL_LANGUAGES:
+                matchers[language.lower()] = compile_matcher([*shared, *language_patterns])
+        # Swapped in whole: a concurrent search sees either the old or the new matchers
+        self._matchers = matchers
+        metrics.guard_patterns.set(sum(matcher.size for matcher in matchers.values()))
+
+    def reload(self):
+        """
+        Load and compile the pattern file. On error (including a file of the
+        wrong shape) the current patterns stay in use.
+        """
+        try:
+            mtime = os.path.getmtime(self.path)
+            with open(self.path, encoding="utf-8") as f:
+                patterns = _validate_patterns(json.load(f))
+            self._compile(patterns)
+            self._mtime = mtime
+            metrics.guard_pattern_reloads_total.labels(result="success").inc()
+            logger.info(f"Loaded forbidden patterns from {self.path}")
+        except (OSError, ValueError, TypeError, AttributeError) as e:
+            metrics.guard_pattern_reloads_total.labels(result="error").inc()
+            logger.error(f"Failed to load forbidden patterns from {self.path}: {e}")
+            if not self._matchers:
+                self._compile(self._fallback)
+
+    def reload_if_changed(self):
+        """
+        Reload the pattern file if its modification time changed. Blocking.
+        """
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if mtime != self._mtime:
+            self.reload()
+
+    async def _watch_forever(self):
+        while True:
+            await asyncio.sleep(self.reload_interval_s)
+            try:
+                await asyncio.to_thread(self.reload_if_changed)
+            except Exception as e:
+                logger.error(f"Forbidden pattern reload failed: {e}")
+
+    def start(self):
+        """
+        Start watching the pattern file (no-op for a fixed pattern set).
+        """
+        if self.path is not None and self._task is None:
+            self._task = asyncio.create_task(self._watch_forever())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def search(self, text: str, language: str = ALL_LANGUAGES) -> Optional[str]:
+        """
+        Return the first forbidden pattern found in `text` for `language`, or None.
+        """
+        start_time = time.perf_counter()
+        matchers = self._matchers
+        matcher = matchers.get(language) or matchers[ALL_LANGUAGES]
+        match = matcher.search(text)
+        metrics.guard_match_seconds.observe(time.perf_counter() - start_time)
+        return match
@@ -0,0 +1,186 @@
+import logging
+import time
+from typing import Iterable, Optional
+
+from forbidden_patterns import ForbiddenPatternEngine
+from instrumentation import GUARD
+from serialization import FastJSONResponse, dumps, loads
+from tracing import record_span
+
+# Default patterns for every language, used when no pattern file is configured
+FORBIDDEN_KEYWORDS = ["prompt", "secret", "token", "password"]
+default_pattern_engine = ForbiddenPatternEngine.from_keywords(FORBIDDEN_KEYWORDS)
+MAX_TEXT_LENGTH = 500
+# Upper bound for a single-item request body. A 500 character text needs at
+# most ~3 KB of JSON even when every character is \u-escaped.
+MAX_BODY_BYTES = 16 * 1024
+# Rejected values are logged as truncated JSON, so a huge batch item cannot blow up a log entry
+MAX_LOGGED_VALUE_CHARS = 500
+# Key under request.state where the guard leaves the parsed JSON body
+PARSED_BODY_STATE_KEY = "detox_body"
+# Key under request.state where the guard leaves the seconds it spent checking the body
+GUARD_SECONDS_STATE_KEY = "detox_guard_seconds"
+
+
+def _log_preview(value) -> str:
+    preview = dumps(value).decode("utf-8")
+    if len(preview) > MAX_LOGGED_VALUE_CHARS:
+        return preview[:MAX_LOGGED_VALUE_CHARS] + f"... ({len(preview)} chars)"
+    return preview
+
+
+def check_detox_item(body, pattern_engine: Optional[ForbiddenPatternEngine] = None) -> Optional[tuple[str, dict, dict]]:
+    """
+    Apply the request guard rules to one `{text, language_id}` item.
+    `pattern_engine` defaults to the built-in FORBIDDEN_KEYWORDS.
+
+    Returns:
+        None if the item is valid, otherwise a tuple of
+        (log message, log payload, 400 response content).
+    """
+    if not isinstance(body, dict):
+        return (
+            "Invalid request format",
+            {"received_body": _log_preview(body), "body_type": type(body).__name__},
+            {"detail": "Invalid request format.", "error": f"request must be an object (got {type(body).__name__})"},
+        )
+
+    if not isinstance(body.get("text"), str) or not isinstance(body.get("language_id"), str):
+        # Debug logging to understand what we're receiving
+        text_value = body.get("text")
+        language_id_value = body.get("language_id")
+        return (
+            "Invalid request format",
+            {
+                "received_body": _log_preview(body),
+                "text_type": type(text_value).__name__,
+                "text_value": _log_preview(text_value),
+                "language_id_type": type(language_id_value).__name__,
+                "language_id_value": _log_preview(language_id_value)
+            },
+            {
+                "detail": "Invalid request format.",
+                "error": f"text must be string (got {type(text_value).__name__}), language_id must be string (got {type(language_id_value).__name__})"
+            },
+        )
+
+    pattern_engine = pattern_engine or default_pattern_engine
+    forbidden_match = pattern_engine.search(body["text"], body["language_id"].lower())
+    if forbidden_match is not None:
+        return (
+            "Forbidden keyword detected in request",
+            {"text_preview": body.get("text", "")[:100], "forbidden_pattern": forbidden_match},
+            {"detail": "Query contains forbidden content."},
+        )
+
+    if len(body.get("text", "")) > MAX_TEXT_LENGTH:
+        return (
+            "Query too long",
+            {"text_length": len(body.get("text", ""))},
+            {"detail": "Query is too long."},
+        )
+
+    return None
+
+
+class TextSanitizationMiddleware:
+    """
+    Pure ASGI request guard for the single-item detoxify endpoints.
+
+    Oversize bodies are rejected from Content-Length before anything is read.
+    The body is then read and parsed once, checked with `check_detox_item`,
+    and the parsed object is handed to the endpoint through
+    `request.state.detox_body`. The raw body is replayed downstream as well,
+    so endpoints that read it themselves keep working.
+    """
+
+    def __init__(
+        self,
+        app,
+        logger: logging.Logger,
+        guarded_paths: Iterable[str] = ("/detoxify",),
+        max_body_bytes: int = MAX_BODY_BYTES,
+        pattern_engine: Optional[ForbiddenPatternEngine] = None,
+    ):
+        self.app = app
+        self.logger = logger
+        self.pattern_engine = pattern_engine
+        self.guarded_paths = frozenset(guarded_paths)
+        self.max_body_bytes = max_body_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in self.guarded_paths:
+            await self.app(scope, receive, send)
+            return
+
+        request_id = scope.get("state", {}).get("request_id", "unknown")
+
+        content_length = None
+        for name, value in scope["headers"]:
+            if name == b"content-length":
+                content_length = int(value) if value.isdigit() else None
+                break
+        if content_length is not None and content_length > self.max_body_bytes:
+            self.logger.warning(
+                "Query too long",
+                extra={"json_payload": {"request_id": request_id, "content_length": content_length}}
+            )
+            await self._reject(scope, receive, send, {"detail": "Query is too long."})
+            return
+
+        chunks = []
+        size = 0
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if size > self.max_body_bytes:
+                self.logger.warning(
+                    "Query too long",
+                    extra={"json_payload": {"request_id": request_id, "content_length": size}}
+                )
+                await self._reject(scope, receive, send, {"detail": "Query is too long."})
+                return
+            chunks.append(chunk)
+            more_body = message.get("more_body", False)
+        raw_body = b"".join(chunks)
+
+        start_time = time.perf_counter()
+        try:
+            body = loads(raw_body)
+        except ValueError:
+            await self._reject(scope, receive, send, {"detail": "Invalid JSON format in request body."})
+            return
+
+        rejection = check_detox_item(body, self.pattern_engine)
+        if rejection is not None:
+            log_message, log_payload, content = rejection
+            self.logger.warning(
+                log_message,
+                extra={"json_payload": {"request_id": request_id, **log_payload}}
+            )
+            await self._reject(scope, receive, send, content)
+            return
+
+        state = scope.setdefault("state", {})
+        state[PARSED_BODY_STATE_KEY] = body
+        state[GUARD_SECONDS_STATE_KEY] = guard_seconds = time.perf_counter() - start_time
+        record_span(GUARD, guard_seconds)
+
+        body_sent = False
+
+        async def replay_receive():
+            nonlocal body_sent
+            if not body_sent:
+                body_sent = True
+                return {"type": "http.request", "body": raw_body, "more_body": False}
+            return await receive()
+
+        await self.app(scope, replay_receive, send)
+
+    async def _reject(self, scope, receive, send, content: dict):
+        response = FastJSONResponse(status_code=400, content=content)
+        await response(scope, receive, send)
@@ -0,0 +1,89 @@
+import time
+from contextlib import contextmanager
+from typing import Iterable
+
+import metrics
+from tracing import record_span
+from utils import langs
+
+# Pipeline stages timed by `detox_stage_seconds`
+GUARD = "guard"
+PROMPT_BUILD = "prompt_build"
+UPSTREAM = "upstream"
+PARSE = "parse"
+LOG_ENQUEUE = "log_enqueue"
+
+_KNOWN_LANGUAGES = frozenset(langs)
+
+
+def language_label(language_id: str) -> str:
+    """
+    Metric label for a client-supplied language id; unknown ids share one
+    label so they cannot blow up the number of series.
+    """
+    return language_id if language_id in _KNOWN_LANGUAGES else "other"
+
+
+def observe_stage(stage: str, language_id: str, adapter: str, seconds: float, span: bool = True):
+    """
+    Record a stage that just ended, as a metric and (unless `span` is False)
+    as a span of the current trace.
+    """
+    if span:
+        record_span(stage, seconds)
+    metrics.stage_seconds.labels(stage=stage, language=language_label(language_id), adapter=adapter).observe(seconds)
+
+
+@contextmanager
+def stage_timer(stage: str, language_id: str, adapter: str):
+    """
+    Time the block as one pipeline stage (also when it raises).
+    """
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, language_id, adapter, time.perf_counter() - start_time)
+
+
+def record_tokens(language_id: str, adapter: str, prompt_tokens: int, completion_tokens: int):
+    language = language_label(language_id)
+    metrics.tokens_total.labels(language=language, adapter=adapter, kind="prompt").inc(prompt_tokens)
+    metrics.tokens_total.labels(language=language, adapter=adapter, kind="completion").inc(completion_tokens)
+
+
+class RequestMetricsMiddleware:
+    """
+    Pure ASGI middleware counting responses by status code and timing
+    requests of the given paths, with an in-flight gauge per path. Added
+    last so that it also sees the guard's rejections.
+    """
+
+    def __init__(self, app, paths: Iterable[str]):
+        self.app = app
+        self.paths = frozenset(paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        endpoint = scope["path"]
+        # An exception before the response started ends as a 500
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        inflight = metrics.http_inflight.labels(endpoint=endpoint)
+        inflight.inc()
+        start_time = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            inflight.dec()
+            metrics.http_request_seconds.labels(endpoint=endpoint).observe(time.perf_counter() - start_time)
+            metrics.http_responses_total.labels(endpoint=endpoint, code=str(status_code)).inc()
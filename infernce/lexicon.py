@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+"""
+Compiled toxic lexicon.
+
+The multilingual lexicon is compiled once, at build time, into a binary
+file that the service maps read-only on first use instead of downloading
+and merging the Hugging Face dataset at startup.
+
+Usage:
+    python lexicon.py compile --output toxic_lexicon.bin [--dataset NAME | --json PATH]
+"""
+
+import argparse
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+import zlib
+from array import array
+from typing import Dict, Iterable, List, Optional
+
+HF_LEXICON_DATASET = "textdetox/multilingual_toxic_lexicon"
+# Section holding the union of every language
+ALL_LANGUAGES = "*"
+
+_MAGIC = b"DTXLEX01"
+# magic, section count
+_HEADER = struct.Struct("<8sI4x")
+# language, term count, bucket bits, hashes offset, term offsets offset, blob offset, buckets offset
+_SECTION = struct.Struct("<16sIIQQQQ")
+# Bucket index size limit: 2**20 + 1 uint32 per section
+_MAX_BUCKET_BITS = 20
+
+
+def _encode(term: str) -> bytes:
+    return term.encode("utf-8", "surrogatepass")
+
+
+def _align(buffer: bytearray, alignment: int = 8):
+    buffer.extend(b"\0" * (-len(buffer) % alignment))
+
+
+def load_hf_lexicon(dataset_name: str = HF_LEXICON_DATASET) -> Dict[str, List[str]]:
+    """
+    Load the lexicon from Hugging Face datasets, one split per language.
+    Only used to build the compiled lexicon (and as a fallback without it).
+    """
+    from datasets import load_dataset
+
+    dataset = load_dataset(dataset_name)
+    return {language: list(dataset[language]["text"]) for language in dataset.keys()}
+
+
+def compile_lexicon(terms_by_language: Dict[str, Iterable[str]], path: str) -> Dict[str, int]:
+    """
+    Write the compiled lexicon: one section per language plus the union of
+    all of them under "*". A section stores its unique terms ordered by
+    CRC-32 as a sorted uint32 hash array, a uint32 offset array and the
+    concatenated UTF-8 terms, plus an index of where each range of hash
+    prefixes starts (about one term per range). A lookup reads one or two
+    hashes of the mapped file, with no parsing at load time.
+
+    Returns:
+        Number of unique terms per section.
+    """
+    if sys.byteorder != "little":
+        raise RuntimeError("The compiled lexicon is little-endian.")
+    sections = {language: {_encode(term) for term in terms if term} for language, terms in terms_by_language.items()}
+    sections[ALL_LANGUAGES] = set().union(*sections.values())
+
+    data = bytearray()
+    table = []
+    data_start = _HEADER.size + _SECTION.size * len(sections)
+    for language, terms in sections.items():
+        ordered = sorted(terms, key=lambda term: (zlib.crc32(term), term))
+        hashes = array("I", (zlib.crc32(term) for term in ordered))
+        offsets = array("I", [0])
+        for term in ordered:
+            offsets.append(offsets[-1] + len(term))
+        bucket_bits = min(_MAX_BUCKET_BITS, max(1, len(ordered).bit_length()))
+        buckets = array("I", [0] * ((1 << bucket_bits) + 1))
+        for term_hash in hashes:
+            buckets[(term_hash >> (32 - bucket_bits)) + 1] += 1
+        for bucket in range(1, len(buckets)):
+            buckets[bucket] += buckets[bucket - 1]
+        _align(data)
+        hashes_offset = data_start + len(data)
+        data.extend(hashes.tobytes())
+        _align(data)
+        offsets_offset = data_start + len(data)
+        data.extend(offsets.tobytes())
+        _align(data)
+        buckets_offset = data_start + len(data)
+        data.extend(buckets.tobytes())
+        blob_offset = data_start + len(data)
+        data.extend(b"".join(ordered))
+        table.append(_SECTION.pack(
+            language.encode("utf-8"), len(ordered), bucket_bits, hashes_offset, offsets_offset, blob_offset, buckets_offset,
+        ))
+
+    # Written next to the target and renamed, so a running service never maps a half-written file
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "wb") as f:
+        f.write(_HEADER.pack(_MAGIC, len(sections)))
+        f.write(b"".join(table))
+        f.write(data)
+    os.replace(temporary_path, path)
+    return {language: len(terms) for language, terms in sections.items()}
+
+
+class _Section:
+    __slots__ = ("hashes", "offsets", "blob", "buckets", "shift")
+
+    def __init__(
+        self,
+        buffer: memoryview,
+        count: int,
+        bucket_bits: int,
+        hashes_offset: int,
+        offsets_offset: int,
+        blob_offset: int,
+        buckets_offset: int,
+    ):
+        self.hashes = buffer[hashes_offset:hashes_offset + 4 * count].cast("I")
+        self.offsets = buffer[offsets_offset:offsets_offset + 4 * (count + 1)].cast("I")
+        self.blob = buffer[blob_offset:blob_offset + self.offsets[count]]
+        self.buckets = buffer[buckets_offset:buckets_offset + 4 * ((1 << bucket_bits) + 1)].cast("I")
+        self.shift = 32 - bucket_bits
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+    def __contains__(self, term: str) -> bool:
+        data = term.encode("utf-8", "surrogatepass")
+        term_hash = zlib.crc32(data)
+        bucket = term_hash >> self.shift
+        buckets, hashes = self.buckets, self.hashes
+        index, end = buckets[bucket], buckets[bucket + 1]
+        # A bucket holds about one term, so a linear scan beats a bisect over it;
+        # hashes are sorted and terms sharing a hash are adjacent
+        while index < end:
+            index_hash = hashes[index]
+            if index_hash == term_hash:
+                offsets = self.offsets
+                if self.blob[offsets[index]:offsets[index + 1]] == data:
+                    return True
+            elif index_hash > term_hash:
+                return False
+            index += 1
+        return False
+
+
+class CompiledLexicon:
+    """
+    Read-only view of a compiled lexicon file (see `compile_lexicon`).
+
+    The file is only opened and memory-mapped on the first lookup, and its
+    pages are shared by every worker process on the host through the page
+    cache. `term in lexicon` looks the term up in every language, like the
+    merged set it replaces; `contains` looks in one language.
+
+    A lookup in the mapped file costs a few times a set lookup, so the
+    results of `term in lexicon` are kept in a per-process dict of up to
+    `cache_size` terms (cleared when full). Request text follows a skewed
+    word distribution, so most tokens hit it.
+
+    Attributes:
+        path (str): Path of the compiled lexicon file
+        cache_size (int): Lookup results kept in memory, 0 to disable
+    """
+
+    def __init__(self, path: str, cache_size: int = 65536):
+        self.path = path
+        self.cache_size = cache_size
+        self._mmap: Optional[mmap.mmap] = None
+        self._sections: Optional[Dict[str, _Section]] = None
+        self._found: Dict[str, bool] = {}
+
+    def _map(self) -> Dict[str, _Section]:
+        if self._sections is None:
+            with open(self.path, "rb") as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            buffer = memoryview(self._mmap)
+            magic, section_count = _HEADER.unpack_from(buffer)
+            if magic != _MAGIC:
+                raise ValueError(f"{self.path} is not a compiled lexicon.")
+            sections = {}
+            for index in range(section_count):
+                language, *layout = _SECTION.unpack_from(buffer, _HEADER.size + index * _SECTION.size)
+                sections[language.rstrip(b"\0").decode("utf-8")] = _Section(buffer, *layout)
+            self._sections = sections
+        return self._sections
+
+    def languages(self) -> List[str]:
+        return [language for language in self._map() if language != ALL_LANGUAGES]
+
+    def __len__(self) -> int:
+        return len(self._map()[ALL_LANGUAGES])
+
+    def __contains__(self, term: str) -> bool:
+        found = self._found.get(term)
+        if found is None:
+            sections = self._sections if self._sections is not None else self._map()
+            found = term in sections[ALL_LANGUAGES]
+            if self.cache_size:
+                if len(self._found) >= self.cache_size:
+                    self._found.clear()
+                self._found[term] = found
+        return found
+
+    def contains(self, term: str, language: str) -> bool:
+        """
+        Whether `term` is in the lexicon of `language`, or of any language
+        if the lexicon has no section for it.
+        """
+        sections = self._map()
+        return term in sections.get(language, sections[ALL_LANGUAGES])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    compile_parser = subparsers.add_parser("compile", help="Compile the lexicon from Hugging Face or a JSON file")
+    compile_parser.add_argument("--output", required=True)
+    compile_parser.add_argument("--dataset", default=HF_LEXICON_DATASET, help="Hugging Face dataset, one split per language")
+    compile_parser.add_argument("--json", help='JSON file of {"language": [terms]} (or a plain list of terms) instead of the dataset')
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    if args.json:
+        with open(args.json) as f:
+            terms = json.load(f)
+        terms_by_language = terms if isinstance(terms, dict) else {ALL_LANGUAGES: terms}
+    else:
+        terms_by_language = load_hf_lexicon(args.dataset)
+    counts = compile_lexicon(terms_by_language, args.output)
+    total = counts.pop(ALL_LANGUAGES)
+    print(" ".join(f"{language}={count}" for language, count in sorted(counts.items())))
+    print(
+        f"{total} unique terms in {len(counts)} languages written to {args.output} "
+        f"({os.path.getsize(args.output) / 1024:.0f} KiB) in {time.perf_counter() - start_time:.1f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+import bisect
+import random
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+from serialization import dumps
+
+# Upper bounds (characters) of the input length histogram in aggregate records
+TEXT_LENGTH_BUCKETS = (25, 50, 100, 200, 300, 400, 500)
+# Fields dropped from sampled success records when payload slimming is on
+SLIM_DROPPED_FIELDS = ("actual_model_id", "prompt_tokens", "completion_tokens")
+# Cloud Logging rejects entries over 256 KB; records split with split_by_size stay well below
+MAX_RECORD_BYTES = 128 * 1024
+
+
+def _new_window_stats() -> dict:
+    return {
+        "requests": 0,
+        "errors": 0,
+        "parse_failures": 0,
+        "slow": 0,
+        "sampled_out": 0,
+        "prompt_tokens": 0,
+        "completion_tokens": 0,
+        "total_tokens": 0,
+        "text_length_histogram": [0] * (len(TEXT_LENGTH_BUCKETS) + 1),
+    }
+
+
+def split_by_size(items: list, max_bytes: int = MAX_RECORD_BYTES) -> List[list]:
+    """
+    Split `items` into consecutive chunks whose serialized size stays under
+    `max_bytes`, one log record per chunk. An item larger than `max_bytes`
+    gets a chunk of its own.
+    """
+    chunks, chunk, size = [], [], 0
+    for item in items:
+        item_size = len(dumps(item)) + 1
+        if chunk and size + item_size > max_bytes:
+            chunks.append(chunk)
+            chunk, size = [], 0
+        chunk.append(item)
+        size += item_size
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+class InferenceLogPolicy:
+    """
+    Decides which inference records are written to Cloud Logging and keeps
+    exact per-language aggregates for the records that are not.
+
+    Errors, parse failures and slow requests are always kept. Other successes
+    are kept with the sample rate of their language (or the default rate).
+    Every request, kept or not, is counted in the current aggregate window,
+    which `pop_aggregates` returns as one compact record per window.
+
+    Attributes:
+        success_sample_rate (float): Default fraction of successes kept
+        language_sample_rates (Dict[str, float]): Per-language overrides
+        slow_threshold_ms (float): Successes slower than this are always kept
+        slim_payload (bool): Drop non-essential fields from sampled successes
+    """
+
+    def __init__(
+        self,
+        success_sample_rate: float = 1.0,
+        language_sample_rates: Optional[Dict[str, float]] = None,
+        slow_threshold_ms: float = 2000.0,
+        slim_payload: bool = False,
+    ):
+        self.success_sample_rate = success_sample_rate
+        self.language_sample_rates = language_sample_rates or {}
+        self.slow_threshold_ms = slow_threshold_ms
+        self.slim_payload = slim_payload
+        self._window_start = time.time()
+        self._window: Dict[str, dict] = defaultdict(_new_window_stats)
+
+    def _count(self, language_id: str, input_text: str) -> dict:
+        stats = self._window[language_id]
+        stats["requests"] += 1
+        stats["text_length_histogram"][bisect.bisect_left(TEXT_LENGTH_BUCKETS, len(input_text))] += 1
+        return stats
+
+    def admit_success(self, result_dict: dict) -> Optional[dict]:
+        """
+        Count a successful request and decide whether to log it.
+
+        Returns:
+            The payload to log (possibly slimmed), or None to skip the record.
+        """
+        language_id = result_dict["language_id"]
+        stats = self._count(language_id, result_dict["input_text"])
+        stats["prompt_tokens"] += result_dict.get("prompt_tokens", 0)
+        stats["completion_tokens"] += result_dict.get("completion_tokens", 0)
+        stats["total_tokens"] += result_dict.get("total_tokens", 0)
+
+        if result_dict["detoxified_text"] == "error":
+            stats["parse_failures"] += 1
+            return {**result_dict, "log_reason": "parse_failure"}
+        if result_dict["latency_ms"] > self.slow_threshold_ms:
+            stats["slow"] += 1
+            return {**result_dict, "log_reason": "slow"}
+
+        sample_rate = self.language_sample_rates.get(language_id, self.success_sample_rate)
+        if sample_rate < 1.0 and random.random() >= sample_rate:
+            stats["sampled_out"] += 1
+            return None
+
+        payload = {**result_dict, "log_reason": "sampled", "sample_rate": sample_rate}
+        if self.slim_payload:
+            for field in SLIM_DROPPED_FIELDS:
+                payload.pop(field, None)
+            payload = {key: value for key, value in payload.items() if value is not None and value is not False}
+        return payload
+
+    def admit_error(self, language_id: str, input_text: str) -> bool:
+        """
+        Count a failed request. Errors are always logged.
+        """
+        self._count(language_id, input_text)["errors"] += 1
+        return True
+
+    def pop_aggregates(self) -> Optional[dict]:
+        """
+        Close the current window and return its aggregate record, or None if
+        no request was seen.
+        """
+        window, window_start = self._window, self._window_start
+        self._window = defaultdict(_new_window_stats)
+        self._window_start = time.time()
+        if not window:
+            return None
+        return {
+            "record_type": "aggregate",
+            "window_start": window_start,
+            "window_end": self._window_start,
+            "text_length_buckets": list(TEXT_LENGTH_BUCKETS),
+            "languages": dict(window),
+            "requests": sum(stats["requests"] for stats in window.values()),
+            "total_tokens": sum(stats["total_tokens"] for stats in window.values()),
+        }
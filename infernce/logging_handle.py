@@ -1,21 +1,28 @@
 import logging
-import json
 import os
+import queue
+import random
+import re
+import threading
 import time
+from google.api_core import exceptions as api_exceptions
 from google.cloud import logging as gcp_logging
 from google.cloud.logging.handlers import CloudLoggingHandler
 from google.oauth2 import service_account
 
+import metrics
+from serialization import dumps, merge_objects
+
 class JsonFormatter(logging.Formatter):
     """
     Custom logging formatter to output logs in a structured JSON format,
     compatible with Google Cloud Logging.
     """
-    def format(self, record):
-        log_entry = {
+    def _base_entry(self, record) -> dict:
+        return {
             "severity": record.levelname,
             "message": record.getMessage(),
-            "timestamp": time.time(),
+            "timestamp": record.created,
             "python_logger": record.name,
             "python_module": record.module,
             "python_function": record.funcName,
@@ -23,18 +30,192 @@ class JsonFormatter(logging.Formatter):
             "trace_id": getattr(record, 'trace_id', None),
             "span_id": getattr(record, 'span_id', None),
         }
+
+    def build_entry(self, record) -> dict:
+        log_entry = self._base_entry(record)
         # Add extra attributes (e.g., from `extra={"json_payload": ...}`)
         if hasattr(record, 'json_payload') and isinstance(record.json_payload, dict):
             log_entry.update(record.json_payload)
-        return json.dumps(log_entry)
+        return log_entry
+
+    def format(self, record):
+        # Reuse a payload the caller already serialized (e.g. for the response body)
+        payload_raw = getattr(record, 'json_payload_raw', None)
+        if payload_raw is not None:
+            return merge_objects(dumps(self._base_entry(record)), payload_raw).decode("utf-8")
+        return dumps(self.build_entry(record)).decode("utf-8")
+
+# Errors after which the same batch is sent again: the backend is unavailable or overloaded
+TRANSIENT_SHIP_ERRORS = (
+    api_exceptions.ServerError,
+    api_exceptions.TooManyRequests,
+    api_exceptions.Aborted,
+    ConnectionError,
+    TimeoutError,
+)
+
+def _rejected_entry_count(error: api_exceptions.InvalidArgument, batch_size: int) -> int:
+    # With partial_success the valid entries are written and the error details
+    # carry the indexes of the rejected ones (WriteLogEntriesPartialErrors, DebugInfo).
+    indexes = set()
+    for detail in getattr(error, "details", None) or []:
+        if isinstance(detail, dict):
+            indexes.update(int(index) for index in detail.get("logEntryErrors", {}))
+        else:
+            indexes.update(int(index) for index in re.findall(r"key: (\d+)", str(detail)))
+    # Without details at least one entry, usually an oversized one, was rejected
+    return min(len(indexes), batch_size) or 1
+
+class BatchedCloudLoggingHandler(logging.Handler):
+    """
+    Logging handler that keeps Cloud Logging off the request path.
+
+    `emit` only puts the record on a bounded in-memory queue. A background
+    thread drains the queue, builds the structured entries and ships them to
+    Cloud Logging in bulk with one API call per batch. When the queue is full
+    the record is dropped according to `overflow_policy` ("drop_newest" or
+    "drop_oldest") and counted, so logging never blocks a request.
+
+    A batch that fails with a transient error (unavailable, deadline
+    exceeded, rate limited) is sent again up to `max_retries` times with
+    exponential backoff; every entry has an insert id, so Cloud Logging
+    drops the duplicates of a batch that was written after all. When
+    Cloud Logging rejects some entries (e.g. too large) the rest are still
+    written and only the rejected ones are counted as dropped.
+    """
+
+    def __init__(
+        self,
+        client: gcp_logging.Client,
+        name: str,
+        max_queue_size: int = 10000,
+        batch_size: int = 500,
+        flush_interval_s: float = 1.0,
+        overflow_policy: str = "drop_newest",
+        max_retries: int = 3,
+        retry_backoff_s: float = 0.5,
+    ):
+        super().__init__()
+        self.cloud_logger = client.logger(name)
+        self.batch_size = batch_size
+        self.flush_interval_s = flush_interval_s
+        self.overflow_policy = overflow_policy
+        self.max_retries = max_retries
+        self.retry_backoff_s = retry_backoff_s
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue_size)
+        self._ship_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._worker = threading.Thread(target=self._run, name=f"log-shipper-{name}", daemon=True)
+        self._worker.start()
 
-def setup_cloud_logging(gcp_project_id: str, inference_log_name: str):
+    def emit(self, record):
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            if self.overflow_policy == "drop_oldest":
+                try:
+                    self._queue.get_nowait()
+                    self._queue.put_nowait(record)
+                except (queue.Empty, queue.Full):
+                    pass
+            metrics.log_records_dropped_total.labels(reason="queue_full").inc()
+        metrics.log_queue_depth.set(self._queue.qsize())
+
+    def _drain(self, first=None) -> list:
+        records = [first] if first is not None else []
+        while len(records) < self.batch_size:
+            try:
+                records.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return records
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                first = self._queue.get(timeout=self.flush_interval_s)
+            except queue.Empty:
+                continue
+            self._ship(self._drain(first))
+
+    def _entry(self, record) -> dict:
+        if isinstance(self.formatter, JsonFormatter):
+            return self.formatter.build_entry(record)
+        return {"severity": record.levelname, "message": self.format(record), "timestamp": record.created}
+
+    def _ship(self, records: list):
+        with self._ship_lock:
+            try:
+                self._commit(records)
+            except Exception as e:
+                metrics.log_records_dropped_total.labels(reason="ship_failed").inc(len(records))
+                logging.getLogger(__name__).error(f"Failed to ship {len(records)} log records: {e}")
+            metrics.log_queue_depth.set(self._queue.qsize())
+
+    def _commit(self, records: list):
+        batch = self.cloud_logger.batch()
+        for record in records:
+            batch.log_struct(self._entry(record), severity=record.levelname, insert_id=os.urandom(12).hex())
+        for attempt in range(self.max_retries + 1):
+            try:
+                # A failed commit keeps its entries, so the same batch is sent again
+                batch.commit(partial_success=True)
+                metrics.log_records_shipped_total.inc(len(records))
+                return
+            except api_exceptions.InvalidArgument as e:
+                rejected = _rejected_entry_count(e, len(records))
+                metrics.log_records_shipped_total.inc(len(records) - rejected)
+                metrics.log_records_dropped_total.labels(reason="invalid_entry").inc(rejected)
+                logging.getLogger(__name__).error(f"Cloud Logging rejected {rejected} of {len(records)} log records: {e}")
+                return
+            except TRANSIENT_SHIP_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                metrics.log_ship_retries_total.inc()
+                delay = self.retry_backoff_s * 2 ** attempt * random.uniform(0.5, 1.0)
+                logging.getLogger(__name__).warning(f"Shipping {len(records)} log records failed ({e}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+
+    def flush(self):
+        """
+        Ship every queued record now. Used at shutdown.
+        """
+        while True:
+            records = self._drain()
+            if not records:
+                break
+            self._ship(records)
+        # Wait for a batch the worker thread may be shipping right now
+        with self._ship_lock:
+            pass
+
+    def close(self):
+        self._stopped.set()
+        self._worker.join(timeout=self.flush_interval_s * 2)
+        self.flush()
+        super().close()
+
+def setup_cloud_logging(
+    gcp_project_id: str,
+    inference_log_name: str,
+    batched: bool = True,
+    max_queue_size: int = 10000,
+    batch_size: int = 500,
+    flush_interval_s: float = 1.0,
+    overflow_policy: str = "drop_newest",
+):
     """
     Sets up Google Cloud Logging for the FastAPI application.
 
     Args:
         gcp_project_id (str): Your Google Cloud Project ID.
         inference_log_name (str): The name for inference-related logs.
+        batched (bool): Ship inference logs through BatchedCloudLoggingHandler
+            instead of formatting them on the request path.
+        max_queue_size (int): Records buffered before the overflow policy applies.
+        batch_size (int): Maximum records per Cloud Logging API call.
+        flush_interval_s (float): Maximum time a record waits before shipping.
+        overflow_policy (str): "drop_newest" or "drop_oldest" when the queue is full.
 
     Returns:
         tuple: A tuple containing (inference_logger, metrics_logger).
@@ -52,7 +233,17 @@ def setup_cloud_logging(gcp_project_id: str, inference_log_name: str):
     # Set up the main logger for inference requests (model input/output)
     inference_logger = logging.getLogger(inference_log_name)
     inference_logger.setLevel(logging.INFO)
-    inference_handler = CloudLoggingHandler(gcp_logging_client, name=inference_log_name)
+    if batched:
+        inference_handler = BatchedCloudLoggingHandler(
+            gcp_logging_client,
+            name=inference_log_name,
+            max_queue_size=max_queue_size,
+            batch_size=batch_size,
+            flush_interval_s=flush_interval_s,
+            overflow_policy=overflow_policy,
+        )
+    else:
+        inference_handler = CloudLoggingHandler(gcp_logging_client, name=inference_log_name)
     inference_handler.setFormatter(JsonFormatter())
     inference_logger.addHandler(inference_handler)
     inference_logger.propagate = False # Prevent logs from propagating to the root logger
@@ -63,14 +254,28 @@ def setup_cloud_logging(gcp_project_id: str, inference_log_name: str):
     root_logger.handlers = [] # Clear existing handlers (like default basicConfig)
     root_logger.addHandler(logging.StreamHandler()) # Add console output
     root_logger.setLevel(logging.INFO) # Set a default level for console output
+    # httpx logs every request at INFO: each replica health probe, metrics scrape and upstream call
+    logging.getLogger("httpx").setLevel(logging.WARNING)
 
     return inference_logger
 
+def formats_raw_payload(logger: logging.Logger) -> bool:
+    """
+    Whether a handler of `logger` formats records with JsonFormatter and so
+    reuses a pre-serialized `json_payload_raw`. BatchedCloudLoggingHandler
+    builds its entries from `json_payload` and never reads it.
+    """
+    return any(
+        isinstance(handler.formatter, JsonFormatter) and not isinstance(handler, BatchedCloudLoggingHandler)
+        for handler in logger.handlers
+    )
+
 def flush_cloud_loggers(loggers: list[logging.Logger]):
     """
-    Flushes all CloudLoggingHandler instances associated with the given loggers.
+    Flushes all CloudLoggingHandler and BatchedCloudLoggingHandler instances
+    associated with the given loggers.
     """
     for logger in loggers:
         for handler in logger.handlers:
-            if isinstance(handler, CloudLoggingHandler):
+            if isinstance(handler, (CloudLoggingHandler, BatchedCloudLoggingHandler)):
                 handler.flush()
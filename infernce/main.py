@@ -1,23 +1,43 @@
 import os
 import logging
-import json
+import math
 import time
 import asyncio
+from typing import Any, Optional
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel
-from starlette.middleware.base import BaseHTTPMiddleware
+from fastapi.responses import PlainTextResponse, Response
+from pydantic import BaseModel, ValidationError
 import httpx
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, nullcontext
 from dotenv import load_dotenv
-from openai import OpenAI
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
 
 # Import the logging setup from the new logging.py file
-from logging_handle import setup_cloud_logging, flush_cloud_loggers
+from logging_handle import setup_cloud_logging, flush_cloud_loggers, formats_raw_payload
 
 # Assuming these are available in your environment or project
 from delete_baseline import DetoxificationBaseline as delete_baseline
-from utils import get_messages, parse_detoxified_output
+from utils import get_messages, prompt_version
+from output_parser import parse_detoxified_output, IncrementalOutputParser, USABLE_STATUSES
+import metrics
+from upstream import create_async_client
+from routing import Replica, ReplicaRouter
+from engine_metrics import EngineMetricsPoller
+from guard import TextSanitizationMiddleware, check_detox_item, PARSED_BODY_STATE_KEY, GUARD_SECONDS_STATE_KEY, FORBIDDEN_KEYWORDS, default_pattern_engine
+from tracing import TracingMiddleware, install_log_record_factory
+from instrumentation import GUARD, PROMPT_BUILD, UPSTREAM, PARSE, LOG_ENQUEUE, RequestMetricsMiddleware, observe_stage, stage_timer, record_tokens
+from forbidden_patterns import ForbiddenPatternEngine
+from batching import MicroBatchDispatcher, from_chat_completion, merge_generation_params, render_chat_prompt, split_completion_batch
+from coalescing import SingleFlight
+from prefilter import LexiconPrefilterPolicy
+from degradation import DegradationController
+from admission import AdaptiveAdmissionController, AdmissionRejected
+from cancellation import CLIENT_DISCONNECT, DEADLINE, ReleasingStreamingResponse, RequestCancelled, run_cancellable
+from scheduling import BATCH, INTERACTIVE, DEFAULT_TENANT, Flow, classify_request
+from log_policy import InferenceLogPolicy, split_by_size
+from output_budget import OutputBudgetPolicy
+from serialization import FastJSONResponse, dumps, merge_objects
+from cache import DetoxResultCache, TieredDetoxCache, SQLiteCacheBackend, RedisCacheBackend, make_cache_key
 
 # Load environment variables from .env file
 load_dotenv()
@@ -25,9 +45,127 @@ load_dotenv()
 # --- Configuration ---
 VLLM_API_BASE_URL = os.getenv("vLLM_API", "localhost") 
 VLLM_OPENAI_COMPLETIONS_URL = f"http://{VLLM_API_BASE_URL}:8000/v1/chat/completions"
-VLLM_METRICS_URL = f"http://{VLLM_API_BASE_URL}:8000/metrics"
 print("VLLM_OPENAI_COMPLETIONS_URL:", VLLM_OPENAI_COMPLETIONS_URL)
+# Upstream connection pool and timeouts
+VLLM_POOL_SIZE = int(os.getenv("VLLM_POOL_SIZE", "512"))
+VLLM_KEEPALIVE_CONNECTIONS = int(os.getenv("VLLM_KEEPALIVE_CONNECTIONS", "128"))
+VLLM_REQUEST_TIMEOUT_S = float(os.getenv("VLLM_REQUEST_TIMEOUT_S", "60"))
+VLLM_CONNECT_TIMEOUT_S = float(os.getenv("VLLM_CONNECT_TIMEOUT_S", "5"))
+# Comma-separated vLLM replicas (host:port or full url); defaults to the single vLLM_API host.
+# Requests are routed by (adapter, language) so each replica keeps its prompts prefix-cached.
+VLLM_REPLICAS = [r.strip() for r in os.getenv("VLLM_REPLICAS", f"{VLLM_API_BASE_URL}:8000").split(",") if r.strip()]
+ROUTER_VIRTUAL_NODES = int(os.getenv("ROUTER_VIRTUAL_NODES", "64"))
+ROUTER_MAX_OUTSTANDING = int(os.getenv("ROUTER_MAX_OUTSTANDING", "64"))
+# Requests queued inside a replica's vLLM engine at which its (adapter, language) pairs spill over; 0 disables
+ROUTER_MAX_ENGINE_WAITING = int(os.getenv("ROUTER_MAX_ENGINE_WAITING", "16"))
+ROUTER_PROBE_INTERVAL_S = float(os.getenv("ROUTER_PROBE_INTERVAL_S", "5"))
+ROUTER_UNHEALTHY_THRESHOLD = int(os.getenv("ROUTER_UNHEALTHY_THRESHOLD", "2"))
+# "affinity" (prefix-cache friendly) or "least_outstanding" (EWMA latency x outstanding requests)
+ROUTER_POLICY = os.getenv("ROUTER_POLICY", "affinity").lower()
+# Per-replica circuit breaker
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_COOLDOWN_S = float(os.getenv("BREAKER_COOLDOWN_S", "10"))
+# vLLM engine load (running and waiting requests, KV-cache usage, prefix-cache hit rate),
+# scraped from every replica's metrics path and used by routing, admission and degradation
+ENGINE_METRICS_ENABLED = os.getenv("ENGINE_METRICS_ENABLED", "true").lower() == "true"
+VLLM_METRICS_PATH = os.getenv("VLLM_METRICS_PATH", "/metrics")
+ENGINE_METRICS_INTERVAL_S = float(os.getenv("ENGINE_METRICS_INTERVAL_S", "2"))
+ENGINE_METRICS_TIMEOUT_S = float(os.getenv("ENGINE_METRICS_TIMEOUT_S", "1"))
+# Hedged requests: duplicate a request that is slower than this latency percentile to a second replica
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "false").lower() == "true"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+# Micro-batching (opt-in): concurrent /detoxify and /detoxify/batch requests for the same
+# (adapter, language) are sent as one /v1/completions call with a list of prompts, rendered
+# with the model's chat template here. A batch generates up to its largest max_tokens, only
+# stops on the stop sequences all its items share and reports token usage for the whole call
+# (split per item by length). A caller that goes away only aborts the call when it was the last.
+UPSTREAM_BATCHING_ENABLED = os.getenv("UPSTREAM_BATCHING_ENABLED", "false").lower() == "true"
+BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", "5"))
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "32"))
+# Bulk /detoxify/batch endpoint
+BATCH_ENDPOINT_MAX_ITEMS = int(os.getenv("BATCH_ENDPOINT_MAX_ITEMS", "1000"))
+BATCH_ENDPOINT_CONCURRENCY = int(os.getenv("BATCH_ENDPOINT_CONCURRENCY", "64"))
+# Decoding. Deterministic (greedy) decoding makes cached results reproducible.
+DETERMINISTIC_DECODING = os.getenv("DETERMINISTIC_DECODING", "false").lower() == "true"
+GENERATION_TEMPERATURE = 0.0 if DETERMINISTIC_DECODING else 1.0
+# Output budget: max_tokens from input length per language, plus stop sequences after the neutral-text line
+OUTPUT_BUDGET_ENABLED = os.getenv("OUTPUT_BUDGET_ENABLED", "true").lower() == "true"
+# Per-language completion tokens per input character overrides, e.g. "zh=2.2,en=0.45"
+OUTPUT_TOKENS_PER_CHAR = os.getenv("OUTPUT_TOKENS_PER_CHAR", "")
+OUTPUT_BUDGET_HEADROOM = float(os.getenv("OUTPUT_BUDGET_HEADROOM", "1.5"))
+OUTPUT_BUDGET_MIN_TOKENS = int(os.getenv("OUTPUT_BUDGET_MIN_TOKENS", "48"))
+OUTPUT_BUDGET_MAX_TOKENS = int(os.getenv("OUTPUT_BUDGET_MAX_TOKENS", "500"))
+OUTPUT_BUDGET_LEARN = os.getenv("OUTPUT_BUDGET_LEARN", "true").lower() == "true"
+OUTPUT_STOP_SEQUENCES_ENABLED = os.getenv("OUTPUT_STOP_SEQUENCES_ENABLED", "true").lower() == "true"
+# Exact-match result cache. On by default only with deterministic decoding: with sampling
+# (temperature 1.0) it would serve one random sample per input for the whole TTL.
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", str(DETERMINISTIC_DECODING)).lower() == "true"
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "10000"))
+RESULT_CACHE_TTL_S = float(os.getenv("RESULT_CACHE_TTL_S", "3600"))
+# Shared second-tier cache: "none", "sqlite" (all workers on a host) or "redis" (all nodes)
+RESULT_CACHE_BACKEND = os.getenv("RESULT_CACHE_BACKEND", "none").lower()
+RESULT_CACHE_SQLITE_PATH = os.getenv("RESULT_CACHE_SQLITE_PATH", "/tmp/detox_result_cache.sqlite3")
+RESULT_CACHE_REDIS_URL = os.getenv("RESULT_CACHE_REDIS_URL", "redis://localhost:6379/0")
+# Lexicon pre-filter: skip the LLM for inputs with no lexicon match (opt-in)
+LEXICON_PREFILTER_ENABLED = os.getenv("LEXICON_PREFILTER_ENABLED", "false").lower() == "true"
+# Comma-separated language ids allowed to bypass; empty means all languages
+LEXICON_PREFILTER_LANGUAGES = os.getenv("LEXICON_PREFILTER_LANGUAGES", "")
+LEXICON_PREFILTER_MAX_TEXT_LENGTH = int(os.getenv("LEXICON_PREFILTER_MAX_TEXT_LENGTH", "500"))
+LEXICON_PREFILTER_AUDIT_RATE = float(os.getenv("LEXICON_PREFILTER_AUDIT_RATE", "0"))
+# Degradation to the lexicon baseline (opt-in): under overload (with hysteresis), or when
+# a request's latency budget is below the expected LLM latency, the request is answered by
+# the word-deletion baseline instead of the model. Such results carry "degraded": true,
+# "degraded_reason" ("overload" or "latency_budget") and model_used "lexicon-baseline".
+DEGRADE_ENABLED = os.getenv("DEGRADE_ENABLED", "false").lower() == "true"
+DEGRADE_ENTER_INFLIGHT = int(os.getenv("DEGRADE_ENTER_INFLIGHT", "256"))
+DEGRADE_EXIT_INFLIGHT = int(os.getenv("DEGRADE_EXIT_INFLIGHT", "192"))
+DEGRADE_ENTER_QUEUE_DEPTH = int(os.getenv("DEGRADE_ENTER_QUEUE_DEPTH", "512"))
+DEGRADE_EXIT_QUEUE_DEPTH = int(os.getenv("DEGRADE_EXIT_QUEUE_DEPTH", "256"))
+# Adaptive admission control in front of the upstream call ("gradient" or "aimd")
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "true").lower() == "true"
+ADMISSION_ALGORITHM = os.getenv("ADMISSION_ALGORITHM", "gradient").lower()
+ADMISSION_INITIAL_LIMIT = int(os.getenv("ADMISSION_INITIAL_LIMIT", "64"))
+ADMISSION_MIN_LIMIT = int(os.getenv("ADMISSION_MIN_LIMIT", "8"))
+ADMISSION_MAX_LIMIT = int(os.getenv("ADMISSION_MAX_LIMIT", "512"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "256"))
+ADMISSION_QUEUE_TIMEOUT_MS = float(os.getenv("ADMISSION_QUEUE_TIMEOUT_MS", "2000"))
+# The admission limit stops growing while more requests than this wait inside vLLM
+ADMISSION_ENGINE_MAX_WAITING = int(os.getenv("ADMISSION_ENGINE_MAX_WAITING", "8"))
+# Weighted fair scheduling of the admission queue by (priority, tenant, language).
+# Priority comes from the x-priority header (interactive or batch; /detoxify/batch
+# defaults to batch), the tenant from x-tenant-id or the API key.
+SCHED_INTERACTIVE_WEIGHT = float(os.getenv("SCHED_INTERACTIVE_WEIGHT", "4"))
+SCHED_BATCH_WEIGHT = float(os.getenv("SCHED_BATCH_WEIGHT", "1"))
+# Per-tenant weights, e.g. "acme=2,backfill=0.5"
+SCHED_TENANT_WEIGHTS = os.getenv("SCHED_TENANT_WEIGHTS", "")
+# Share of the admission limit that only interactive requests may use
+SCHED_INTERACTIVE_RESERVED_FRACTION = float(os.getenv("SCHED_INTERACTIVE_RESERVED_FRACTION", "0.25"))
+# Request header carrying the client's latency budget in milliseconds. It is also the
+# request's deadline: past it the upstream generation is aborted (as on client disconnect).
+LATENCY_BUDGET_HEADER = "x-latency-budget-ms"
+# Deadline of requests without a latency budget, and the longest budget accepted; 0 disables it
+REQUEST_DEADLINE_MS = float(os.getenv("REQUEST_DEADLINE_MS", "60000"))
+# Inference log policy: errors, parse failures and slow requests are always
+# logged, other successes are sampled per language. Exact counts are kept in
+# per-window aggregate records.
+LOG_SUCCESS_SAMPLE_RATE = float(os.getenv("LOG_SUCCESS_SAMPLE_RATE", "1.0"))
+# Per-language overrides, e.g. "en=0.05,de=0.2"
+LOG_LANGUAGE_SAMPLE_RATES = os.getenv("LOG_LANGUAGE_SAMPLE_RATES", "")
+LOG_SLOW_THRESHOLD_MS = float(os.getenv("LOG_SLOW_THRESHOLD_MS", "2000"))
+LOG_SLIM_PAYLOAD = os.getenv("LOG_SLIM_PAYLOAD", "false").lower() == "true"
+LOG_AGGREGATE_INTERVAL_S = float(os.getenv("LOG_AGGREGATE_INTERVAL_S", "60"))
+# Request tracing: an incoming W3C traceparent is continued (or a trace started) and its
+# ids are set on every log record. Sampled requests, by TRACE_SAMPLE_RATE or a sampled
+# traceparent, also record per-stage spans, answer with a Server-Timing header and log
+# one trace record.
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "true").lower() == "true"
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+# Bumped manually when the LoRA adapters are replaced behind the same name
+ADAPTER_VERSION = os.getenv("ADAPTER_VERSION", "v1")
 GCP_PROJECT_ID = os.getenv("GCP_PROJECT_ID", "your-gcp-project-id")
+# Toxic lexicon compiled at build time (python lexicon.py compile). Without it the
+# lexicon is downloaded from Hugging Face at startup.
+COMPILED_LEXICON_PATH = os.getenv("COMPILED_LEXICON_PATH", "/opt/detox/toxic_lexicon.bin")
 
 # Log names for Google Cloud Logging
 INFERENCE_LOG_NAME = "llm-detox-inference-logs"
@@ -37,185 +175,917 @@ INFERENCE_LOG_NAME = "llm-detox-inference-logs"
 inference_logger = setup_cloud_logging(
     gcp_project_id=GCP_PROJECT_ID,
     inference_log_name=INFERENCE_LOG_NAME,
+    batched=os.getenv("LOG_BATCHING_ENABLED", "true").lower() == "true",
+    max_queue_size=int(os.getenv("LOG_QUEUE_SIZE", "10000")),
+    batch_size=int(os.getenv("LOG_BATCH_SIZE", "500")),
+    flush_interval_s=float(os.getenv("LOG_FLUSH_INTERVAL_S", "1")),
+    overflow_policy=os.getenv("LOG_OVERFLOW_POLICY", "drop_newest"),
 )
+# Only formatter-based handlers reuse the serialized response for the log record;
+# with the batched handler building it would be wasted work
+LOG_RAW_PAYLOAD = formats_raw_payload(inference_logger)
 
 
 
 
-class TextSanitizationMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
-        if request.method == "POST" and request.url.path == "/detoxify":
-            try:
-                body = await request.json()
-            except json.JSONDecodeError:
-                return JSONResponse(
-                    status_code=400,
-                    content={"detail": "Invalid JSON format in request body."}
-                )
+# Single-item endpoints whose body is checked by TextSanitizationMiddleware
+GUARDED_PATHS = {"/detoxify", "/detoxify/stream"}
+# Optional JSON file of per-language forbidden patterns, reloaded in the background when it changes
+FORBIDDEN_PATTERNS_PATH = os.getenv("FORBIDDEN_PATTERNS_PATH")
+FORBIDDEN_PATTERNS_RELOAD_S = float(os.getenv("FORBIDDEN_PATTERNS_RELOAD_S", "5"))
 
-            if not isinstance(body.get("text"), str) or not isinstance(body.get("language_id"), str):
-                # Debug logging to understand what we're receiving
-                text_value = body.get("text")
-                language_id_value = body.get("language_id")
-                
-                inference_logger.warning(
-                    "Invalid request format",
-                    extra={"json_payload": {
-                        "request_id": getattr(request.state, 'request_id', 'unknown'), 
-                        "received_body": body,
-                        "text_type": type(text_value).__name__,
-                        "text_value": text_value,
-                        "language_id_type": type(language_id_value).__name__,
-                        "language_id_value": language_id_value
-                    }}
-                )
-                return JSONResponse(
-                    status_code=400,
-                    content={
-                        "detail": "Invalid request format.", 
-                        "error": f"text must be string (got {type(text_value).__name__}), language_id must be string (got {type(language_id_value).__name__})"
-                    }
-                )
+if FORBIDDEN_PATTERNS_PATH:
+    forbidden_patterns = ForbiddenPatternEngine(
+        patterns={"*": FORBIDDEN_KEYWORDS},
+        path=FORBIDDEN_PATTERNS_PATH,
+        reload_interval_s=FORBIDDEN_PATTERNS_RELOAD_S,
+    )
+else:
+    forbidden_patterns = default_pattern_engine
 
-            forbidden_keywords = ["prompt", "secret", "token", "password"]
-            if any(keyword in body.get("text", "").lower() for keyword in forbidden_keywords):
-                inference_logger.warning(
-                    "Forbidden keyword detected in request",
-                    extra={"json_payload": {"request_id": getattr(request.state, 'request_id', 'unknown'), "text_preview": body.get("text", "")[:100]}}
-                )
-                return JSONResponse(
-                    status_code=400,
-                    content={"detail": "Query contains forbidden content."}
-                )
+output_budget = OutputBudgetPolicy(
+    tokens_per_char={
+        lang.strip(): float(ratio)
+        for lang, ratio in (item.split("=", 1) for item in OUTPUT_TOKENS_PER_CHAR.split(",") if "=" in item)
+    },
+    headroom=OUTPUT_BUDGET_HEADROOM,
+    min_tokens=OUTPUT_BUDGET_MIN_TOKENS,
+    max_tokens=OUTPUT_BUDGET_MAX_TOKENS,
+    learn=OUTPUT_BUDGET_LEARN,
+    stop_sequences=OUTPUT_STOP_SEQUENCES_ENABLED,
+) if OUTPUT_BUDGET_ENABLED else None
 
-            if len(body.get("text", "")) > 500:
-                inference_logger.warning(
-                    "Query too long",
-                    extra={"json_payload": {"request_id": getattr(request.state, 'request_id', 'unknown'), "text_length": len(body.get("text", ""))}}
-                )
-                return JSONResponse(
-                    status_code=400,
-                    content={"detail": "Query is too long."}
-                )
+def get_generation_params(input_text: str, language_id: str) -> dict:
+    """
+    max_tokens (and stop sequences) for one generation.
+    """
+    if output_budget is None:
+        return {"max_tokens": 500}
+    return output_budget.generation_params(input_text, language_id)
+
+def record_generation_end(input_text: str, language_id: str, model_name: str, generation_params: dict, usage, finish_reason, stop_reason=None):
+    if usage:
+        record_tokens(language_id, model_name, usage.prompt_tokens, usage.completion_tokens)
+    if output_budget is not None:
+        output_budget.record(
+            input_text, language_id, generation_params["max_tokens"],
+            usage.completion_tokens if usage else 0, finish_reason, stop_reason,
+        )
+
+def record_generation_cancelled(input_text: str, language_id: str, generation_params: dict, generated_tokens: int = 0):
+    """
+    Count an upstream generation aborted before it finished and the completion tokens it would still have cost.
+    """
+    expected = generation_params["max_tokens"]
+    if output_budget is not None:
+        expected = min(expected, output_budget.expected_tokens(input_text, language_id))
+    metrics.upstream_cancelled_total.labels(language=language_id).inc()
+    metrics.cancelled_tokens_saved_total.inc(max(0.0, expected - generated_tokens))
 
-        response = await call_next(request)
-        return response
+def log_detox_error(message: str, request_id: str, input_text: str, language_id: str, model_name: str, error: Exception):
+    """
+    Count a failed request and log it with its traceback. Errors are always logged.
+    """
+    log_policy.admit_error(language_id, input_text)
+    inference_logger.error(
+        message,
+        exc_info=True,
+        extra={
+            "json_payload": {
+                "request_id": request_id,
+                "input_text": input_text,
+                "language_id": language_id,
+                "error_type": error.__class__.__name__,
+                "error_message": str(error),
+                "model_used": model_name,
+            }
+        }
+    )
+
+def record_parse_status(language_id: str, model_name: str, status: str, output_text: str):
+    metrics.output_parse_total.labels(language=language_id, adapter=model_name, status=status).inc()
+    if status not in USABLE_STATUSES:
+        logging.warning(f"Unparseable model output ({status}) for language {language_id}: {output_text!r}")
+
+async def create_completion(model_name: str, language_id: str, messages: list[dict], generation_params: dict):
+    """
+    Send one chat request through the replica router (with hedging if enabled).
+    """
+    response, _ = await router.call(
+        model_name, language_id,
+        lambda replica: replica.client.chat.completions.create(
+            model=model_name,
+            messages=messages,
+            temperature=GENERATION_TEMPERATURE,
+            timeout=VLLM_REQUEST_TIMEOUT_S,
+            **generation_params,
+        ),
+    )
+    return response
+
+async def submit_generation_batch(key: tuple[str, str], batch: list[tuple[list[dict], dict]]) -> list:
+    """
+    Send one micro-batch of (messages, generation_params) for a single (adapter, language)
+    as one multi-prompt completion through the replica router.
+    """
+    model_name, language_id = key
+    prompts = [render_chat_prompt(messages) for messages, _ in batch]
+    generation_params = merge_generation_params([params for _, params in batch])
+    response, _ = await router.call(
+        model_name, language_id,
+        lambda replica: replica.client.completions.create(
+            model=model_name,
+            prompt=prompts,
+            temperature=GENERATION_TEMPERATURE,
+            timeout=VLLM_REQUEST_TIMEOUT_S,
+            **generation_params,
+        ),
+    )
+    return split_completion_batch(response, prompts)
 
 # Use lifespan event handler for app startup and shutdown
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     global detoxify_baseline
-    global openai_client
+    global router
+    global dispatcher
+    global result_cache
+    global degradation
+    global admission
+    global engine_poller
 
-    # Initialize detoxification baseline
-    detoxify_baseline = delete_baseline()
+    # Initialize detoxification baseline; the compiled lexicon is only mapped on first use
+    if os.path.exists(COMPILED_LEXICON_PATH):
+        detoxify_baseline = delete_baseline(compiled_lexicon_path=COMPILED_LEXICON_PATH)
+    else:
+        logging.warning(f"No compiled lexicon at {COMPILED_LEXICON_PATH}, loading the lexicon from Hugging Face.")
+        detoxify_baseline = delete_baseline()
 
-    # Initialize OpenAI client for vLLM
+    # Recompile the forbidden patterns off the request path when their file changes
+    forbidden_patterns.start()
+
+    # Initialize a non-blocking OpenAI client with a pooled connection set per vLLM replica
     openai_api_key = os.getenv('vLLM_KEY',"NONE")
-    openai_client = OpenAI(
-        api_key=openai_api_key,
-        base_url=f"http://{VLLM_API_BASE_URL}:8000/v1",
+    replicas = []
+    for address in VLLM_REPLICAS:
+        base_url = address if "://" in address else f"http://{address}"
+        replicas.append(Replica(
+            name=address.split("://")[-1],
+            base_url=base_url,
+            client=create_async_client(
+                base_url=f"{base_url.rstrip('/')}/v1",
+                api_key=openai_api_key,
+                pool_size=VLLM_POOL_SIZE,
+                keepalive_connections=VLLM_KEEPALIVE_CONNECTIONS,
+                request_timeout_s=VLLM_REQUEST_TIMEOUT_S,
+                connect_timeout_s=VLLM_CONNECT_TIMEOUT_S,
+            ),
+        ))
+    router = ReplicaRouter(
+        replicas,
+        policy=ROUTER_POLICY,
+        virtual_nodes=ROUTER_VIRTUAL_NODES,
+        max_outstanding=ROUTER_MAX_OUTSTANDING,
+        max_engine_waiting=ROUTER_MAX_ENGINE_WAITING if ENGINE_METRICS_ENABLED else 0,
+        probe_interval_s=ROUTER_PROBE_INTERVAL_S,
+        unhealthy_threshold=ROUTER_UNHEALTHY_THRESHOLD,
+        breaker_failure_threshold=BREAKER_FAILURE_THRESHOLD,
+        breaker_cooldown_s=BREAKER_COOLDOWN_S,
+        hedge_enabled=HEDGE_ENABLED,
+        hedge_percentile=HEDGE_PERCENTILE,
+    )
+    router.start()
+
+    engine_poller = EngineMetricsPoller(
+        replicas,
+        interval_s=ENGINE_METRICS_INTERVAL_S,
+        timeout_s=ENGINE_METRICS_TIMEOUT_S,
+        path=VLLM_METRICS_PATH,
+    )
+    if ENGINE_METRICS_ENABLED:
+        engine_poller.start()
+
+    # Group concurrent requests per (adapter, language) into one upstream call
+    dispatcher = MicroBatchDispatcher(
+        submit_generation_batch,
+        max_wait_ms=BATCH_MAX_WAIT_MS,
+        max_batch_size=BATCH_MAX_SIZE,
+    ) if UPSTREAM_BATCHING_ENABLED else None
+
+    admission = AdaptiveAdmissionController(
+        initial_limit=ADMISSION_INITIAL_LIMIT,
+        min_limit=ADMISSION_MIN_LIMIT,
+        max_limit=ADMISSION_MAX_LIMIT,
+        max_queue_size=ADMISSION_MAX_QUEUE,
+        queue_timeout_s=ADMISSION_QUEUE_TIMEOUT_MS / 1000,
+        algorithm=ADMISSION_ALGORITHM,
+        priority_weights={INTERACTIVE: SCHED_INTERACTIVE_WEIGHT, BATCH: SCHED_BATCH_WEIGHT},
+        tenant_weights={
+            tenant.strip(): float(weight)
+            for tenant, weight in (item.split("=", 1) for item in SCHED_TENANT_WEIGHTS.split(",") if "=" in item)
+        },
+        interactive_reserved_fraction=SCHED_INTERACTIVE_RESERVED_FRACTION,
+        engine_waiting_fn=engine_poller.total_waiting,
+        engine_max_waiting=ADMISSION_ENGINE_MAX_WAITING,
+    ) if ADMISSION_ENABLED else None
+
+    degradation = DegradationController(
+        enter_inflight=DEGRADE_ENTER_INFLIGHT,
+        exit_inflight=DEGRADE_EXIT_INFLIGHT,
+        enter_queue_depth=DEGRADE_ENTER_QUEUE_DEPTH,
+        exit_queue_depth=DEGRADE_EXIT_QUEUE_DEPTH,
+        # Requests waiting in this worker plus those queued inside vLLM from every worker
+        queue_depth_fn=lambda: (
+            (dispatcher.queue_depth() if dispatcher else 0)
+            + (admission.queue_length() if admission else 0)
+            + engine_poller.total_waiting()
+        ),
     )
 
+    result_cache = None
+    if RESULT_CACHE_ENABLED:
+        if RESULT_CACHE_BACKEND == "sqlite":
+            cache_backend = SQLiteCacheBackend(RESULT_CACHE_SQLITE_PATH)
+        elif RESULT_CACHE_BACKEND == "redis":
+            cache_backend = RedisCacheBackend(RESULT_CACHE_REDIS_URL)
+        else:
+            cache_backend = None
+        result_cache = TieredDetoxCache(
+            DetoxResultCache(max_entries=RESULT_CACHE_MAX_ENTRIES, ttl_s=RESULT_CACHE_TTL_S),
+            backend=cache_backend,
+        )
+        result_cache.start()
+
+    aggregates_task = asyncio.create_task(emit_log_aggregates_periodically())
+
     yield
 
-    logging.info("FastAPI application shutting down. Flushing logs...")
+    logging.info("FastAPI application shutting down. Closing upstream connections...")
+    aggregates_task.cancel()
+    await forbidden_patterns.close()
+    if dispatcher is not None:
+        await dispatcher.close()
+    await engine_poller.close()
+    if result_cache is not None:
+        await result_cache.close()
+    await router.close()
+    logging.info("Flushing logs...")
+    emit_log_aggregates()
     flush_cloud_loggers([inference_logger]) # Use the new flush function
     logging.info("Logs flushed. FastAPI application shut down.")
 
+# In-flight request coalescing, keyed like the result cache
+inflight_requests = SingleFlight()
+
+log_policy = InferenceLogPolicy(
+    success_sample_rate=LOG_SUCCESS_SAMPLE_RATE,
+    language_sample_rates={
+        lang.strip(): float(rate)
+        for lang, rate in (item.split("=", 1) for item in LOG_LANGUAGE_SAMPLE_RATES.split(",") if "=" in item)
+    },
+    slow_threshold_ms=LOG_SLOW_THRESHOLD_MS,
+    slim_payload=LOG_SLIM_PAYLOAD,
+)
+
+def emit_log_aggregates():
+    aggregates = log_policy.pop_aggregates()
+    if aggregates is not None:
+        inference_logger.info("Detoxification Aggregate", extra={"json_payload": aggregates})
+
+async def emit_log_aggregates_periodically():
+    while True:
+        await asyncio.sleep(LOG_AGGREGATE_INTERVAL_S)
+        emit_log_aggregates()
+
+prefilter_policy = LexiconPrefilterPolicy(
+    languages={lang.strip() for lang in LEXICON_PREFILTER_LANGUAGES.split(",") if lang.strip()} or None,
+    max_text_length=LEXICON_PREFILTER_MAX_TEXT_LENGTH,
+    audit_rate=LEXICON_PREFILTER_AUDIT_RATE,
+) if LEXICON_PREFILTER_ENABLED else None
+
 # Define the app with the lifespan handler and middlewares
-app = FastAPI(lifespan=lifespan)
-app.add_middleware(TextSanitizationMiddleware)
+app = FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
+app.add_middleware(
+    TextSanitizationMiddleware,
+    logger=inference_logger,
+    guarded_paths=GUARDED_PATHS,
+    pattern_engine=forbidden_patterns,
+)
+# Added after the guard so it wraps it and counts its 4xx rejections too
+app.add_middleware(RequestMetricsMiddleware, paths={"/detoxify", "/detoxify/stream", "/detoxify/batch"})
+if TRACING_ENABLED:
+    # Outermost, so that the guard's log records carry the trace ids as well
+    install_log_record_factory()
+    app.add_middleware(
+        TracingMiddleware,
+        paths={"/detoxify", "/detoxify/stream", "/detoxify/batch"},
+        sample_rate=TRACE_SAMPLE_RATE,
+        logger=inference_logger,
+    )
 
 # Schema for detoxification request
 class DetoxificationRequest(BaseModel):
     text: str
     language_id: str
 
+# Schema for bulk detoxification request. Items are validated one by one so
+# that a bad item is reported in place instead of failing the whole batch.
+class DetoxificationBatchRequest(BaseModel):
+    items: list[Any]
+
+# The guard parses the body once; endpoints read it from request.state instead
+# of letting FastAPI parse it again. The schema is still published in OpenAPI.
+DETOX_REQUEST_OPENAPI = {
+    "requestBody": {
+        "required": True,
+        "content": {"application/json": {"schema": DetoxificationRequest.model_json_schema()}},
+    }
+}
+
+async def read_detox_request(http_request: Request) -> DetoxificationRequest:
+    body = getattr(http_request.state, PARSED_BODY_STATE_KEY, None)
+    if body is not None:
+        # Already type-checked by TextSanitizationMiddleware
+        return DetoxificationRequest.model_construct(text=body["text"], language_id=body["language_id"])
+    try:
+        return DetoxificationRequest.model_validate(await http_request.json())
+    except (ValueError, ValidationError) as e:
+        raise HTTPException(status_code=400, detail="Invalid request format.") from e
+
+def observe_guard_stage(http_request: Request, language_id: str, model_name: str):
+    # The guard runs before the language is known; its timing waits in request.state.
+    # Its trace span was recorded by the guard itself.
+    guard_seconds = getattr(http_request.state, GUARD_SECONDS_STATE_KEY, None)
+    if guard_seconds is not None:
+        observe_stage(GUARD, language_id, model_name, guard_seconds, span=False)
+
+def get_model_name(language_id: str) -> str:
+    if language_id in ['fr','it','hin','ja','tt','he']:
+        return "unseen-language"
+    return "seen-language"
+
+async def generate_detoxification(
+    input_text: str,
+    language_id: str,
+    model_name: str,
+    deadline: Optional[float] = None,
+    flow: Optional[Flow] = None,
+) -> dict:
+    """
+    Call the model through admission control and the micro-batching dispatcher (or
+    directly through the replica router), and parse its output.
+    `deadline` (time.monotonic() seconds) bounds the wait for an admission slot and
+    `flow` is the request's scheduling class.
+    """
+    with stage_timer(PROMPT_BUILD, language_id, model_name):
+        messages = get_messages(input_text, language_id)
+        generation_params = get_generation_params(input_text, language_id)
+
+    with stage_timer(UPSTREAM, language_id, model_name):
+        async with admission_slot(deadline, flow or (INTERACTIVE, DEFAULT_TENANT, language_id)):
+            with degradation.track():
+                try:
+                    if dispatcher is not None:
+                        generation = await dispatcher.submit((model_name, language_id), (messages, generation_params))
+                    else:
+                        generation = from_chat_completion(
+                            await create_completion(model_name, language_id, messages, generation_params)
+                        )
+                except asyncio.CancelledError:
+                    # Every waiter is gone: the router (or the dispatcher, once the whole
+                    # batch is gone) aborts the upstream request
+                    record_generation_cancelled(input_text, language_id, generation_params)
+                    raise
+
+    usage = generation.usage
+    record_generation_end(
+        input_text, language_id, model_name, generation_params, usage,
+        generation.finish_reason, generation.stop_reason,
+    )
+    output_text = generation.text
+    with stage_timer(PARSE, language_id, model_name):
+        parsed_output = parse_detoxified_output(output_text, language_id)
+    record_parse_status(language_id, model_name, parsed_output["status"], output_text)
+
+    return {"actual_model_id": generation.model,
+            "detoxified_text": parsed_output['neutral_text'],
+            "toxicity_terms_detected": parsed_output['toxic_words'],
+            "prompt_tokens": usage.prompt_tokens if usage else 0,
+            "completion_tokens": usage.completion_tokens if usage else 0,
+            "total_tokens": usage.total_tokens if usage else 0,
+            "parse_status": parsed_output["status"],
+        }
+
+def build_result(input_text: str, language_id: str, model_name: str, start_time: float, generation: dict, **flags) -> dict:
+    """
+    Build the result record shared by the response body and the inference log.
+    """
+    return {"input_text": input_text,
+            "language_id": language_id,
+            "model_used": model_name,
+            "actual_model_id": generation["actual_model_id"],
+            "detoxified_text": generation["detoxified_text"],
+            "toxicity_terms_detected": generation["toxicity_terms_detected"],
+            "latency_ms": (time.perf_counter() - start_time) * 1000,
+            "prompt_tokens": generation.get("prompt_tokens", 0),
+            "completion_tokens": generation.get("completion_tokens", 0),
+            "total_tokens": generation.get("total_tokens", 0),
+            "cache_hit": flags.get("cache_hit", False),
+            "coalesced": flags.get("coalesced", False),
+            "prefilter_bypass": flags.get("prefilter_bypass", False),
+            "degraded": flags.get("degraded", False),
+            "degraded_reason": flags.get("degraded_reason"),
+        }
+
+def admission_slot(deadline: Optional[float], flow: Flow):
+    return admission.slot(deadline, flow) if admission is not None else nullcontext()
+
+def get_deadline(start_time: float, latency_budget_ms: Optional[float]) -> Optional[float]:
+    """
+    Convert a latency budget counted from `start_time` (perf_counter) into a time.monotonic() deadline.
+    Without a budget the server default applies (None if disabled).
+    """
+    if latency_budget_ms is None:
+        if REQUEST_DEADLINE_MS <= 0:
+            return None
+        latency_budget_ms = REQUEST_DEADLINE_MS
+    return time.monotonic() + latency_budget_ms / 1000 - (time.perf_counter() - start_time)
+
+def too_many_requests(e: AdmissionRejected) -> HTTPException:
+    return HTTPException(
+        status_code=429,
+        detail="Too many requests. Please retry later.",
+        headers={"Retry-After": str(e.retry_after_s)},
+    )
+
+def request_cancelled(e: RequestCancelled) -> HTTPException:
+    # 499 (client closed request) is only ever seen in access logs
+    if e.reason == DEADLINE:
+        return HTTPException(status_code=504, detail="Deadline exceeded.")
+    return HTTPException(status_code=499, detail="Client closed request.")
+
+def get_latency_budget_ms(http_request: Request) -> Optional[float]:
+    """
+    The client's latency budget, or None (the default budget) when the header is
+    missing or malformed: not a number, not finite (nan, inf) or not positive.
+    Budgets longer than the default deadline (e.g. 1e308) are capped at it.
+    """
+    value = http_request.headers.get(LATENCY_BUDGET_HEADER)
+    if value is None:
+        return None
+    try:
+        budget_ms = float(value)
+    except ValueError:
+        return None
+    if not math.isfinite(budget_ms) or budget_ms <= 0:
+        return None
+    return min(budget_ms, REQUEST_DEADLINE_MS) if REQUEST_DEADLINE_MS > 0 else budget_ms
+
+async def run_detoxification(
+    input_text: str,
+    language_id: str,
+    model_name: str,
+    start_time: float,
+    latency_budget_ms: Optional[float] = None,
+    flow: Optional[Flow] = None,
+    deadline: Optional[float] = None,
+) -> dict:
+    """
+    Run one detoxification (lexicon pre-filter, cache, degradation check,
+    then coalesced generation) and build its result record. `flow` is the
+    (priority, tenant, language) class used by the admission scheduler and
+    `deadline` (time.monotonic() seconds) bounds the wait for admission.
+    """
+    if prefilter_policy is not None and prefilter_policy.should_bypass(detoxify_baseline, input_text, language_id):
+        clean_text = {"actual_model_id": None, "detoxified_text": input_text, "toxicity_terms_detected": []}
+        return build_result(input_text, language_id, "lexicon-prefilter", start_time, clean_text, prefilter_bypass=True)
+
+    version = f"{prompt_version[language_id]}:{ADAPTER_VERSION}:t{GENERATION_TEMPERATURE}"
+    request_key = make_cache_key(input_text, language_id, model_name, version)
+
+    if result_cache is not None:
+        cached = await result_cache.get(request_key)
+        if cached is not None:
+            # Cache hits did not spend any tokens of their own
+            return build_result(input_text, language_id, model_name, start_time, cached, cache_hit=True)
+
+    # Under overload, or when the client cannot wait for the LLM, answer with the lexicon baseline
+    degraded_reason = degradation.should_degrade(latency_budget_ms) if DEGRADE_ENABLED else None
+    if degraded_reason is not None:
+        baseline_result = {
+            "actual_model_id": None,
+            "detoxified_text": detoxify_baseline.detoxify(input_text, language_id),
+            "toxicity_terms_detected": sorted(detoxify_baseline.find_toxic_terms(input_text, language_id)),
+        }
+        return build_result(
+            input_text, language_id, "lexicon-baseline", start_time, baseline_result,
+            degraded=True, degraded_reason=degraded_reason,
+        )
+
+    # Identical concurrent requests share one upstream generation
+    generation, coalesced = await inflight_requests.run(
+        request_key, lambda: generate_detoxification(input_text, language_id, model_name, deadline, flow)
+    )
+
+    if coalesced:
+        metrics.coalesced_tokens_saved_total.inc(generation["total_tokens"])
+        # Coalesced requests did not spend any tokens of their own
+        shared = {key: generation[key] for key in ("actual_model_id", "detoxified_text", "toxicity_terms_detected")}
+        return build_result(input_text, language_id, model_name, start_time, shared, coalesced=True)
+
+    # Parse failures are not cached so a retry gets a fresh generation
+    if result_cache is not None and generation["parse_status"] in USABLE_STATUSES:
+        result_cache.set(request_key, {
+            "actual_model_id": generation["actual_model_id"],
+            "detoxified_text": generation["detoxified_text"],
+            "toxicity_terms_detected": generation["toxicity_terms_detected"],
+        })
+
+    return build_result(input_text, language_id, model_name, start_time, generation)
+
 # Health check endpoint
 @app.get("/health")
 async def health_check():
     return {"status": "healthy", "timestamp": time.time()}
 
+# Prometheus metrics endpoint
+@app.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
 # Detoxification endpoint
-@app.post("/detoxify")
-async def detoxify(request: DetoxificationRequest):
+@app.post("/detoxify", openapi_extra=DETOX_REQUEST_OPENAPI)
+async def detoxify(http_request: Request):
     start_time = time.perf_counter()
+    request = await read_detox_request(http_request)
     input_text = request.text.strip()
     language_id = request.language_id.lower()
     request_id = os.urandom(8).hex()
+    model_name = get_model_name(language_id)
+    observe_guard_stage(http_request, language_id, model_name)
+    latency_budget_ms = get_latency_budget_ms(http_request)
+    deadline = get_deadline(start_time, latency_budget_ms)
     try:
-        messages = get_messages(input_text, language_id)
-        
-        if language_id in ['fr','it','hin','ja','tt','he']:
-            model_name = "unseen-language"
-        else:
-            model_name = "seen-language"
+        # Abort the generation if the client goes away or the deadline passes
+        result_dict = await run_cancellable(
+            run_detoxification(
+                input_text, language_id, model_name, start_time,
+                latency_budget_ms=latency_budget_ms,
+                flow=classify_request(http_request.headers, language_id),
+                deadline=deadline,
+            ),
+            http_request.receive, deadline, "detoxify",
+        )
+
+        # Serialize the result once for both the response body and the log record
+        result_json = dumps(result_dict)
+        with stage_timer(LOG_ENQUEUE, language_id, model_name):
+            log_payload = log_policy.admit_success(result_dict)
+            if log_payload is not None:
+                log_extra = {
+                    "json_payload": {
+                        "request_id": request_id,
+                        **log_payload,
+                    }
+                }
+                if LOG_RAW_PAYLOAD and log_payload.keys() >= result_dict.keys():
+                    extra_fields = {key: log_payload[key] for key in log_payload.keys() - result_dict.keys()}
+                    log_extra["json_payload_raw"] = merge_objects(
+                        dumps({"request_id": request_id, **extra_fields}), result_json
+                    )
+                inference_logger.info("Detoxification Inference Completed", extra=log_extra)
 
-        response = openai_client.chat.completions.create(
+        return Response(
+            content=b'{"status":"success","data":' + result_json + b'}',
+            media_type="application/json",
+            status_code=200
+        )
+    except AdmissionRejected as e:
+        raise too_many_requests(e)
+    except RequestCancelled as e:
+        raise request_cancelled(e)
+    except Exception as e:
+        log_detox_error(f"Detoxification error for request_id: {request_id}", request_id, input_text, language_id, model_name, e)
+        logging.error(f"Detoxification error for request_id {request_id}: {e}")
+        raise HTTPException(status_code=503, detail="Service is not available now. Please try again later.")
+
+# Streaming detoxification endpoint (newline-delimited JSON events)
+@app.post("/detoxify/stream", openapi_extra=DETOX_REQUEST_OPENAPI)
+async def detoxify_stream(http_request: Request):
+    start_time = time.perf_counter()
+    request = await read_detox_request(http_request)
+    input_text = request.text.strip()
+    language_id = request.language_id.lower()
+    request_id = os.urandom(8).hex()
+    model_name = get_model_name(language_id)
+    observe_guard_stage(http_request, language_id, model_name)
+    try:
+        with stage_timer(PROMPT_BUILD, language_id, model_name):
+            messages = get_messages(input_text, language_id)
+            generation_params = get_generation_params(input_text, language_id)
+    except Exception as e:
+        # e.g. an unknown language_id, answered like /detoxify does before anything is acquired
+        log_detox_error(f"Detoxification stream error for request_id: {request_id}", request_id, input_text, language_id, model_name, e)
+        raise HTTPException(status_code=503, detail="Service is not available now. Please try again later.")
+
+    async def open_stream(replica):
+        # Waiting for the first chunk here lets the router hedge a replica that is slow to start
+        stream = await replica.client.chat.completions.create(
             model=model_name,
             messages=messages,
-            max_tokens=500,
-            temperature=1
+            temperature=GENERATION_TEMPERATURE,
+            stream=True,
+            stream_options={"include_usage": True},
+            timeout=VLLM_REQUEST_TIMEOUT_S,
+            **generation_params,
         )
-        
-        output_text = response.choices[0].message.content
-        parsed_output = parse_detoxified_output(output_text, language_id)
+        try:
+            return stream, await stream.__anext__()
+        except StopAsyncIteration:
+            return stream, None
+        except BaseException:
+            await stream.close()
+            raise
 
-        prompt_tokens = response.usage.prompt_tokens if response.usage else 0
-        completion_tokens = response.usage.completion_tokens if response.usage else 0
-        total_tokens = response.usage.total_tokens if response.usage else 0
-        model_id_from_response = response.model
+    async def close_stream(opened):
+        await opened[0].close()
 
-        end_time = time.perf_counter()
-        latency_ms = (end_time - start_time) * 1000
+    # The admission slot, like the replica, is held until the stream is finished
+    flow = classify_request(http_request.headers, language_id)
+    deadline = get_deadline(start_time, get_latency_budget_ms(http_request))
+    queue_start_time = time.perf_counter()
+    if admission is not None:
+        try:
+            await admission.acquire(deadline, flow)
+        except AdmissionRejected as e:
+            raise too_many_requests(e)
+    upstream_start_time = time.perf_counter()
+    try:
+        (stream, first_chunk), replica = await run_cancellable(
+            router.call(
+                model_name, language_id, open_stream,
+                latency_class="first_token", hold=True, discard=close_stream,
+            ),
+            http_request.receive, deadline, "detoxify_stream",
+        )
+    except RequestCancelled as e:
+        if admission is not None:
+            admission.release(priority=flow[0])
+        record_generation_cancelled(input_text, language_id, generation_params)
+        raise request_cancelled(e)
+    except asyncio.CancelledError:
+        if admission is not None:
+            admission.release(priority=flow[0])
+        raise
+    except Exception as e:
+        if admission is not None:
+            admission.release(failed=True, priority=flow[0])
+        logging.error(f"Detoxification stream error for request_id {request_id}: {e}")
+        raise HTTPException(status_code=503, detail="Service is not available now. Please try again later.")
 
-        result_dict = {"input_text": input_text,
+    # From here the upstream stream, the replica and the admission slot are held until
+    # release(), which runs once the body is finished or the response is abandoned
+    body_started = False
+    released = False
+    # Only a fully read stream feeds its latency into the admission limit
+    upstream_latency_s = None
+    upstream_failed = False
+
+    async def release():
+        nonlocal released
+        if released:
+            return
+        released = True
+        if not body_started:
+            # The client went away (or sending failed) before the body started
+            metrics.requests_cancelled_total.labels(endpoint="detoxify_stream", reason=CLIENT_DISCONNECT).inc()
+            record_generation_cancelled(input_text, language_id, generation_params)
+        try:
+            # Closing the upstream stream lets vLLM free the sequence if the client went away
+            await stream.close()
+        finally:
+            router.release(replica)
+            if admission is not None:
+                admission.release(upstream_latency_s, failed=upstream_failed, priority=flow[0])
+
+    async def event_stream():
+        nonlocal body_started, upstream_latency_s, upstream_failed
+        body_started = True
+        parser = IncrementalOutputParser(language_id)
+        content_chunks = 0
+        first_token_time = None
+        usage = None
+        model_id_from_response = None
+        finish_reason = stop_reason = None
+
+        async def chunks():
+            if first_chunk is not None:
+                yield first_chunk
+            while True:
+                # Every wait for the next chunk is bounded by the request deadline
+                timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+                try:
+                    yield await asyncio.wait_for(stream.__anext__(), timeout)
+                except StopAsyncIteration:
+                    return
+
+        try:
+            async for chunk in chunks():
+                model_id_from_response = chunk.model
+                if chunk.usage:
+                    usage = chunk.usage
+                if chunk.choices and chunk.choices[0].finish_reason:
+                    finish_reason = chunk.choices[0].finish_reason
+                    stop_reason = getattr(chunk.choices[0], "stop_reason", None)
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                if first_token_time is None:
+                    first_token_time = time.perf_counter()
+                delta = chunk.choices[0].delta.content
+                content_chunks += 1
+                for event in parser.feed(delta):
+                    yield dumps(event) + b"\n"
+
+            stream_end_time = time.perf_counter()
+            upstream_latency_s = stream_end_time - upstream_start_time
+            observe_stage(UPSTREAM, language_id, model_name, stream_end_time - queue_start_time)
+            record_generation_end(input_text, language_id, model_name, generation_params, usage, finish_reason, stop_reason)
+            with stage_timer(PARSE, language_id, model_name):
+                parsed_output = parser.result()
+            record_parse_status(language_id, model_name, parsed_output["status"], parser.buffer)
+            end_time = time.perf_counter()
+            result_dict = {"input_text": input_text,
                     "language_id": language_id,
                     "model_used": model_name,
                     "actual_model_id": model_id_from_response,
                     "detoxified_text": parsed_output['neutral_text'],
                     "toxicity_terms_detected": parsed_output['toxic_words'],
-                    "latency_ms": latency_ms,
-                    "prompt_tokens": prompt_tokens,
-                    "completion_tokens": completion_tokens,
-                    "total_tokens": total_tokens,
+                    "latency_ms": (end_time - start_time) * 1000,
+                    "ttft_ms": (first_token_time - start_time) * 1000 if first_token_time else None,
+                    "prompt_tokens": usage.prompt_tokens if usage else 0,
+                    "completion_tokens": usage.completion_tokens if usage else 0,
+                    "total_tokens": usage.total_tokens if usage else 0,
                 }
+            with stage_timer(LOG_ENQUEUE, language_id, model_name):
+                log_payload = log_policy.admit_success(result_dict)
+                if log_payload is not None:
+                    inference_logger.info(
+                        "Detoxification Stream Completed",
+                        extra={"json_payload": {"request_id": request_id, **log_payload}}
+                    )
+            yield dumps({"event": "done", "status": "success", "data": result_dict}) + b"\n"
+        except asyncio.TimeoutError:
+            metrics.requests_cancelled_total.labels(endpoint="detoxify_stream", reason=DEADLINE).inc()
+            record_generation_cancelled(input_text, language_id, generation_params, content_chunks)
+            yield dumps({"event": "error", "detail": "Deadline exceeded."}) + b"\n"
+        except (asyncio.CancelledError, GeneratorExit):
+            # The client went away mid-stream (not just before reading the final event)
+            if upstream_latency_s is None:
+                metrics.requests_cancelled_total.labels(endpoint="detoxify_stream", reason=CLIENT_DISCONNECT).inc()
+                record_generation_cancelled(input_text, language_id, generation_params, content_chunks)
+            raise
+        except Exception as e:
+            upstream_failed = upstream_latency_s is None
+            log_detox_error(f"Detoxification stream error for request_id: {request_id}", request_id, input_text, language_id, model_name, e)
+            yield dumps({"event": "error", "detail": "Service is not available now. Please try again later."}) + b"\n"
+        finally:
+            await release()
 
-        inference_logger.info(
-            "Detoxification Inference Completed",
-            extra={
-                "json_payload": {
-                    "request_id": request_id,
-                    **result_dict,
+    try:
+        return ReleasingStreamingResponse(event_stream(), release, media_type="application/x-ndjson")
+    except BaseException:
+        await release()
+        raise
+
+# Bulk detoxification endpoint
+@app.post("/detoxify/batch")
+async def detoxify_batch(request: DetoxificationBatchRequest, http_request: Request):
+    start_time = time.perf_counter()
+    batch_id = os.urandom(8).hex()
+
+    if len(request.items) > BATCH_ENDPOINT_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"Batch is too large (max {BATCH_ENDPOINT_MAX_ITEMS} items).")
+
+    results: list[Optional[dict]] = [None] * len(request.items)
+    rejected = []
+    accepted = []
+    for index, item in enumerate(request.items):
+        rejection = check_detox_item(item, forbidden_patterns)
+        if rejection is not None:
+            log_message, log_payload, content = rejection
+            results[index] = {"index": index, "status": "error", "status_code": 400, "error": content}
+            rejected.append({"index": index, "reason": log_message, **log_payload})
+        else:
+            accepted.append(index)
+
+    semaphore = asyncio.Semaphore(BATCH_ENDPOINT_CONCURRENCY)
+    deadline = get_deadline(start_time, get_latency_budget_ms(http_request))
+
+    async def run_item(index: int):
+        item = request.items[index]
+        input_text = item["text"].strip()
+        language_id = item["language_id"].lower()
+        model_name = get_model_name(language_id)
+        async with semaphore:
+            item_start_time = time.perf_counter()
+            try:
+                result_dict = await run_detoxification(
+                    input_text, language_id, model_name, item_start_time,
+                    flow=classify_request(http_request.headers, language_id, default_priority=BATCH),
+                    deadline=deadline,
+                )
+                results[index] = {"index": index, "status": "success", "data": result_dict}
+            except AdmissionRejected as e:
+                results[index] = {
+                    "index": index,
+                    "status": "error",
+                    "status_code": 429,
+                    "error": {"detail": "Too many requests. Please retry later.", "retry_after_s": e.retry_after_s},
+                }
+            except Exception as e:
+                log_policy.admit_error(language_id, input_text)
+                logging.error(f"Detoxification error for batch_id {batch_id} item {index}: {e}")
+                results[index] = {
+                    "index": index,
+                    "status": "error",
+                    "status_code": 503,
+                    "error": {
+                        "detail": "Service is not available now. Please try again later.",
+                        "error_type": e.__class__.__name__,
+                    },
                 }
-            }
-        )
 
-        return JSONResponse(
-            content={
-                "status": "success",
-                "data": result_dict
-            },
-            status_code=200
+    try:
+        await run_cancellable(
+            asyncio.gather(*(run_item(index) for index in accepted)),
+            http_request.receive, deadline, "detoxify_batch",
         )
-    except Exception as e:
-        inference_logger.error(
-            f"Detoxification error for request_id: {request_id}",
-            exc_info=True,
-            extra={
-                "json_payload": {
-                    "request_id": request_id,
-                    "input_text": input_text,
-                    "language_id": language_id,
-                    "error_type": e.__class__.__name__,
-                    "error_message": str(e),
-                    "model_used": model_name if 'model_name' in locals() else 'unknown',
+    except RequestCancelled as e:
+        if e.reason != DEADLINE:
+            raise request_cancelled(e)
+        # Items finished before the deadline are still returned
+        for index in accepted:
+            if results[index] is None:
+                results[index] = {
+                    "index": index,
+                    "status": "error",
+                    "status_code": 504,
+                    "error": {"detail": "Deadline exceeded."},
                 }
+
+    latency_ms = (time.perf_counter() - start_time) * 1000
+    succeeded = [r["data"] for r in results if r["status"] == "success"]
+    failed = [r for r in results if r["status"] == "error"]
+    sampled_items = []
+    for r in results:
+        if r["status"] == "success":
+            log_payload = log_policy.admit_success(r["data"])
+            if log_payload is not None:
+                sampled_items.append({"index": r["index"], **log_payload})
+    # Item details go into records of bounded size after the summary, so that no
+    # entry of a 1000-item batch exceeds the Cloud Logging entry size limit
+    item_records = split_by_size(rejected + sampled_items)
+
+    inference_logger.info(
+        "Detoxification Batch Inference Completed",
+        extra={
+            "json_payload": {
+                "batch_id": batch_id,
+                "item_count": len(results),
+                "success_count": len(succeeded),
+                "error_count": len(failed),
+                "latency_ms": latency_ms,
+                "prompt_tokens": sum(r["prompt_tokens"] for r in succeeded),
+                "completion_tokens": sum(r["completion_tokens"] for r in succeeded),
+                "total_tokens": sum(r["total_tokens"] for r in succeeded),
+                "rejected_indexes": [item["index"] for item in rejected],
+                "failed_items": [
+                    {"index": r["index"], "status_code": r["status_code"], "error_type": r["error"].get("error_type")}
+                    for r in failed if r["status_code"] != 400
+                ],
+                "item_records": len(item_records),
             }
+        }
+    )
+    for part, items in enumerate(item_records):
+        inference_logger.info(
+            "Detoxification Batch Items",
+            extra={"json_payload": {"batch_id": batch_id, "part": part, "items": items}}
         )
-        logging.error(f"Detoxification error for request_id {request_id}: {e}")
-        raise HTTPException(status_code=503, detail="Service is not available now. Please try again later.")
+
+    return FastJSONResponse(
+        content={
+            "status": "success",
+            "data": {
+                "batch_id": batch_id,
+                "latency_ms": latency_ms,
+                "success_count": len(succeeded),
+                "error_count": len(failed),
+                "results": results,
+            }
+        },
+        status_code=200
+    )
 
 if __name__ == "__main__":
     import uvicorn
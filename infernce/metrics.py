@@ -0,0 +1,255 @@
+from prometheus_client import Counter, Gauge, Histogram
+
+# Prometheus metrics for the detoxification service, grouped by pipeline stage.
+
+# --- Micro-batching dispatcher ---
+batch_size = Histogram(
+    'detox_batch_size',
+    'Number of requests sent upstream together in one micro-batch',
+    ['adapter'],
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128),
+)
+batch_wait_seconds = Histogram(
+    'detox_batch_wait_seconds',
+    'Time a request waited in the dispatcher queue before its batch was sent',
+    ['adapter'],
+    buckets=(0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.25),
+)
+batch_queue_depth = Gauge(
+    'detox_batch_queue_depth',
+    'Requests currently waiting in the dispatcher queues of an adapter',
+    ['adapter'],
+)
+batch_max_wait_ms = Gauge('detox_batch_max_wait_ms', 'Configured dispatcher max wait in milliseconds')
+batch_max_size = Gauge('detox_batch_max_size', 'Configured dispatcher max batch size')
+
+# --- Result cache ---
+cache_requests_total = Counter(
+    'detox_cache_requests_total',
+    'Result cache lookups by outcome',
+    ['result'],
+)
+cache_evictions_total = Counter(
+    'detox_cache_evictions_total',
+    'Result cache evictions by reason (lru, ttl)',
+    ['reason'],
+)
+cache_entries = Gauge('detox_cache_entries', 'Results currently held in the in-process cache')
+cache_backend_requests_total = Counter(
+    'detox_cache_backend_requests_total',
+    'Shared (second-tier) cache lookups after a local miss, by outcome',
+    ['result'],
+)
+cache_backend_writes_dropped_total = Counter(
+    'detox_cache_backend_writes_dropped_total',
+    'Write-behind entries dropped because the queue was full, the value could not be encoded or the backend failed',
+)
+
+# --- In-flight request coalescing ---
+coalesced_requests_total = Counter(
+    'detox_coalesced_requests_total',
+    'Requests served by joining an identical in-flight upstream generation',
+)
+coalesced_tokens_saved_total = Counter(
+    'detox_coalesced_tokens_saved_total',
+    'Upstream tokens not generated thanks to request coalescing',
+)
+
+# --- Lexicon pre-filter ---
+prefilter_decisions_total = Counter(
+    'detox_prefilter_decisions_total',
+    'Lexicon pre-filter decisions per language (bypass, toxic, audit, too_long, language_excluded)',
+    ['language', 'decision'],
+)
+
+# --- Degradation to the lexicon baseline ---
+upstream_inflight = Gauge('detox_upstream_inflight', 'Upstream generations currently in flight')
+degraded_mode = Gauge('detox_degraded_mode', '1 while the service answers with the lexicon baseline because of overload')
+degraded_responses_total = Counter(
+    'detox_degraded_responses_total',
+    'Requests answered by the lexicon baseline instead of the LLM, by reason',
+    ['reason'],
+)
+
+# --- Request guard ---
+guard_match_seconds = Histogram(
+    'detox_guard_match_seconds',
+    'Time spent matching a request text against the forbidden patterns',
+    buckets=(0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.005),
+)
+guard_patterns = Gauge('detox_guard_patterns', 'Forbidden patterns currently compiled, summed over languages')
+guard_pattern_reloads_total = Counter(
+    'detox_guard_pattern_reloads_total',
+    'Forbidden pattern file reloads by result',
+    ['result'],
+)
+
+# --- Inference log shipping ---
+log_queue_depth = Gauge('detox_log_queue_depth', 'Inference log records waiting to be shipped')
+log_records_shipped_total = Counter('detox_log_records_shipped_total', 'Inference log records shipped to Cloud Logging')
+log_records_dropped_total = Counter(
+    'detox_log_records_dropped_total',
+    'Inference log records dropped, by reason (queue_full, invalid_entry = rejected by Cloud Logging, ship_failed)',
+    ['reason'],
+)
+log_ship_retries_total = Counter(
+    'detox_log_ship_retries_total',
+    'Log batches sent again after a transient Cloud Logging error',
+)
+
+# --- Replica routing ---
+replica_outstanding = Gauge(
+    'detox_replica_outstanding',
+    'Upstream requests currently in flight per vLLM replica',
+    ['replica'],
+)
+replica_healthy = Gauge(
+    'detox_replica_healthy',
+    'Whether the vLLM replica passes its health probe (1) or is evicted (0)',
+    ['replica'],
+)
+replica_probe_failures_total = Counter(
+    'detox_replica_probe_failures_total',
+    'Failed health probes per vLLM replica',
+    ['replica'],
+)
+# Affinity hit rate: decision="affinity" over all decisions
+routing_decisions_total = Counter(
+    'detox_routing_decisions_total',
+    'Upstream routing decisions by chosen replica and decision (affinity, spillover, failover)',
+    ['replica', 'decision'],
+)
+replica_latency_ewma_ms = Gauge(
+    'detox_replica_latency_ewma_ms',
+    'Smoothed latency of successful upstream requests per vLLM replica',
+    ['replica'],
+)
+replica_circuit_state = Gauge(
+    'detox_replica_circuit_state',
+    'Circuit breaker state per vLLM replica (0 closed, 1 half-open, 2 open)',
+    ['replica'],
+)
+hedged_requests_total = Counter(
+    'detox_hedged_requests_total',
+    'Requests duplicated to a second replica, by outcome (primary_won, hedge_won, failed)',
+    ['outcome'],
+)
+hedge_delay_seconds = Gauge('detox_hedge_delay_seconds', 'Latency percentile after which the last request was hedged')
+
+# --- vLLM engine load (scraped from each replica's /metrics) ---
+engine_running = Gauge(
+    'detox_engine_running_requests',
+    'Requests in the vLLM engine running batch per replica, at the last scrape',
+    ['replica'],
+)
+engine_waiting = Gauge(
+    'detox_engine_waiting_requests',
+    'Requests queued inside the vLLM engine per replica, at the last scrape',
+    ['replica'],
+)
+engine_kv_cache_usage = Gauge(
+    'detox_engine_kv_cache_usage',
+    'Fraction of the vLLM KV cache in use per replica, at the last scrape',
+    ['replica'],
+)
+engine_prefix_cache_hit_rate = Gauge(
+    'detox_engine_prefix_cache_hit_rate',
+    'vLLM prefix-cache hit rate per replica between the last two scrapes',
+    ['replica'],
+)
+engine_scrape_failures_total = Counter(
+    'detox_engine_scrape_failures_total',
+    'Failed scrapes of vLLM /metrics per replica',
+    ['replica'],
+)
+
+# --- Admission control ---
+admission_limit = Gauge('detox_admission_limit', 'Current adaptive limit of concurrent upstream generations')
+admission_inflight = Gauge(
+    'detox_admission_inflight',
+    'Admitted upstream generations currently running, by priority',
+    ['priority'],
+)
+admission_queue_length = Gauge('detox_admission_queue_length', 'Requests waiting for an admission slot')
+admission_queue_wait_seconds = Histogram(
+    'detox_admission_queue_wait_seconds',
+    'Time a request waited for an admission slot, by priority and language',
+    ['priority', 'language'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 5),
+)
+admission_rejected_total = Counter(
+    'detox_admission_rejected_total',
+    'Requests rejected with 429 by admission control, by reason (queue_full, deadline) and priority',
+    ['reason', 'priority'],
+)
+
+# --- Output budget ---
+output_finish_total = Counter(
+    'detox_output_finish_total',
+    'Generations by how they ended (eos, stop_sequence, length = truncated at max_tokens)',
+    ['language', 'reason'],
+)
+output_budget_overrun_total = Counter(
+    'detox_output_budget_overrun_total',
+    'Generations longer than the expected output length for their input',
+    ['language'],
+)
+output_budget_utilization = Histogram(
+    'detox_output_budget_utilization',
+    'Completion tokens as a fraction of the max_tokens budget',
+    ['language'],
+    buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0),
+)
+output_tokens_per_char = Gauge(
+    'detox_output_tokens_per_char',
+    'Learned completion tokens per input character',
+    ['language'],
+)
+
+# --- Cancellation ---
+requests_cancelled_total = Counter(
+    'detox_requests_cancelled_total',
+    'Requests abandoned before they finished, by endpoint and reason (client_disconnect, deadline)',
+    ['endpoint', 'reason'],
+)
+upstream_cancelled_total = Counter(
+    'detox_upstream_cancelled_total',
+    'Upstream generations aborted because nobody was waiting for them any more',
+    ['language'],
+)
+cancelled_tokens_saved_total = Counter(
+    'detox_cancelled_tokens_saved_total',
+    'Estimated completion tokens not generated thanks to aborted upstream generations',
+)
+
+# --- Output parsing ---
+output_parse_total = Counter(
+    'detox_output_parse_total',
+    'Parsed model outputs by status (ok, recovered, or the reason the output was unusable = a parse failure)',
+    ['language', 'adapter', 'status'],
+)
+
+# --- Request pipeline ---
+stage_seconds = Histogram(
+    'detox_stage_seconds',
+    'Time spent per pipeline stage (guard, prompt_build, upstream = admission queue + generation, parse, log_enqueue)',
+    ['stage', 'language', 'adapter'],
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+tokens_total = Counter(
+    'detox_tokens_total',
+    'Tokens spent upstream by kind (prompt, completion)',
+    ['language', 'adapter', 'kind'],
+)
+http_inflight = Gauge('detox_http_inflight', 'Requests currently being handled', ['endpoint'])
+http_request_seconds = Histogram(
+    'detox_http_request_seconds',
+    'End-to-end request latency, including streaming the response',
+    ['endpoint'],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+http_responses_total = Counter(
+    'detox_http_responses_total',
+    'Responses by status code (4xx are client errors and guard rejections, 5xx upstream failures)',
+    ['endpoint', 'code'],
+)
@@ -0,0 +1,145 @@
+import math
+from typing import Dict, List, Optional
+
+import metrics
+from output_parser import PARSERS
+
+# Completion tokens per input character, for the whole two-line output
+# (toxic words and neutral text together). Starting points per script; the
+# policy refines them from observed generations when learning is on.
+DEFAULT_TOKENS_PER_CHAR = {
+    'en': 0.5, 'hin': 0.7,
+    'es': 0.6, 'fr': 0.6, 'de': 0.6, 'it': 0.6,
+    'ru': 0.9, 'uk': 0.9, 'tt': 1.0,
+    'he': 1.0, 'ar': 1.0,
+    'zh': 2.0, 'ja': 2.0, 'hi': 2.0,
+    'am': 3.0,
+}
+
+
+class OutputBudgetPolicy:
+    """
+    Chooses `max_tokens` and stop sequences for one generation.
+
+    The expected output length is `overhead_tokens + ratio * len(text)`,
+    with a tokens-per-character ratio per language. The budget adds
+    `headroom` on top of the ratio. With `learn` on, the ratio follows an
+    EWMA of observed outputs once `min_samples` were seen; truncated outputs
+    push it up so that a too small ratio corrects itself.
+
+    Stop sequences end the generation after the neutral-text line: a blank
+    line or the start of a repeated toxic-words block.
+
+    Attributes:
+        tokens_per_char (Dict[str, float]): Current ratio per language
+        default_ratio (float): Ratio for languages without one
+        headroom (float): Budget multiplier over the expected variable part
+        overhead_tokens (int): Tokens of the field keys and list syntax
+        min_tokens (int): Lower bound of the budget
+        max_tokens (int): Upper bound of the budget
+        learn (bool): Refine the ratios from observed generations
+    """
+
+    def __init__(
+        self,
+        tokens_per_char: Optional[Dict[str, float]] = None,
+        default_ratio: float = 1.0,
+        headroom: float = 1.5,
+        overhead_tokens: int = 32,
+        min_tokens: int = 48,
+        max_tokens: int = 500,
+        learn: bool = True,
+        learn_alpha: float = 0.05,
+        min_samples: int = 50,
+        stop_sequences: bool = True,
+    ):
+        self.tokens_per_char = {**DEFAULT_TOKENS_PER_CHAR, **(tokens_per_char or {})}
+        self.default_ratio = default_ratio
+        self.headroom = headroom
+        self.overhead_tokens = overhead_tokens
+        self.min_tokens = min_tokens
+        self.max_tokens = max_tokens
+        self.learn = learn
+        self.learn_alpha = learn_alpha
+        self.min_samples = min_samples
+        self.stop_sequences_enabled = stop_sequences
+        self._learned: Dict[str, float] = {}
+        self._samples: Dict[str, int] = {}
+
+    def ratio(self, language: str) -> float:
+        if self.learn and self._samples.get(language, 0) >= self.min_samples:
+            return self._learned[language]
+        return self.tokens_per_char.get(language, self.default_ratio)
+
+    def expected_tokens(self, text: str, language: str) -> float:
+        return self.overhead_tokens + self.ratio(language) * len(text)
+
+    def budget(self, text: str, language: str) -> int:
+        """
+        `max_tokens` for detoxifying `text`.
+        """
+        budget = math.ceil(self.overhead_tokens + self.ratio(language) * self.headroom * len(text))
+        return min(self.max_tokens, max(self.min_tokens, budget))
+
+    def stop_sequences(self, text: str, language: str) -> List[str]:
+        """
+        Stop sequences that end the generation after the neutral-text line.
+        """
+        if not self.stop_sequences_enabled:
+            return []
+        # Every spelling of the toxic words key that the output parser accepts
+        parser = PARSERS.get(language)
+        stops = ["\n" + label for label in (parser.toxic_labels if parser is not None else ["toxic_words"])]
+        # A blank line is a valid part of a multi-paragraph input
+        if "\n\n" not in text:
+            stops.append("\n\n")
+        return stops
+
+    def generation_params(self, text: str, language: str) -> dict:
+        """
+        Keyword arguments for `chat.completions.create`.
+        """
+        params = {"max_tokens": self.budget(text, language)}
+        stops = self.stop_sequences(text, language)
+        if stops:
+            params["stop"] = stops
+        return params
+
+    def record(
+        self,
+        text: str,
+        language: str,
+        max_tokens: int,
+        completion_tokens: int,
+        finish_reason: Optional[str],
+        stop_reason=None,
+    ):
+        """
+        Record how one generation ended and refine the language's ratio.
+
+        `stop_reason` is vLLM's extension field: the matched stop string, or
+        None when the model emitted its end-of-sequence token.
+        """
+        if finish_reason == "length":
+            reason = "length"
+        elif isinstance(stop_reason, str):
+            reason = "stop_sequence"
+        else:
+            reason = "eos"
+        metrics.output_finish_total.labels(language=language, reason=reason).inc()
+        metrics.output_budget_utilization.labels(language=language).observe(completion_tokens / max(max_tokens, 1))
+        if completion_tokens > self.expected_tokens(text, language):
+            metrics.output_budget_overrun_total.labels(language=language).inc()
+
+        if not self.learn or not text:
+            return
+        sample = max(0, completion_tokens - self.overhead_tokens) / len(text)
+        if reason == "length":
+            # The true length is unknown but larger: never let a truncation lower the ratio
+            sample = max(sample, self.ratio(language)) * self.headroom
+        samples = self._samples.get(language, 0) + 1
+        self._samples[language] = samples
+        current = self._learned.get(language, self.tokens_per_char.get(language, self.default_ratio))
+        self._learned[language] = current + self.learn_alpha * (sample - current)
+        if samples >= self.min_samples:
+            metrics.output_tokens_per_char.labels(language=language).set(self._learned[language])
@@ -0,0 +1,307 @@
+import re
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from serialization import loads
+from utils import langs, neutral_text_key, neutral_text_key_dict, toxic_words_key, toxic_words_key_dict
+
+# Parse status codes. Only OK and RECOVERED results carry usable text.
+OK = "ok"
+# Parsed, but the toxic words list was malformed (e.g. an unterminated quote) and repaired
+RECOVERED = "recovered"
+MISSING_TOXIC_WORDS = "missing_toxic_words"
+MISSING_NEUTRAL_TEXT = "missing_neutral_text"
+# Both fields are present but not in the expected order
+MALFORMED = "malformed"
+EMPTY_NEUTRAL_TEXT = "empty_neutral_text"
+UNKNOWN_LANGUAGE = "unknown_language"
+USABLE_STATUSES = (OK, RECOVERED)
+
+# Neutral text of an output that could not be parsed
+PARSE_ERROR_TEXT = "error"
+
+# Opening quote -> closing quote, for list items and a quoted neutral text
+QUOTES = {'"': '"', "'": "'", "“": "”", "‘": "’", "«": "»", "„": "“", "「": "」", "『": "』"}
+_QUOTE_CHARS = "".join(set(QUOTES) | set(QUOTES.values()))
+
+# Values of the toxic words field that mean "no toxic words"
+_EMPTY_VALUES = {"", "[]", "none", "null", "-"}
+
+# One list item: a quoted string (JSON/Python escapes allowed) or a bare word, then a comma or the end
+_LIST_ITEM = re.compile(
+    r"""\s*(?:
+        "(?P<dq>(?:[^"\\]|\\.)*)"
+      | '(?P<sq>(?:[^'\\]|\\.)*)'
+      | “(?P<cq>[^”]*)”
+      | «(?P<gq>[^»]*)»
+      | 「(?P<jq>[^」]*)」
+      | (?P<bare>[^,]*?)
+    )\s*(?:,|$)""",
+    re.VERBOSE | re.DOTALL,
+)
+_ESCAPE = re.compile(r"\\(.)")
+
+
+def key_variants(keys: Iterable[str]) -> List[str]:
+    """
+    The spellings and capitalizations of a field key that the parser accepts, longest first.
+    """
+    variants = {variant for key in keys for variant in (key, key.lower(), key[:1].upper() + key[1:])}
+    return sorted(variants, key=lambda variant: (-len(variant), variant))
+
+
+def _head_pattern(keys: Iterable[str]) -> str:
+    # A field key in any of its spellings and capitalizations, optionally wrapped in
+    # quotes or markdown emphasis, and its colon. Listing the case variants instead of
+    # matching case-insensitively keeps the literal-prefix search of the regex engine.
+    return "(?:" + "|".join(re.escape(key) for key in key_variants(keys)) + r")[*\"'`]*[ \t]*[:：]?[ \t]*"
+
+
+def _split_simple_list(inner: str) -> Optional[List[str]]:
+    # Fast path for lists whose terms contain no commas, escapes or inner quotes; None otherwise
+    terms = []
+    for part in inner.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        close = QUOTES.get(part[0])
+        if close is not None:
+            if len(part) < 2 or part[-1] != close or close in part[1:-1] or "\\" in part:
+                return None
+            part = part[1:-1].strip()
+        elif part[-1] in _QUOTE_CHARS:
+            return None
+        if part:
+            terms.append(part)
+    return terms
+
+
+def parse_toxic_words(value: str) -> Tuple[List[str], bool]:
+    """
+    Parse the value of the toxic words field: a JSON or Python style list
+    (quoted items may contain commas), a bare comma-separated list or a
+    single word.
+
+    Returns:
+        (terms, well_formed); well_formed is False when the value had to be repaired.
+    """
+    value = value.strip()
+    if len(value) <= 4 and value.lower() in _EMPTY_VALUES:
+        return [], True
+    if value[0] == "[" and value[-1] == "]":
+        value = value[1:-1]
+        well_formed = True
+    elif value[0] == "[" or value[-1] == "]":
+        value = value.strip("[]")
+        well_formed = False
+    else:
+        well_formed = True
+
+    terms = _split_simple_list(value)
+    if terms is not None:
+        return terms, well_formed
+    if well_formed and value[:1] == '"':
+        try:
+            terms = loads(f"[{value}]")
+        except ValueError:
+            terms = None
+        if isinstance(terms, list) and all(isinstance(term, str) for term in terms):
+            return [term.strip() for term in terms if term.strip()], True
+
+    terms = []
+    position, end = 0, len(value)
+    while position < end:
+        match = _LIST_ITEM.match(value, position)
+        position = match.end()
+        quoted = match.lastgroup
+        term = match.group(quoted).strip() if quoted else ""
+        if quoted == "bare":
+            if term and (term[0] in _QUOTE_CHARS or term[-1] in _QUOTE_CHARS):
+                # e.g. an unterminated quote at the end of a truncated list
+                term = term.strip(_QUOTE_CHARS).strip()
+                well_formed = False
+        elif "\\" in term:
+            term = _ESCAPE.sub(r"\1", term)
+        if term:
+            terms.append(term)
+        if match.end() == match.start():
+            break
+    return terms, well_formed
+
+
+def _unquote(text: str) -> str:
+    close = QUOTES.get(text[:1])
+    if close is None:
+        return text
+    text = text[1:]
+    if text.endswith(close):
+        text = text[:-1]
+    return text.strip()
+
+
+def _failure(status: str) -> dict:
+    return {"toxic_words": [], "neutral_text": PARSE_ERROR_TEXT, "status": status}
+
+
+class OutputParser:
+    """
+    Parser of one language's model output, compiled once:
+
+        <toxic words key>: <list>
+        <neutral text key>: <text>
+
+    The keys may be any of the language's spellings, lower case or
+    capitalized; ":" and the full-width "：" are both accepted. The neutral
+    text is the first non-empty line after its key.
+
+    Attributes:
+        toxic_labels (List[str]): Accepted spellings of the toxic words key
+        toxic_head (re.Pattern): Matches the toxic words key and its separator
+        neutral_head (re.Pattern): Matches the neutral text key and its separator
+        pattern (re.Pattern): Matches a complete output in one pass
+    """
+
+    def __init__(self, toxic_keys: Iterable[str], neutral_keys: Iterable[str]):
+        self.toxic_labels = key_variants(toxic_keys)
+        toxic_head = _head_pattern(toxic_keys)
+        neutral_head = _head_pattern(neutral_keys)
+        self.toxic_head = re.compile(toxic_head)
+        self.neutral_head = re.compile(neutral_head)
+        self.pattern = re.compile(toxic_head + r"(?P<toxic>.*?)" + neutral_head + r"\s*(?P<neutral>[^\n]*)", re.DOTALL)
+
+    def parse(self, output_text: str) -> dict:
+        """
+        Parse a complete output.
+
+        Returns:
+            dict with "toxic_words", "neutral_text" and a "status" code. When
+            the status is not usable the neutral text is "error".
+        """
+        match = self.pattern.search(output_text)
+        if match is None:
+            if self.toxic_head.search(output_text) is None:
+                return _failure(MISSING_TOXIC_WORDS)
+            if self.neutral_head.search(output_text) is None:
+                return _failure(MISSING_NEUTRAL_TEXT)
+            return _failure(MALFORMED)
+        return self.build(match.group("toxic"), match.group("neutral"))
+
+    @staticmethod
+    def parse_toxic_value(toxic_value: str) -> Tuple[List[str], bool]:
+        # Markdown emphasis opening the neutral text key ends up after the list
+        return parse_toxic_words(toxic_value.rstrip().rstrip("*`"))
+
+    def build(self, toxic_value: str, neutral_value: str) -> dict:
+        neutral_text = _unquote(neutral_value.strip())
+        if not neutral_text:
+            return _failure(EMPTY_NEUTRAL_TEXT)
+        toxic_words, well_formed = self.parse_toxic_value(toxic_value)
+        return {"toxic_words": toxic_words, "neutral_text": neutral_text, "status": OK if well_formed else RECOVERED}
+
+
+PARSERS: Dict[str, OutputParser] = {
+    lang: OutputParser(
+        (toxic_words_key[lang], toxic_words_key_dict[lang]),
+        (neutral_text_key[lang], neutral_text_key_dict[lang]),
+    )
+    for lang in langs
+}
+
+
+def parse_detoxified_output(output_text: str, lang: str) -> dict:
+    """
+    Parse the model output for `lang`.
+
+    Example:
+        >>> parse_detoxified_output('toxic_words: ["idiot", "stupid, dumb"]\\nneutral_text: You are not very smart.', "en")
+        {'toxic_words': ['idiot', 'stupid, dumb'], 'neutral_text': 'You are not very smart.', 'status': 'ok'}
+    """
+    parser = PARSERS.get(lang)
+    if parser is None:
+        return _failure(UNKNOWN_LANGUAGE)
+    return parser.parse(output_text)
+
+
+class IncrementalOutputParser:
+    """
+    Incremental parser for streamed model output.
+
+    Chunks are fed as they arrive. The toxic words are emitted once the
+    neutral text key follows them, then the neutral text is emitted piece by
+    piece until the end of its line. A quoted neutral text is emitted without
+    its quotes. `result` parses everything fed so far with the same rules as
+    `parse_detoxified_output`.
+
+    Example:
+        >>> parser = IncrementalOutputParser("en")
+        >>> parser.feed('toxic_words: ["idiot"]\\nneutral_')
+        []
+        >>> parser.feed('text: You are')
+        [{'event': 'toxic_words', 'toxic_words': ['idiot']}, {'event': 'token', 'text': 'You are'}]
+    """
+
+    def __init__(self, lang: str):
+        self.parser: Optional[OutputParser] = PARSERS.get(lang)
+        self.buffer = ""
+        self.toxic_words = None
+        self.neutral_text = ""
+        self._toxic_match = None
+        self._cursor = None
+        self._close_quote = None
+        self._value_started = False
+        self._neutral_done = False
+
+    def feed(self, chunk: str) -> list:
+        """
+        Add a chunk of model output and return the events it completes.
+        """
+        self.buffer += chunk
+        events = []
+        if self.parser is None or self._neutral_done:
+            return events
+
+        if self._cursor is None:
+            # A key is only complete once a character follows its separator
+            if self._toxic_match is None:
+                toxic_match = self.parser.toxic_head.search(self.buffer)
+                if toxic_match is None or toxic_match.end() == len(self.buffer):
+                    return events
+                self._toxic_match = toxic_match
+            neutral_match = self.parser.neutral_head.search(self.buffer, self._toxic_match.end())
+            if neutral_match is None or neutral_match.end() == len(self.buffer):
+                return events
+            self.toxic_words, _ = self.parser.parse_toxic_value(self.buffer[self._toxic_match.end():neutral_match.start()])
+            events.append({"event": "toxic_words", "toxic_words": self.toxic_words})
+            self._cursor = neutral_match.end()
+
+        pending = self.buffer[self._cursor:]
+        if not self._value_started:
+            value = pending.lstrip()
+            self._cursor += len(pending) - len(value)
+            if not value:
+                return events
+            self._close_quote = QUOTES.get(value[0])
+            if self._close_quote is not None:
+                self._cursor += 1
+                value = value[1:]
+            self._value_started = True
+            pending = value
+        line_end = pending.find("\n")
+        if line_end != -1:
+            pending = pending[:line_end].rstrip()
+            self._neutral_done = True
+        if self._close_quote is not None and pending.endswith(self._close_quote):
+            # The closing quote is dropped at the end of the line and held back until then
+            pending = pending[:-1]
+        if pending:
+            self._cursor += len(pending)
+            self.neutral_text += pending
+            events.append({"event": "token", "text": pending})
+        return events
+
+    def result(self) -> dict:
+        """
+        Parse of everything fed so far (see `parse_detoxified_output`).
+        """
+        if self.parser is None:
+            return _failure(UNKNOWN_LANGUAGE)
+        return self.parser.parse(self.buffer)
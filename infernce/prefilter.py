@@ -0,0 +1,46 @@
+import random
+from typing import Optional, Set
+
+import metrics
+from instrumentation import language_label
+
+
+class LexiconPrefilterPolicy:
+    """
+    Decides whether an input with no lexicon match may skip the LLM and be
+    returned unchanged.
+
+    Attributes:
+        languages (Optional[Set[str]]): Languages allowed to bypass, None means all
+        max_text_length (int): Longer inputs always go to the LLM
+        audit_rate (float): Fraction of bypass-eligible inputs still sent to the
+            LLM so the bypass decision can be audited against model output
+    """
+
+    def __init__(
+        self,
+        languages: Optional[Set[str]] = None,
+        max_text_length: int = 500,
+        audit_rate: float = 0.0,
+    ):
+        self.languages = languages
+        self.max_text_length = max_text_length
+        self.audit_rate = audit_rate
+
+    def should_bypass(self, baseline, text: str, language: str) -> bool:
+        """
+        Run the lexicon over `text` and decide if the LLM call can be skipped.
+        Every decision is counted per language (unknown ids share one label).
+        """
+        if self.languages is not None and language not in self.languages:
+            decision = "language_excluded"
+        elif len(text) > self.max_text_length:
+            decision = "too_long"
+        elif baseline.find_toxic_terms(text, language):
+            decision = "toxic"
+        elif self.audit_rate > 0 and random.random() < self.audit_rate:
+            decision = "audit"
+        else:
+            decision = "bypass"
+        metrics.prefilter_decisions_total.labels(language=language_label(language), decision=decision).inc()
+        return decision == "bypass"
@@ -0,0 +1,467 @@
+import asyncio
+import bisect
+import hashlib
+import logging
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+import httpx
+import openai
+from openai import AsyncOpenAI
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Routing policies
+AFFINITY = "affinity"
+LEAST_OUTSTANDING = "least_outstanding"
+# Numeric circuit states exported by the detox_replica_circuit_state gauge
+CIRCUIT_STATE_VALUES = {"closed": 0, "half_open": 1, "open": 2}
+
+
+class NoReplicaAvailableError(RuntimeError):
+    """
+    Raised when every replica's circuit breaker is open.
+    """
+
+
+def is_backend_failure(error: BaseException) -> bool:
+    """
+    Whether an upstream error says something about the backend's health.
+    Client errors (4xx) do not trip the circuit breaker.
+    """
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code >= 500
+    return isinstance(error, (openai.APIConnectionError, httpx.HTTPError, asyncio.TimeoutError, OSError))
+
+
+def _ring_hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class CircuitBreaker:
+    """
+    Per-replica circuit breaker. After `failure_threshold` consecutive
+    backend failures the circuit opens and the replica is skipped without
+    sending it anything. After `cooldown_s` a single trial request is let
+    through (half-open); its success closes the circuit, its failure opens
+    it again.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, cooldown_s: float = 10.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown_s = cooldown_s
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_inflight = False
+        metrics.replica_circuit_state.labels(replica=name).set(CIRCUIT_STATE_VALUES["closed"])
+
+    def _set_state(self, state: str):
+        if state != self.state:
+            logger.warning(f"Circuit of replica {self.name} is now {state}.")
+            self.state = state
+            metrics.replica_circuit_state.labels(replica=self.name).set(CIRCUIT_STATE_VALUES[state])
+
+    def allows(self) -> bool:
+        """
+        Whether a request may be sent to the replica now.
+        """
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.cooldown_s:
+            self._set_state("half_open")
+            self.trial_inflight = False
+        if self.state == "half_open":
+            return not self.trial_inflight
+        return self.state == "closed"
+
+    def on_acquire(self):
+        if self.state == "half_open":
+            self.trial_inflight = True
+
+    def record_success(self):
+        self.failures = 0
+        self.trial_inflight = False
+        self._set_state("closed")
+
+    def record_failure(self):
+        self.failures += 1
+        self.trial_inflight = False
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            self._set_state("open")
+
+    def record_abandoned(self):
+        # A cancelled trial (e.g. a hedge loser) proves nothing either way
+        self.trial_inflight = False
+
+
+class Replica:
+    """
+    One vLLM backend and its OpenAI client.
+
+    Attributes:
+        name (str): Label used in metrics and logs, e.g. vllm-a:8000
+        base_url (str): Server root, e.g. http://vllm-a:8000 (health probe target)
+        client (AsyncOpenAI): Client bound to `{base_url}/v1`
+        outstanding (int): Upstream requests currently sent to this replica
+        healthy (bool): False once the health probe evicted the replica
+        latency_ewma_ms (Optional[float]): Smoothed latency of successful requests
+        breaker (CircuitBreaker): Circuit breaker of the replica
+        engine (Optional[EngineStats]): vLLM load at the last scrape, None when unknown
+    """
+
+    def __init__(self, name: str, base_url: str, client: AsyncOpenAI):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.client = client
+        self.outstanding = 0
+        self.healthy = True
+        self.probe_failures = 0
+        self.latency_ewma_ms: Optional[float] = None
+        self.breaker = CircuitBreaker(name)
+        self.engine = None
+
+    def engine_waiting(self) -> int:
+        """
+        Requests queued inside vLLM at the last scrape (0 when unknown). Unlike
+        `outstanding` it includes requests of the other service workers.
+        """
+        return self.engine.waiting if self.engine is not None else 0
+
+    def load_score(self) -> float:
+        """
+        Expected wait for one more request: EWMA latency times the requests
+        it would queue behind. Replicas without latency samples score lowest.
+        """
+        return (self.outstanding + self.engine_waiting() + 1) * (self.latency_ewma_ms or 0.0)
+
+
+class ReplicaRouter:
+    """
+    Routes upstream requests across vLLM replicas.
+
+    With the "affinity" policy each (adapter, language) pair keeps landing on
+    the same replica, where its long system prompt is already in vLLM's
+    prefix cache. The home replica of a pair is found on a consistent-hash
+    ring, so adding or removing a replica only moves the pairs that hashed to
+    it. When the home replica is saturated (`max_outstanding` requests in
+    flight, or `max_engine_waiting` requests queued inside vLLM) or
+    unavailable, the request spills over to the least-loaded available
+    replica. The share of "affinity" routing decisions is the
+    prefix-cache affinity hit rate.
+
+    With the "least_outstanding" policy every request goes to the available
+    replica with the lowest `Replica.load_score`, so a slow node receives
+    less traffic.
+
+    A replica is available while it passes its health probe and its circuit
+    breaker is not open. `call` can also hedge: when the first replica has
+    not answered within the `hedge_percentile` latency of recent requests, a
+    duplicate is sent to a second replica and the slower one is cancelled.
+
+    Attributes:
+        replicas (List[Replica]): All configured replicas
+        policy (str): "affinity" or "least_outstanding"
+        max_outstanding (int): In-flight requests at which a replica counts as saturated
+        max_engine_waiting (int): Requests queued inside vLLM at which a replica counts as saturated (0 disables)
+        probe_interval_s (float): Seconds between health probes
+        probe_timeout_s (float): Timeout of one health probe
+        unhealthy_threshold (int): Consecutive probe failures before eviction
+        latency_alpha (float): Smoothing factor of the per-replica latency EWMA
+        hedge_enabled (bool): Send hedged duplicates of slow requests
+        hedge_percentile (float): Latency percentile after which a request is hedged
+        hedge_min_samples (int): Latency samples needed before hedging starts
+    """
+
+    def __init__(
+        self,
+        replicas: List[Replica],
+        policy: str = AFFINITY,
+        virtual_nodes: int = 64,
+        max_outstanding: int = 64,
+        max_engine_waiting: int = 0,
+        probe_interval_s: float = 5.0,
+        probe_timeout_s: float = 2.0,
+        unhealthy_threshold: int = 2,
+        latency_alpha: float = 0.2,
+        breaker_failure_threshold: int = 5,
+        breaker_cooldown_s: float = 10.0,
+        hedge_enabled: bool = False,
+        hedge_percentile: float = 95.0,
+        hedge_min_samples: int = 50,
+        latency_window: int = 512,
+    ):
+        if not replicas:
+            raise ValueError("At least one replica is required.")
+        if policy not in (AFFINITY, LEAST_OUTSTANDING):
+            raise ValueError(f"Unknown routing policy: {policy}")
+        self.replicas = replicas
+        self.policy = policy
+        self.max_outstanding = max_outstanding
+        self.max_engine_waiting = max_engine_waiting
+        self.probe_interval_s = probe_interval_s
+        self.probe_timeout_s = probe_timeout_s
+        self.unhealthy_threshold = unhealthy_threshold
+        self.latency_alpha = latency_alpha
+        self.hedge_enabled = hedge_enabled and len(replicas) > 1
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self._latency_window = latency_window
+        # Recent latencies (seconds) per latency class, e.g. "completion" or "first_token"
+        self._latencies: Dict[str, deque] = {}
+        self._probe_task: Optional[asyncio.Task] = None
+
+        for replica in replicas:
+            replica.breaker.failure_threshold = breaker_failure_threshold
+            replica.breaker.cooldown_s = breaker_cooldown_s
+
+        ring = sorted(
+            (_ring_hash(f"{replica.name}#{i}"), index)
+            for index, replica in enumerate(replicas)
+            for i in range(virtual_nodes)
+        )
+        self._ring_hashes = [point for point, _ in ring]
+        self._ring_replicas = [index for _, index in ring]
+
+        for replica in replicas:
+            metrics.replica_outstanding.labels(replica=replica.name).set(0)
+            metrics.replica_healthy.labels(replica=replica.name).set(1)
+
+    def home_replica(self, adapter: str, language: str) -> Replica:
+        """
+        Replica that owns (adapter, language) on the hash ring, whatever its state.
+        """
+        position = bisect.bisect(self._ring_hashes, _ring_hash(f"{adapter}:{language}"))
+        return self.replicas[self._ring_replicas[position % len(self._ring_replicas)]]
+
+    def saturated(self, replica: Replica) -> bool:
+        if replica.outstanding >= self.max_outstanding:
+            return True
+        return self.max_engine_waiting > 0 and replica.engine_waiting() >= self.max_engine_waiting
+
+    def _candidates(self, exclude: Set[Replica]) -> List[Replica]:
+        allowed = [r for r in self.replicas if r not in exclude and r.breaker.allows()]
+        # With every replica evicted by the probe, keep serving from all of them rather than failing outright
+        return [r for r in allowed if r.healthy] or allowed
+
+    def acquire(self, adapter: str, language: str, exclude: Optional[Set[Replica]] = None) -> Replica:
+        """
+        Pick the replica for one request and count it as outstanding there.
+        Every `acquire` must be paired with a `release`.
+
+        Raises:
+            NoReplicaAvailableError: If no replica outside `exclude` may take the request
+        """
+        exclude = exclude or set()
+        if exclude:
+            decision = "hedge"
+        elif self.policy == LEAST_OUTSTANDING:
+            decision = "least_outstanding"
+        else:
+            decision = "affinity"
+
+        replica = self.home_replica(adapter, language) if decision == "affinity" else None
+        if replica is None or not (
+            replica.healthy and replica.breaker.allows() and not self.saturated(replica)
+        ):
+            if replica is not None:
+                decision = "spillover" if replica.healthy and replica.breaker.allows() else "failover"
+            candidates = self._candidates(exclude)
+            if not candidates:
+                raise NoReplicaAvailableError("No vLLM replica is available.")
+            replica = min(
+                candidates,
+                key=Replica.load_score if self.policy == LEAST_OUTSTANDING else lambda r: r.outstanding + r.engine_waiting(),
+            )
+
+        metrics.routing_decisions_total.labels(replica=replica.name, decision=decision).inc()
+        replica.breaker.on_acquire()
+        replica.outstanding += 1
+        metrics.replica_outstanding.labels(replica=replica.name).set(replica.outstanding)
+        return replica
+
+    def release(self, replica: Replica):
+        replica.outstanding -= 1
+        metrics.replica_outstanding.labels(replica=replica.name).set(replica.outstanding)
+
+    @contextmanager
+    def route(self, adapter: str, language: str):
+        """
+        Context manager around `acquire`/`release` that yields the chosen replica.
+        """
+        replica = self.acquire(adapter, language)
+        try:
+            yield replica
+        finally:
+            self.release(replica)
+
+    def record_result(self, replica: Replica, latency_s: float, error: Optional[BaseException] = None, latency_class: str = "completion"):
+        """
+        Feed the outcome of one request into the replica's circuit breaker,
+        its latency EWMA and the hedging latency window.
+        """
+        if isinstance(error, asyncio.CancelledError):
+            replica.breaker.record_abandoned()
+            return
+        if error is not None and is_backend_failure(error):
+            replica.breaker.record_failure()
+            return
+        # Client errors still prove the replica is up
+        replica.breaker.record_success()
+        if error is not None:
+            return
+        latency_ms = latency_s * 1000
+        if replica.latency_ewma_ms is None:
+            replica.latency_ewma_ms = latency_ms
+        else:
+            replica.latency_ewma_ms += self.latency_alpha * (latency_ms - replica.latency_ewma_ms)
+        metrics.replica_latency_ewma_ms.labels(replica=replica.name).set(replica.latency_ewma_ms)
+        window = self._latencies.get(latency_class)
+        if window is None:
+            window = self._latencies[latency_class] = deque(maxlen=self._latency_window)
+        window.append(latency_s)
+
+    def hedge_delay_s(self, latency_class: str = "completion") -> Optional[float]:
+        """
+        Seconds after which a request of `latency_class` is hedged, or None
+        while there are too few samples.
+        """
+        window = self._latencies.get(latency_class)
+        if window is None or len(window) < self.hedge_min_samples:
+            return None
+        ordered = sorted(window)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * self.hedge_percentile / 100))]
+
+    async def _attempt(self, replica: Replica, fn: Callable[[Replica], Awaitable[Any]], latency_class: str, hold: bool):
+        start_time = time.perf_counter()
+        try:
+            result = await fn(replica)
+        except BaseException as e:
+            self.record_result(replica, time.perf_counter() - start_time, e, latency_class)
+            self.release(replica)
+            raise
+        self.record_result(replica, time.perf_counter() - start_time, latency_class=latency_class)
+        if not hold:
+            self.release(replica)
+        return result
+
+    async def call(
+        self,
+        adapter: str,
+        language: str,
+        fn: Callable[[Replica], Awaitable[Any]],
+        latency_class: str = "completion",
+        hold: bool = False,
+        discard: Optional[Callable[[Any], Awaitable[None]]] = None,
+    ) -> Tuple[Any, Replica]:
+        """
+        Run `fn(replica)` on a routed replica, hedging it on a second replica
+        if it is slow. The first successful attempt wins and the other one is
+        cancelled; if both fail, the first error is raised.
+
+        With `hold`, the winning replica stays counted as outstanding until the
+        caller releases it, e.g. when `fn` only opens a stream. `discard` is
+        awaited on the result of a losing attempt that succeeded as well, e.g.
+        to close its stream.
+
+        Returns:
+            (result, replica that produced it)
+        """
+        primary = self.acquire(adapter, language)
+        primary_task = asyncio.create_task(self._attempt(primary, fn, latency_class, hold))
+        attempts = {primary_task: primary}
+        winner = None
+        try:
+            hedge_delay = self.hedge_delay_s(latency_class) if self.hedge_enabled else None
+            if hedge_delay is not None:
+                await asyncio.wait([primary_task], timeout=hedge_delay)
+                if not primary_task.done():
+                    try:
+                        secondary = self.acquire(adapter, language, exclude={primary})
+                    except NoReplicaAvailableError:
+                        secondary = None
+                    if secondary is not None:
+                        metrics.hedge_delay_seconds.set(hedge_delay)
+                        attempts[asyncio.create_task(self._attempt(secondary, fn, latency_class, hold))] = secondary
+
+            pending = set(attempts)
+            errors = []
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = task
+                        if len(attempts) > 1:
+                            outcome = "primary_won" if task is primary_task else "hedge_won"
+                            metrics.hedged_requests_total.labels(outcome=outcome).inc()
+                        return task.result(), attempts[task]
+                    errors.append(task.exception())
+            if len(attempts) > 1:
+                metrics.hedged_requests_total.labels(outcome="failed").inc()
+            raise errors[0]
+        finally:
+            for task, replica in attempts.items():
+                if not task.done():
+                    task.cancel()
+                    # A loser that fails before its cancellation lands must not warn about an unretrieved error
+                    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+                elif task is not winner and not task.cancelled() and task.exception() is None:
+                    if hold:
+                        self.release(replica)
+                    if discard is not None:
+                        await discard(task.result())
+
+    async def probe(self, http_client: httpx.AsyncClient):
+        """
+        Probe `GET /health` on every replica once. A replica is evicted after
+        `unhealthy_threshold` consecutive failures and re-admitted on the
+        first success.
+        """
+        async def probe_one(replica: Replica):
+            try:
+                response = await http_client.get(f"{replica.base_url}/health", timeout=self.probe_timeout_s)
+                ok = response.status_code == 200
+            except httpx.HTTPError:
+                ok = False
+
+            if ok:
+                if not replica.healthy:
+                    logger.info(f"Replica {replica.name} is healthy again, re-admitting it.")
+                replica.probe_failures = 0
+                replica.healthy = True
+            else:
+                replica.probe_failures += 1
+                metrics.replica_probe_failures_total.labels(replica=replica.name).inc()
+                if replica.healthy and replica.probe_failures >= self.unhealthy_threshold:
+                    logger.warning(f"Replica {replica.name} failed {replica.probe_failures} health probes, evicting it.")
+                    replica.healthy = False
+            metrics.replica_healthy.labels(replica=replica.name).set(1 if replica.healthy else 0)
+
+        await asyncio.gather(*(probe_one(replica) for replica in self.replicas))
+
+    async def _probe_forever(self):
+        async with httpx.AsyncClient() as http_client:
+            while True:
+                await self.probe(http_client)
+                await asyncio.sleep(self.probe_interval_s)
+
+    def start(self):
+        """
+        Start the background health probe (not needed with a single replica).
+        """
+        if len(self.replicas) > 1 and self._probe_task is None:
+            self._probe_task = asyncio.create_task(self._probe_forever())
+
+    async def close(self):
+        """
+        Stop the health probe and close every replica client.
+        """
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+            await asyncio.gather(self._probe_task, return_exceptions=True)
+            self._probe_task = None
+        await asyncio.gather(*(replica.client.close() for replica in self.replicas))
@@ -0,0 +1,107 @@
+import hashlib
+import heapq
+import itertools
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Traffic classes. Interactive requests have capacity reserved for them.
+INTERACTIVE = "interactive"
+BATCH = "batch"
+PRIORITIES = (INTERACTIVE, BATCH)
+
+# Request headers used for classification
+PRIORITY_HEADER = "x-priority"
+TENANT_HEADER = "x-tenant-id"
+API_KEY_HEADER = "x-api-key"
+
+DEFAULT_TENANT = "default"
+
+# A flow is one (priority, tenant, language) class of requests
+Flow = Tuple[str, str, str]
+
+
+def classify_request(headers, language_id: str, default_priority: str = INTERACTIVE) -> Flow:
+    """
+    Classify a request into its scheduling flow from its headers.
+
+    The tenant is the `x-tenant-id` header, else a digest of the API key
+    (`x-api-key` or a bearer token) so raw keys never reach metrics or logs.
+    The priority is the `x-priority` header if it names a known class.
+    """
+    priority = headers.get(PRIORITY_HEADER, "").lower()
+    if priority not in PRIORITIES:
+        priority = default_priority
+
+    tenant = headers.get(TENANT_HEADER)
+    if not tenant:
+        api_key = headers.get(API_KEY_HEADER)
+        authorization = headers.get("authorization", "")
+        if not api_key and authorization.lower().startswith("bearer "):
+            api_key = authorization[7:].strip()
+        tenant = f"key-{hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:12]}" if api_key else DEFAULT_TENANT
+    return priority, tenant, language_id
+
+
+class FairQueue:
+    """
+    Weighted fair queue (start-time fair queuing) over flows.
+
+    Every flow gets a share of the dispatch order proportional to its weight,
+    however many requests it has queued, so a backfill flooding one flow
+    cannot starve the others. Entries are kept in one heap per priority so
+    that `pop` can skip priorities that are not currently allowed to run.
+    """
+
+    # Forget the finish tags of idle flows once this many are tracked
+    MAX_TRACKED_FLOWS = 4096
+
+    def __init__(self):
+        self._heaps: Dict[str, List[list]] = {priority: [] for priority in PRIORITIES}
+        self._flow_finish: Dict[Flow, float] = {}
+        self._virtual_time = 0.0
+        self._sequence = itertools.count()
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def push(self, flow: Flow, weight: float, item: Any) -> list:
+        """
+        Queue `item` for `flow`. Returns an entry handle for `remove`.
+        """
+        start = max(self._virtual_time, self._flow_finish.get(flow, 0.0))
+        finish = start + 1.0 / weight
+        self._flow_finish[flow] = finish
+        if len(self._flow_finish) > self.MAX_TRACKED_FLOWS:
+            self._flow_finish = {f: tag for f, tag in self._flow_finish.items() if tag > self._virtual_time}
+        # [finish tag, tie breaker, start tag, flow, item, removed]
+        entry = [finish, next(self._sequence), start, flow, item, False]
+        heapq.heappush(self._heaps[flow[0]], entry)
+        self._size += 1
+        return entry
+
+    def remove(self, entry: list):
+        """
+        Drop a queued entry (lazily; it is skipped when it reaches the top).
+        """
+        if not entry[5]:
+            entry[5] = True
+            self._size -= 1
+
+    def pop(self, eligible: Callable[[str], bool]) -> Optional[Tuple[Flow, Any]]:
+        """
+        Remove and return the (flow, item) with the smallest finish tag among
+        priorities for which `eligible(priority)` is true, or None.
+        """
+        best = None
+        for priority, heap in self._heaps.items():
+            while heap and heap[0][5]:
+                heapq.heappop(heap)
+            if heap and (best is None or heap[0] < best[0]) and eligible(priority):
+                best = (heap[0], heap)
+        if best is None:
+            return None
+        entry = heapq.heappop(best[1])
+        entry[5] = True
+        self._size -= 1
+        self._virtual_time = max(self._virtual_time, entry[2])
+        return entry[3], entry[4]
@@ -0,0 +1,51 @@
+import json
+from typing import Any
+
+from starlette.responses import JSONResponse
+
+# orjson is optional: it is several times faster than the stdlib encoder,
+# especially for non-ASCII text, but the service works without it.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BACKEND = "orjson" if orjson is not None else "json"
+
+
+def dumps(obj: Any) -> bytes:
+    """
+    Serialize `obj` to compact UTF-8 JSON bytes. Values the encoder does not
+    know are converted with str().
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, default=str)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=str).encode("utf-8")
+
+
+def loads(data):
+    """
+    Parse JSON from bytes or str. Raises ValueError on invalid input.
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def merge_objects(*serialized: bytes) -> bytes:
+    """
+    Concatenate already serialized JSON objects into one object without
+    parsing them again. On duplicate keys the later object wins, as with
+    dict.update.
+    """
+    members = [obj[1:-1] for obj in serialized if len(obj) > 2]
+    return b"{" + b",".join(members) + b"}"
+
+
+class FastJSONResponse(JSONResponse):
+    """
+    JSONResponse rendered with the fastest available serializer.
+    """
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
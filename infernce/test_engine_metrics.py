@@ -0,0 +1,53 @@
+import os
+
+from engine_metrics import parse_vllm_metrics
+
+FIXTURE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "vllm_metrics_sample.txt")
+
+# Values of the captured scrape of a vLLM (V1 engine) server with one LoRA-enabled model
+EXPECTED = {
+    "running": 7.0,
+    "waiting": 3.0,
+    "kv_cache_usage": 0.4375,
+    "prefix_cache_queries": 1234567.0,
+    "prefix_cache_hits": 987654.0,
+}
+
+
+def load_fixture() -> str:
+    with open(FIXTURE_PATH) as f:
+        return f.read()
+
+
+def test_parses_gauges_and_counters_of_captured_scrape():
+    assert parse_vllm_metrics(load_fixture()) == EXPECTED
+
+
+def test_parses_renamed_series():
+    # Newer engines renamed the KV-cache and prefix-cache series
+    exposition = (
+        load_fixture()
+        .replace("vllm:gpu_cache_usage_perc", "vllm:kv_cache_usage_perc")
+        .replace("vllm:gpu_prefix_cache", "vllm:prefix_cache")
+    )
+    assert parse_vllm_metrics(exposition) == EXPECTED
+
+
+def test_combines_data_parallel_engines():
+    # Counts add up, fractions take the busiest engine
+    exposition = (
+        load_fixture()
+        + 'vllm:num_requests_waiting{engine="1",model_name="m"} 5.0\n'
+        + 'vllm:gpu_cache_usage_perc{engine="1",model_name="m"} 0.9\n'
+    )
+    assert parse_vllm_metrics(exposition) == {**EXPECTED, "waiting": 8.0, "kv_cache_usage": 0.9}
+
+
+def test_parses_v0_hit_rate_gauge():
+    # The older engine exported a hit-rate gauge instead of counters
+    exposition = "vllm:num_requests_running 2.0\nvllm:num_requests_waiting 0.0\nvllm:gpu_prefix_cache_hit_rate 0.75\n"
+    assert parse_vllm_metrics(exposition) == {"running": 2.0, "waiting": 0.0, "prefix_cache_hit_rate": 0.75}
+
+
+def test_ignores_other_exporters():
+    assert parse_vllm_metrics("# TYPE up gauge\nup 1.0\n") == {}
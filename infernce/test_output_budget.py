@@ -0,0 +1,26 @@
+from output_budget import OutputBudgetPolicy
+from output_parser import parse_detoxified_output
+
+
+def test_hin_stops_on_every_toxic_words_label_the_parser_accepts():
+    # The Hinglish prompt labels the field "Toxic shabd"; "toxic_words" is its alternate spelling
+    stops = OutputBudgetPolicy().stop_sequences("tu bahut bekaar hai", "hin")
+    assert stops == ["\nToxic shabd", "\nToxic_words", "\ntoxic shabd", "\ntoxic_words", "\n\n"]
+
+
+def test_stop_sequences_cut_a_repeated_block_the_parser_would_read():
+    stops = OutputBudgetPolicy().stop_sequences("tu bahut bekaar hai", "hin")
+    for label in ("Toxic shabd", "toxic shabd", "toxic_words", "Toxic_words"):
+        output = f'{label}: ["bekaar"]\nNeutral text: tu achha nahi hai'
+        assert parse_detoxified_output(output, "hin")["status"] == "ok"
+        assert "\n" + label in stops
+
+
+def test_blank_line_stop_only_for_single_paragraph_inputs():
+    policy = OutputBudgetPolicy()
+    assert "\n\n" in policy.stop_sequences("one paragraph", "en")
+    assert "\n\n" not in policy.stop_sequences("first\n\nsecond", "en")
+
+
+def test_no_stop_sequences_when_disabled():
+    assert "stop" not in OutputBudgetPolicy(stop_sequences=False).generation_params("text", "hin")
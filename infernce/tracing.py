@@ -0,0 +1,225 @@
+import logging
+import random
+import re
+import time
+from contextvars import ContextVar
+from typing import Iterable, List, Optional, Tuple
+
+TRACEPARENT_HEADER = b"traceparent"
+SERVER_TIMING_HEADER = b"server-timing"
+
+# version-trace_id-parent_id-flags (https://www.w3.org/TR/trace-context/)
+_TRACEPARENT = re.compile(r"([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})(-.*)?")
+_INVALID_TRACE_ID = "0" * 32
+_INVALID_SPAN_ID = "0" * 16
+_SAMPLED_FLAG = 0x01
+
+
+def parse_traceparent(value: str) -> Optional[Tuple[str, str, bool]]:
+    """
+    Parse a W3C `traceparent` header value.
+
+    Returns:
+        (trace_id, parent_span_id, sampled), or None if the value is invalid.
+    """
+    match = _TRACEPARENT.fullmatch(value.strip())
+    if match is None:
+        return None
+    version, trace_id, parent_id, flags, rest = match.groups()
+    # Version 00 has exactly four fields; later versions may append more
+    if version == "ff" or (version == "00" and rest is not None):
+        return None
+    if trace_id == _INVALID_TRACE_ID or parent_id == _INVALID_SPAN_ID:
+        return None
+    return trace_id, parent_id, bool(int(flags, 16) & _SAMPLED_FLAG)
+
+
+def new_trace_id() -> str:
+    return f"{random.getrandbits(128) or 1:032x}"
+
+
+def new_span_id() -> str:
+    return f"{random.getrandbits(64) or 1:016x}"
+
+
+class Trace:
+    """
+    Trace context of one request. Every request has ids; only sampled
+    requests record spans. New ids are only generated when first read, so
+    an unsampled request that logs nothing never pays for them.
+
+    Attributes:
+        trace_id (str): 32 hex digits, taken from the incoming traceparent if any
+        span_id (str): Id of this request's server span
+        parent_id (Optional[str]): Span id of the caller, if it sent a traceparent
+        sampled (bool): Whether spans are recorded
+        start_time (float): perf_counter() at the start of the request
+        spans (List[tuple]): (name, span_id, start offset s, duration s) per stage
+    """
+
+    __slots__ = ("_trace_id", "_span_id", "parent_id", "sampled", "start_time", "spans")
+
+    def __init__(self, trace_id: Optional[str], parent_id: Optional[str], sampled: bool):
+        self._trace_id = trace_id
+        self._span_id = None
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.start_time = time.perf_counter()
+        self.spans: List[tuple] = []
+
+    @property
+    def trace_id(self) -> str:
+        if self._trace_id is None:
+            self._trace_id = new_trace_id()
+        return self._trace_id
+
+    @property
+    def span_id(self) -> str:
+        if self._span_id is None:
+            self._span_id = new_span_id()
+        return self._span_id
+
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def add_span(self, name: str, seconds: float):
+        """
+        Record a stage that just ended and took `seconds`.
+        """
+        if self.sampled:
+            self.spans.append((name, new_span_id(), time.perf_counter() - seconds - self.start_time, seconds))
+
+    def server_timing(self) -> str:
+        """
+        `Server-Timing` header value: the duration of every stage so far
+        (summed when a stage ran more than once, e.g. per batch item), the
+        total, and the traceparent so the client can find the trace.
+        """
+        durations = {}
+        for name, _, _, seconds in self.spans:
+            durations[name] = durations.get(name, 0.0) + seconds
+        entries = [f"{name};dur={seconds * 1000:.3f}" for name, seconds in durations.items()]
+        entries.append(f"total;dur={(time.perf_counter() - self.start_time) * 1000:.3f}")
+        entries.append(f'traceparent;desc="{self.traceparent()}"')
+        return ", ".join(entries)
+
+    def to_record(self, path: str, status_code: int) -> dict:
+        """
+        Log payload of a finished sampled request: its server span and one child span per stage.
+        """
+        return {
+            "record_type": "trace",
+            "path": path,
+            "status_code": status_code,
+            "parent_span_id": self.parent_id,
+            "duration_ms": (time.perf_counter() - self.start_time) * 1000,
+            "spans": [
+                {
+                    "name": name,
+                    "span_id": span_id,
+                    "parent_span_id": self.span_id,
+                    "start_offset_ms": start_s * 1000,
+                    "duration_ms": seconds * 1000,
+                }
+                for name, span_id, start_s, seconds in self.spans
+            ],
+        }
+
+
+# Trace of the request being handled; asyncio tasks inherit it when they are created
+current_trace: ContextVar[Optional[Trace]] = ContextVar("detox_trace", default=None)
+
+
+def record_span(name: str, seconds: float):
+    """
+    Record a stage of the current request, if it is traced and sampled.
+    """
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add_span(name, seconds)
+
+
+def install_log_record_factory():
+    """
+    Set `trace_id` and `span_id` on every log record created while a request
+    is traced, for `JsonFormatter`. Installing it twice is harmless.
+    """
+    factory = logging.getLogRecordFactory()
+    if getattr(factory, "adds_trace_ids", False):
+        return
+
+    def record_factory(*args, **kwargs):
+        record = factory(*args, **kwargs)
+        trace = current_trace.get()
+        if trace is not None:
+            record.trace_id = trace.trace_id
+            record.span_id = trace.span_id
+        return record
+
+    record_factory.adds_trace_ids = True
+    logging.setLogRecordFactory(record_factory)
+
+
+class TracingMiddleware:
+    """
+    Pure ASGI middleware that gives each request of the given paths a trace
+    context: the incoming W3C `traceparent` is continued (a sampled parent
+    samples the request too), otherwise a new trace is started and sampled
+    with `sample_rate`.
+
+    Sampled requests answer with a `Server-Timing` header of the stages that
+    finished before the response started, and log one trace record with all
+    their spans once the response is sent. Unsampled requests only carry
+    their ids into the log records.
+    """
+
+    def __init__(self, app, paths: Iterable[str], sample_rate: float = 0.0, logger: Optional[logging.Logger] = None):
+        self.app = app
+        self.paths = frozenset(paths)
+        self.sample_rate = sample_rate
+        self.logger = logger
+
+    def start_trace(self, headers) -> Trace:
+        for name, value in headers:
+            if name == TRACEPARENT_HEADER:
+                parent = parse_traceparent(value.decode("latin-1"))
+                if parent is not None:
+                    trace_id, parent_id, sampled = parent
+                    return Trace(trace_id, parent_id, sampled or self._sample())
+                break
+        return Trace(None, None, self._sample())
+
+    def _sample(self) -> bool:
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        trace = self.start_trace(scope["headers"])
+        token = current_trace.set(trace)
+        if not trace.sampled:
+            try:
+                await self.app(scope, receive, send)
+            finally:
+                current_trace.reset(token)
+            return
+
+        status_code = 500
+
+        async def send_with_timing(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((SERVER_TIMING_HEADER, trace.server_timing().encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            if self.logger is not None:
+                self.logger.info("Request Trace", extra={"json_payload": trace.to_record(scope["path"], status_code)})
+            current_trace.reset(token)
@@ -0,0 +1,46 @@
+import httpx
+from openai import AsyncOpenAI
+
+
+def create_async_client(
+    base_url: str,
+    api_key: str,
+    pool_size: int = 512,
+    keepalive_connections: int = 128,
+    keepalive_expiry_s: float = 30.0,
+    request_timeout_s: float = 60.0,
+    connect_timeout_s: float = 5.0,
+) -> AsyncOpenAI:
+    """
+    Create a non-blocking OpenAI-compatible client for the vLLM server.
+
+    The client owns a single pooled httpx.AsyncClient so that concurrent
+    generations reuse keep-alive connections instead of opening a new socket
+    per request.
+
+    Args:
+        base_url: vLLM OpenAI API base url, e.g. http://vllm:8000/v1
+        api_key: API key expected by the vLLM server
+        pool_size: Maximum number of concurrent upstream connections
+        keepalive_connections: Maximum number of idle connections kept open
+        keepalive_expiry_s: Seconds an idle connection is kept before closing
+        request_timeout_s: Default timeout for a whole upstream request
+        connect_timeout_s: Timeout for establishing a new connection
+
+    Returns:
+        AsyncOpenAI client. Call `await client.close()` at shutdown.
+    """
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=keepalive_connections,
+            keepalive_expiry=keepalive_expiry_s,
+        ),
+        timeout=httpx.Timeout(request_timeout_s, connect=connect_timeout_s),
+    )
+    return AsyncOpenAI(
+        api_key=api_key,
+        base_url=base_url,
+        http_client=http_client,
+        timeout=httpx.Timeout(request_timeout_s, connect=connect_timeout_s),
+    )